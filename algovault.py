@@ -17,22 +17,204 @@
 # You should have received a copy of the GNU Affero General Public License along
 # with algovault.  If not, see <https://www.gnu.org/licenses/>.
 
+import importlib
+import os
+import sys
+
+# With a daemon running (see algovault/daemon.py), hand the command over to it
+# before paying for any imports. Falls through if it isn't reachable.
+if (
+    __name__ == "__main__"
+    and os.environ.get("ALGOVAULT_DAEMON")
+    and sys.argv[1:2] != ["daemon"]
+):
+    from algovault.daemon_client import forward
+
+    exit_code = forward(os.environ["ALGOVAULT_DAEMON"], sys.argv[1:])
+    if exit_code is not None:
+        sys.exit(exit_code)
+
 import click
 
-import algovault.client
-import algovault.naming
-import algovault.qvote_counterexample
-import algovault.subscription
+from algovault import trace
+
+
+class LazyGroup(click.Group):
+    # Subcommand groups are imported on first use, so e.g. `name get` doesn't
+    # pay for importing the subscription and qvote modules.
+    def __init__(self, *args, lazy_commands=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lazy_commands = lazy_commands or {}
+
+    def list_commands(self, ctx):
+        return sorted(set(super().list_commands(ctx)) | set(self.lazy_commands))
+
+    def get_command(self, ctx, cmd_name):
+        if cmd_name in self.lazy_commands and cmd_name not in self.commands:
+            module_name, attr = self.lazy_commands[cmd_name].split(":")
+            command = getattr(importlib.import_module(module_name), attr)
+            self.add_command(command, cmd_name)
+        return super().get_command(ctx, cmd_name)
+
+
+@click.group(
+    cls=LazyGroup,
+    lazy_commands={
+        "daemon": "algovault.daemon:command",
+        "name": "algovault.naming:command_group",
+        "offline": "algovault.offline:command_group",
+        "qvote-counter": "algovault.qvote_counterexample:command_group",
+        "reconcile": "algovault.reconcile:command",
+        "shard": "algovault.shard:command_group",
+        "subscription": "algovault.subscription:command_group",
+        "teal-profile": "algovault.teal_profile:command",
+        "token": "algovault.token:command_group",
+    },
+)
+@click.option("--trace", "trace_summary", is_flag=True, help="Print per-RPC timings.")
+@click.option("--trace_file", type=click.Path(), help="Append RPC records as JSON.")
+@click.option(
+    "--pool_size",
+    type=click.INT,
+    help="Keep-alive connections per node (default 4, 0 disables pooling).",
+)
+@click.option(
+    "--idle_timeout",
+    type=click.FLOAT,
+    help="Seconds before an idle pooled connection is dropped (default 30).",
+)
+@click.option(
+    "--endpoints",
+    type=click.Path(exists=True, dir_okay=False),
+    envvar="ALGOVAULT_ENDPOINTS",
+    help="JSON file listing algod readers and a submitter to route between.",
+)
+@click.option(
+    "--offline",
+    "offline_file",
+    type=click.Path(exists=True, dir_okay=False),
+    help="Build against an `offline export` snapshot instead of algod.",
+)
+@click.option(
+    "--offline_out",
+    type=click.Path(allow_dash=True),
+    help="Where to append signed groups in offline mode ('-' for stdout).",
+)
+@click.option(
+    "--account_cache",
+    "account_cache_file",
+    type=click.Path(dir_okay=False),
+    envvar="ALGOVAULT_ACCOUNT_CACHE",
+    help="SQLite file to share the account/app info cache between processes.",
+)
+@click.option(
+    "--secret_ttl",
+    type=click.INT,
+    help="Seconds to keep derived subscription secrets (default 900, 0 disables).",
+)
+@click.option(
+    "--secret_cache",
+    is_flag=True,
+    envvar="ALGOVAULT_SECRET_CACHE",
+    help="Also keep them on disk between invocations, encrypted with the "
+    "wallet password.",
+)
+@click.option(
+    "--wallet_password",
+    envvar="ALGOVAULT_WALLET_PASSWORD",
+    help="Password of the kmd wallet (default empty).",
+)
+@click.option(
+    "--fee_target",
+    type=click.INT,
+    help="Rounds to aim to confirm within when picking fees (default 2).",
+)
+@click.pass_context
+def cli(
+    ctx,
+    trace_summary,
+    trace_file,
+    pool_size,
+    idle_timeout,
+    endpoints,
+    offline_file,
+    offline_out,
+    fee_target,
+    account_cache_file,
+    secret_ttl,
+    secret_cache,
+    wallet_password,
+):
+    if wallet_password is not None:
+        from algovault import client
+
+        client.wallet_password = wallet_password
+    if secret_cache and not wallet_password:
+        # The cache file is encrypted with a key stretched from the password.
+        click.echo(
+            "--secret_cache needs a wallet password (--wallet_password or"
+            " ALGOVAULT_WALLET_PASSWORD). Without one, secrets are only kept"
+            " in memory, which helps the daemon but not separate runs.",
+            err=True,
+        )
+        sys.exit(1)
+    if secret_ttl is not None or secret_cache:
+        from algovault import secret_cache as secrets
+
+        if secret_ttl is not None:
+            secrets.ttl = secret_ttl
+        secrets.on_disk = secret_cache
+    if account_cache_file is not None:
+        from algovault import client
+
+        client.account_cache_file = account_cache_file
+    if fee_target is not None:
+        from algovault import fees
+
+        fees.target_rounds = fee_target
+    if offline_file is not None:
+        from algovault import client
+
+        if offline_out is None:
+            click.echo("--offline needs --offline_out.", err=True)
+            sys.exit(1)
+        client.offline_file = offline_file
+        client.offline_out = offline_out
+    if endpoints is not None:
+        from algovault import client
+
+        client.endpoints_file = endpoints
+    if pool_size is not None or idle_timeout is not None:
+        from algovault import client, transport
+
+        if pool_size == 0:
+            client.set_transport(transport.UrllibTransport())
+        else:
+            client.set_transport(
+                transport.PooledTransport(
+                    pool_size=pool_size or 4,
+                    idle_timeout=30.0 if idle_timeout is None else idle_timeout,
+                )
+            )
+    if trace_summary or trace_file:
+        tracer = trace.enable(trace_file)
 
+        def finish():
+            if trace_summary:
+                from algovault import client
 
-@click.group()
-def cli():
-    algovault.client.init_environ()
+                click.echo(tracer.summary(), err=True)
+                stats = client.transport.stats()
+                if stats:
+                    click.echo(
+                        "  transport: "
+                        + " ".join(f"{key}={value}" for key, value in stats.items()),
+                        err=True,
+                    )
+            tracer.close()
 
+        ctx.call_on_close(finish)
 
-cli.add_command(algovault.naming.command_group)
-cli.add_command(algovault.qvote_counterexample.command_group)
-cli.add_command(algovault.subscription.command_group)
 
 if __name__ == "__main__":
     cli()
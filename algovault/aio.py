@@ -0,0 +1,465 @@
+# Copyright 2021 Mackenzie Straight
+#
+# This file is part of algovault.
+#
+# algovault is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# algovault is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with algovault.  If not, see <https://www.gnu.org/licenses/>.
+
+
+# Asyncio facade over the naming and subscription operations, for services
+# that want to embed algovault instead of shelling out to it. Nothing here
+# reads client.py's module globals: an AlgovaultClient works against the
+# algod/kmd clients in the Context it's given, and failures raise
+# AlgovaultError rather than exiting.
+#
+# The SDK is blocking, so building, signing and sending run on a bounded
+# thread pool. Waiting for confirmation doesn't hold a thread, though: one
+# watcher task per client follows the chain a round at a time and resolves
+# every waiter whose group landed, so a service can keep hundreds of
+# operations in flight on a handful of threads.
+#
+#   async with AlgovaultClient(Context.from_environ()) as vault:
+#       subs = await vault.subscription_list(sender)
+import asyncio
+import concurrent.futures
+import functools
+import threading
+import time
+
+from algosdk import error
+
+from algovault import client, fees, naming, subscription
+from algovault.subscription import (
+    DEFAULT_APP_ID,
+    DEFAULT_CASH_ID,
+    DEFAULT_SUB_ID,
+    SubscriptionAccount,
+)
+
+DEFAULT_WORKERS = 16
+# The CLI samples fees once per process; a long-lived client resamples about
+# every couple of rounds instead.
+FEE_MAX_AGE = 10.0
+
+
+class AlgovaultError(Exception):
+    pass
+
+
+class Context:
+    """
+    The algod and kmd clients to use, and which kmd wallet to sign with. kcl
+    can be left out for read-only use; wallet_id defaults to kmd's first
+    wallet, like the CLI.
+    """
+
+    def __init__(self, acl, kcl=None, wallet_id=None, password=""):
+        self.acl = acl
+        self.kcl = kcl
+        self.wallet_id = wallet_id
+        self.password = password
+
+    @classmethod
+    def from_environ(cls):
+        # Same discovery as the CLI, through $ALGORAND_DATA.
+        algod_url, algod_token = client._load_environ()["algod"]
+        kmd_url, kmd_token = client._discover_kmd()
+        return cls(
+            client.AlgodClient(algod_token, algod_url),
+            client.KMDClient(kmd_token, kmd_url),
+        )
+
+
+class AlgovaultClient:
+    def __init__(self, context, max_workers=DEFAULT_WORKERS):
+        self.ctx = context
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers, thread_name_prefix="algovault"
+        )
+        self._wallet_lock = asyncio.Lock()
+        self._wallet_handle = None
+        self._fee_lock = threading.Lock()
+        self._estimate = None
+        # Slot allocation reads and writes a shared state file.
+        self._slot_locks = {}
+        # txid -> (future, last valid round)
+        self._waiting = {}
+        self._watcher = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        if self._watcher is not None:
+            self._watcher.cancel()
+            try:
+                await self._watcher
+            except asyncio.CancelledError:
+                pass
+        self._executor.shutdown(wait=False)
+
+    def _run(self, fn, *args, **kwargs):
+        return asyncio.get_running_loop().run_in_executor(
+            self._executor, functools.partial(fn, *args, **kwargs)
+        )
+
+    async def _wallet(self):
+        async with self._wallet_lock:
+            if self._wallet_handle is None or time.monotonic() > self._wallet_handle[1]:
+                handle = await self._run(self._init_wallet)
+                self._wallet_handle = (
+                    handle,
+                    time.monotonic() + client.WALLET_HANDLE_LEASE,
+                )
+            return self._wallet_handle[0]
+
+    def _init_wallet(self):
+        kcl = self.ctx.kcl
+        if kcl is None:
+            raise AlgovaultError("no kmd client to sign with")
+        if self.ctx.wallet_id is None:
+            self.ctx.wallet_id = kcl.list_wallets()[0]["id"]
+        return kcl.init_wallet_handle(self.ctx.wallet_id, self.ctx.password)
+
+    def _fees(self):
+        with self._fee_lock:
+            if self._estimate is None or time.monotonic() > self._estimate[1]:
+                self._estimate = (
+                    fees.sample(self.ctx.acl, fees.target_rounds),
+                    time.monotonic() + FEE_MAX_AGE,
+                )
+            return self._estimate[0]
+
+    def _sign(self, wallet_handle, txn):
+        return self.ctx.kcl.sign_transaction(wallet_handle, self.ctx.password, txn)
+
+    async def _submit(self, build):
+        # build runs on the pool and returns a signed group. Resolves to the
+        # round it confirmed in.
+        group = await self._run(build)
+        try:
+            await self._run(self.ctx.acl.send_transactions, group)
+        except error.AlgodHTTPError as e:
+            raise AlgovaultError(str(e)) from e
+        return await self._confirm(group)
+
+    def _confirm(self, group):
+        txid = group[0].get_txid()
+        last_valid = min(txn.transaction.last_valid_round for txn in group)
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[txid] = (future, last_valid)
+        if self._watcher is None or self._watcher.done():
+            self._watcher = asyncio.ensure_future(self._watch())
+        return future
+
+    def _pending_info(self, txid):
+        try:
+            return self.ctx.acl.pending_transaction_info(txid)
+        except error.AlgodHTTPError as e:
+            # Not in the pool and not recently confirmed either.
+            return {"pool-error": str(e)}
+
+    async def _watch(self):
+        # Same bookkeeping as pipeline.submit_groups, but shared by every
+        # waiter on this client.
+        try:
+            current = (await self._run(self.ctx.acl.status))["last-round"]
+            while self._waiting:
+                status = await self._run(self.ctx.acl.status_after_block, current)
+                current = status["last-round"]
+                waiting = list(self._waiting.items())
+                infos = await asyncio.gather(
+                    *(self._run(self._pending_info, txid) for txid, _ in waiting)
+                )
+                for (txid, (future, last_valid)), info in zip(waiting, infos):
+                    if future.done():
+                        # The caller gave up on it.
+                        pass
+                    elif info.get("confirmed-round"):
+                        future.set_result(info["confirmed-round"])
+                    elif info.get("pool-error"):
+                        future.set_exception(AlgovaultError(info["pool-error"]))
+                    elif current > last_valid:
+                        future.set_exception(
+                            AlgovaultError(f"{txid} expired before confirmation")
+                        )
+                    else:
+                        continue
+                    del self._waiting[txid]
+        except Exception as e:
+            for future, _ in self._waiting.values():
+                if not future.done():
+                    future.set_exception(e)
+            self._waiting.clear()
+
+    # Names
+
+    async def name_create(self, name, authority, app_id=naming.DEFAULT_APP_ID):
+        """
+        Registers name, funded by and rekeyed to authority. Returns the
+        name's account address.
+        """
+        acl = self.ctx.acl
+        acct = naming.NamedAccount(app_id, name)
+        wallet_handle = await self._wallet()
+
+        def build():
+            fund, optin = acct.initialize(
+                acl.suggested_params(), authority, authority, self._fees()
+            )
+            return [self._sign(wallet_handle, fund), optin]
+
+        await self._submit(build)
+        return acct.get_address()
+
+    async def name_get(self, name, index, app_id=naming.DEFAULT_APP_ID):
+        # None if the name has nothing stored under index.
+        acct = naming.NamedAccount(app_id, name)
+        info = await self._run(self.ctx.acl.account_info, acct.get_address())
+        return naming._get_data(info, acct, index)
+
+    async def name_update(
+        self, signer, name, index, data, app_id=naming.DEFAULT_APP_ID
+    ):
+        acl = self.ctx.acl
+        acct = naming.NamedAccount(app_id, name)
+        wallet_handle = await self._wallet()
+
+        def build():
+            txn = acct.update_data(
+                acl.suggested_params(), index.encode("utf-8"), data.encode("utf-8")
+            )
+            return [
+                self.ctx.kcl.sign_transaction(
+                    wallet_handle,
+                    self.ctx.password,
+                    txn,
+                    signing_address=client.raw_signing_address(signer),
+                )
+            ]
+
+        return await self._submit(build)
+
+    # Subscriptions
+
+    async def subscription_request(
+        self,
+        sender,
+        receiver,
+        amount,
+        interval,
+        sign_sender=True,
+        sign_receiver=True,
+        sub_asset_id=DEFAULT_SUB_ID,
+        app_id=DEFAULT_APP_ID,
+        template_version=None,
+    ):
+        """
+        Builds a Subscribe group and signs the sides we hold keys for. The
+        result is what `subscription request` writes to its out_file, and
+        goes to subscription_submit once both sides are signed.
+
+        As with the CLI, the sub account slot isn't taken until the group
+        lands, so submit a request before asking for another one for the same
+        sender.
+        """
+        wallet_handle = await self._wallet()
+        lock = self._slot_locks.setdefault((sender, app_id), asyncio.Lock())
+        async with lock:
+            estimate = await self._run(self._fees)
+            return await self._run(
+                subscription._request_parts,
+                self.ctx.kcl,
+                self.ctx.acl,
+                wallet_handle,
+                self.ctx.password,
+                sender,
+                receiver,
+                amount,
+                interval,
+                sub_asset_id,
+                app_id,
+                sign_sender,
+                sign_receiver,
+                estimate,
+                template_version,
+                self.ctx.wallet_id,
+            )
+
+    async def subscription_submit(self, sender_parts, receiver_parts):
+        return await self._submit(
+            lambda: subscription._submit_group(sender_parts, receiver_parts)
+        )
+
+    async def subscription_list(self, sender, app_id=DEFAULT_APP_ID, max_index=None):
+        """
+        Returns (sub account address, key, SubscriptionRecord) for each of
+        sender's live subscriptions. key is None unless the app packs several
+        subscriptions into each sub account.
+        """
+        wallet_handle = await self._wallet()
+
+        def read():
+            secret = subscription._get_sub_account_secret(
+                self.ctx.kcl,
+                wallet_handle,
+                self.ctx.password,
+                sender,
+                app_id,
+                self.ctx.wallet_id,
+            )
+            slots = subscription.SubscriptionSlots(self.ctx.acl, secret, sender, app_id)
+            return [
+                (slots.account(i).get_address(), key, record)
+                for (i, key), record in subscription._read_subs(
+                    slots, max_index
+                ).items()
+            ]
+
+        async with self._slot_locks.setdefault((sender, app_id), asyncio.Lock()):
+            return await self._run(read)
+
+    async def _get_sub(self, sub_address, app_id, key=None):
+        info = await self._run(self.ctx.acl.account_info, sub_address)
+        sub_data = subscription._get_sub_account_data(info, app_id, key)
+        if sub_data is None:
+            raise AlgovaultError(f"no subscription at {sub_address}")
+        return info, sub_data
+
+    async def subscription_dispense(
+        self,
+        sub_address,
+        sub_asset_id=DEFAULT_SUB_ID,
+        app_id=DEFAULT_APP_ID,
+        max_intervals=0,
+        key=None,
+    ):
+        """
+        Pays out every overdue interval of one subscription (at most
+        max_intervals of them if that's nonzero), signed by its receiver.
+        """
+        _, sub_data = await self._get_sub(sub_address, app_id, key)
+        wallet_handle = await self._wallet()
+
+        def build():
+            group = subscription._dispense_group(
+                sub_address,
+                key,
+                sub_data,
+                self.ctx.acl.suggested_params(),
+                self._fees(),
+                sub_asset_id,
+                app_id,
+                max_intervals,
+            )
+            return [self._sign(wallet_handle, txn) for txn in group]
+
+        return await self._submit(build)
+
+    async def subscription_close(
+        self, signer, sub_address, app_id=DEFAULT_APP_ID, key=None
+    ):
+        """
+        Cancels a subscription. signer is its sender or receiver. In a packed
+        sub account, key picks the subscription, and the account itself is
+        only closed (back to the sender) once the sender cancels the last one.
+        """
+        info, sub_data = await self._get_sub(sub_address, app_id, key)
+        wallet_handle = await self._wallet()
+        if key is not None:
+            others = subscription._get_sub_account_subs(info, app_id).keys() - {key}
+            if others or signer != sub_data.sender:
+
+                def build():
+                    return subscription._cancel_group(
+                        self.ctx.kcl,
+                        wallet_handle,
+                        self.ctx.password,
+                        self.ctx.acl.suggested_params(),
+                        self._fees(),
+                        signer,
+                        sub_address,
+                        key,
+                        app_id,
+                    )
+
+                return await self._submit(build)
+            remainder_to = signer
+        else:
+            remainder_to = sub_data.receiver
+        sub_account = SubscriptionAccount.for_address(
+            info.get("auth-addr"), app_id, sub_data.sender, sub_data.receiver
+        )
+        if sub_account is None:
+            raise AlgovaultError(f"{sub_address} isn't controlled by a known template")
+
+        def build():
+            return subscription._close_group(
+                self.ctx.kcl,
+                wallet_handle,
+                self.ctx.password,
+                self.ctx.acl.suggested_params(),
+                self._fees(),
+                signer,
+                sub_address,
+                remainder_to,
+                sub_account,
+                app_id,
+            )
+
+        return await self._submit(build)
+
+    async def _swap(self, op, sender, amount, input_asset_id, output_asset_id, app_id):
+        wallet_handle = await self._wallet()
+
+        def build():
+            group = subscription._swap_group(
+                op,
+                sender,
+                amount,
+                input_asset_id,
+                output_asset_id,
+                self.ctx.acl.suggested_params(),
+                self._fees(),
+                app_id,
+            )
+            return [self._sign(wallet_handle, txn) for txn in group]
+
+        return await self._submit(build)
+
+    async def cash_in(
+        self,
+        sender,
+        amount,
+        cash_asset_id=DEFAULT_CASH_ID,
+        sub_asset_id=DEFAULT_SUB_ID,
+        app_id=DEFAULT_APP_ID,
+    ):
+        return await self._swap(
+            b"CashIn", sender, amount, cash_asset_id, sub_asset_id, app_id
+        )
+
+    async def cash_out(
+        self,
+        sender,
+        amount,
+        cash_asset_id=DEFAULT_CASH_ID,
+        sub_asset_id=DEFAULT_SUB_ID,
+        app_id=DEFAULT_APP_ID,
+    ):
+        return await self._swap(
+            b"CashOut", sender, amount, sub_asset_id, cash_asset_id, app_id
+        )
@@ -0,0 +1,258 @@
+# Copyright 2021 Mackenzie Straight
+#
+# This file is part of algovault.
+#
+# algovault is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# algovault is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with algovault.  If not, see <https://www.gnu.org/licenses/>.
+
+# Array-backed view of a whole book of subscriptions, for merchant side
+# analytics. One row per subscription blob, with the addresses left as raw
+# 32-byte keys so nothing gets allocated per record.
+#
+# NumPy is only needed by this module.
+import json
+
+from algosdk import encoding
+import numpy as np
+
+SECONDS_PER_DAY = 86400
+# bincount sums in float64, so amounts are split into 32-bit halves and summed
+# in chunks small enough that the float sums stay exact.
+_SUM_CHUNK = 1 << 20
+
+# Layout of the blob as stored on chain (see
+# subscription_teal.subtoken_approval_expr).
+BLOB_DTYPE = np.dtype(
+    [
+        ("sender", "V32"),
+        ("receiver", "V32"),
+        ("amount", ">u8"),
+        ("interval", ">u8"),
+        ("next", ">u8"),
+    ]
+)
+
+# Same fields, native byte order for arithmetic.
+SUBSCRIPTION_DTYPE = np.dtype(
+    [
+        ("sender", "V32"),
+        ("receiver", "V32"),
+        ("amount", "u8"),
+        ("interval", "u8"),
+        ("next", "u8"),
+    ]
+)
+
+
+def decode_blobs(blobs):
+    """
+    Decodes an iterable of raw 88-byte subscription blobs into a
+    SUBSCRIPTION_DTYPE structured array.
+    """
+    raw = b"".join(blobs)
+    if len(raw) % BLOB_DTYPE.itemsize != 0:
+        raise ValueError("subscription blobs must be exactly 88 bytes each")
+    return np.frombuffer(raw, dtype=BLOB_DTYPE).astype(SUBSCRIPTION_DTYPE)
+
+
+def address_key(address):
+    # For filtering, e.g. book[book["receiver"] == address_key(merchant)]
+    return np.void(encoding.decode_address(address))
+
+
+def load(path):
+    """
+    Loads a book saved with np.save, or a JSON-lines file of records as
+    produced by SubscriptionRecord.to_dict.
+    """
+    if path.endswith(".npy"):
+        return np.load(path).astype(SUBSCRIPTION_DTYPE)
+    rows = []
+    with open(path, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            rows.append(
+                (
+                    encoding.decode_address(record["sender"]),
+                    encoding.decode_address(record["receiver"]),
+                    record["amount"],
+                    record["interval"],
+                    record["next"],
+                )
+            )
+    return np.array(rows, dtype=SUBSCRIPTION_DTYPE)
+
+
+def _sums(index, amounts, size):
+    # Exact sum of uint64 amounts grouped by index, as (hi, lo) uint64 arrays
+    # with total = hi << 32 | lo.
+    lo = np.zeros(size, dtype=np.uint64)
+    hi = np.zeros(size, dtype=np.uint64)
+    for i in range(0, len(index), _SUM_CHUNK):
+        chunk_index = index[i : i + _SUM_CHUNK]
+        chunk_amounts = amounts[i : i + _SUM_CHUNK]
+        lo += np.bincount(
+            chunk_index,
+            weights=(chunk_amounts & np.uint64(0xFFFFFFFF)).astype(np.float64),
+            minlength=size,
+        ).astype(np.uint64)
+        hi += np.bincount(
+            chunk_index,
+            weights=(chunk_amounts >> np.uint64(32)).astype(np.float64),
+            minlength=size,
+        ).astype(np.uint64)
+        hi += lo >> np.uint64(32)
+        lo &= np.uint64(0xFFFFFFFF)
+    return hi, lo
+
+
+def _product_sums(index, amounts, counts, size):
+    # Like _sums, but of amounts * counts, which can overflow uint64 for a
+    # single row. Both factors are split into 32-bit halves so every partial
+    # product fits, and the partial sums are shifted into place. Totals of
+    # 2^96 or more (far past any asset's supply) wrap.
+    mask = np.uint64(0xFFFFFFFF)
+    shift = np.uint64(32)
+    counts = counts.astype(np.uint64)
+    amount_hi, amount_lo = amounts >> shift, amounts & mask
+    count_hi, count_lo = counts >> shift, counts & mask
+    hi, lo = _sums(index, amount_lo * count_lo, size)
+    for product, words in (
+        (amount_hi * count_lo, 1),
+        (amount_lo * count_hi, 1),
+        (amount_hi * count_hi, 2),
+    ):
+        if not np.any(product):
+            continue
+        part_hi, part_lo = _sums(index, product, size)
+        if words == 1:
+            hi += part_lo + (part_hi << shift)
+        else:
+            hi += part_lo << shift
+    return hi, lo
+
+
+def _dispense_counts(book, until):
+    # Number of dispenses each subscription allows up to and including the
+    # timestamp `until` (scalar or one per row).
+    next_time = book["next"].astype(np.int64)
+    interval = book["interval"].astype(np.int64)
+    due = next_time <= until
+    return np.where(due, (until - next_time) // interval + 1, 0).astype(np.uint64)
+
+
+def runout_days(book, sender_index, balances, start, days):
+    """
+    For each sender, the first day (relative to start) by the end of which
+    their scheduled dispenses exceed their balance, or `days` if their balance
+    lasts the whole horizon. Binary searches every sender at once, so it's
+    O(len(book) * log(days)).
+    """
+    num_senders = len(balances)
+    balances = np.asarray(balances, dtype=np.uint64)
+    balance_hi = balances >> np.uint64(32)
+    balance_lo = balances & np.uint64(0xFFFFFFFF)
+    lo = np.zeros(num_senders, dtype=np.int64)
+    hi = np.full(num_senders, days, dtype=np.int64)
+    while np.any(lo < hi):
+        mid = (lo + hi) // 2
+        until = start + (mid[sender_index] + 1) * SECONDS_PER_DAY - 1
+        spend_hi, spend_lo = _product_sums(
+            sender_index, book["amount"], _dispense_counts(book, until), num_senders
+        )
+        over = (spend_hi > balance_hi) | (
+            (spend_hi == balance_hi) & (spend_lo > balance_lo)
+        )
+        searching = lo < hi
+        hi = np.where(searching & over, mid, hi)
+        lo = np.where(searching & ~over, mid + 1, lo)
+    return lo
+
+
+def forecast(book, balances, start, days):
+    """
+    Projects every dispense of every subscription in the book over `days` days
+    from `start` and buckets the amounts by day. Anything already overdue lands
+    on day 0, since a catch-up dispense can take it right away.
+
+    balances is the sub token balance of each distinct sender, in the order of
+    np.unique(book["sender"]). Dispenses falling on or after the day a sender's
+    balance runs out are counted as at risk.
+
+    Returns (scheduled, at_risk, runout) where the first two are per-day lists
+    of ints and runout is the per-sender result of runout_days.
+    """
+    # A zero interval would allow unlimited dispenses; nothing sensible to
+    # project for those, so callers should filter them out first.
+    assert np.all(book["interval"] > 0)
+    _, sender_index = np.unique(book["sender"], return_inverse=True)
+    sender_index = sender_index.reshape(-1)
+    runout = runout_days(book, sender_index, balances, start, days)
+    end = start + days * SECONDS_PER_DAY
+    scheduled = [np.zeros(days, dtype=np.uint64), np.zeros(days, dtype=np.uint64)]
+    at_risk = [np.zeros(days, dtype=np.uint64), np.zeros(days, dtype=np.uint64)]
+
+    def add(bucket, day, amounts, counts=None):
+        if counts is None:
+            hi, lo = _sums(day, amounts, days)
+        else:
+            hi, lo = _product_sums(day, amounts, counts, days)
+        bucket[0] += hi
+        bucket[1] += lo
+
+    amount = book["amount"]
+    interval = book["interval"].astype(np.int64)
+    # Collapse everything overdue into one day 0 payment per subscription.
+    overdue = _dispense_counts(book, start - 1)
+    rows = np.nonzero(overdue)[0]
+    day = np.zeros(len(rows), dtype=np.int64)
+    add(scheduled, day, amount[rows], overdue[rows])
+    risky = runout[sender_index[rows]] == 0
+    add(at_risk, day[risky], amount[rows[risky]], overdue[rows[risky]])
+    next_time = book["next"].astype(np.int64) + overdue.astype(np.int64) * interval
+    rows = np.nonzero(next_time < end)[0]
+    # Subscriptions dispensing more than once a day: count each one's
+    # dispenses per day rather than stepping through them.
+    short = rows[interval[rows] < SECONDS_PER_DAY]
+    first, step = next_time[short], interval[short]
+    short_runout = runout[sender_index[short]]
+    done = np.zeros(len(short), dtype=np.int64)
+    for d in range(days if len(short) else 0):
+        until = start + (d + 1) * SECONDS_PER_DAY - 1
+        total = np.where(first <= until, (until - first) // step + 1, 0)
+        day = np.full(len(short), d, dtype=np.int64)
+        add(scheduled, day, amount[short], total - done)
+        risky = d >= short_runout
+        add(at_risk, day[risky], amount[short[risky]], (total - done)[risky])
+        done = total
+    # The rest have at most one dispense a day, so step through them one
+    # interval at a time, only touching subscriptions which still have one
+    # inside the horizon.
+    rows = rows[interval[rows] >= SECONDS_PER_DAY]
+    times = next_time[rows]
+    while len(rows):
+        day = (times - start) // SECONDS_PER_DAY
+        add(scheduled, day, amount[rows])
+        risky = day >= runout[sender_index[rows]]
+        add(at_risk, day[risky], amount[rows[risky]])
+        times = times + interval[rows]
+        keep = times < end
+        rows = rows[keep]
+        times = times[keep]
+
+    def to_ints(bucket):
+        return [(int(hi) << 32) + int(lo) for hi, lo in zip(*bucket)]
+
+    return to_ints(scheduled), to_ints(at_risk), runout
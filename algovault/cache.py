@@ -0,0 +1,149 @@
+# Copyright 2021 Mackenzie Straight
+#
+# This file is part of algovault.
+#
+# algovault is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# algovault is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with algovault.  If not, see <https://www.gnu.org/licenses/>.
+
+# Round-versioned cache for account_info and application_info. Every response
+# is stored with the round it reflects (the one algod reports, or for
+# application_info, which has none, the latest round we knew of when we asked),
+# and is good for as long as that's still the latest round we know of. The
+# latest round is learned from status calls, from the responses themselves and
+# from our own transactions confirming (wait_for_confirmation polls
+# pending_transaction_info), so anything fetched before one of our transactions
+# landed is dropped as soon as we see it land. If nothing has told us the round
+# for ROUND_CHECK seconds, the next lookup asks /status once before trusting
+# the cache.
+#
+# MemoryCache lives for the process. SqliteCache keeps entries and the latest
+# round in a file that several worker processes can share.
+import json
+import sqlite3
+import threading
+import time
+
+ROUND_CHECK = 1.0
+
+
+class MemoryCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.round = 0
+        self.checked = 0.0
+
+    def get(self, kind, key):
+        with self.lock:
+            entry = self.entries.get((kind, key))
+            if entry is None or entry[0] < self.round:
+                return None
+            return entry[1]
+
+    def put(self, kind, key, round, value):
+        with self.lock:
+            if round >= self.round:
+                self.entries[(kind, key)] = (round, value)
+
+    def observe(self, round):
+        with self.lock:
+            if round > self.round:
+                self.round = round
+                # Everything older is dead now.
+                self.entries = {
+                    k: entry for k, entry in self.entries.items() if entry[0] >= round
+                }
+            self.checked = time.monotonic()
+
+    def stale(self):
+        return time.monotonic() - self.checked > ROUND_CHECK
+
+    def latest(self):
+        with self.lock:
+            return self.round
+
+
+class SqliteCache:
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        with self._db() as db:
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    kind TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    round INTEGER NOT NULL,
+                    value TEXT NOT NULL,
+                    PRIMARY KEY (kind, key)
+                );
+                CREATE TABLE IF NOT EXISTS latest (
+                    id INTEGER PRIMARY KEY CHECK (id = 0),
+                    round INTEGER NOT NULL,
+                    checked REAL NOT NULL
+                );
+                INSERT OR IGNORE INTO latest VALUES (0, 0, 0);
+                """)
+
+    def _db(self):
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10)
+            db.execute("PRAGMA journal_mode = WAL")
+            db.execute("PRAGMA synchronous = OFF")
+            self.local.db = db
+        return db
+
+    def get(self, kind, key):
+        row = (
+            self._db()
+            .execute(
+                "SELECT value FROM entries, latest WHERE kind = ? AND key = ?"
+                " AND entries.round >= latest.round",
+                (kind, key),
+            )
+            .fetchone()
+        )
+        return None if row is None else json.loads(row[0])
+
+    def put(self, kind, key, round, value):
+        with self._db() as db:
+            db.execute(
+                "INSERT INTO entries SELECT ?, ?, ?, ? FROM latest WHERE ? >= round"
+                " ON CONFLICT (kind, key) DO UPDATE SET round = excluded.round,"
+                " value = excluded.value WHERE excluded.round >= entries.round",
+                (kind, key, round, json.dumps(value), round),
+            )
+
+    def observe(self, round):
+        # Wall clock rather than monotonic, since other processes read it.
+        with self._db() as db:
+            now = time.time()
+            if db.execute(
+                "UPDATE latest SET round = ?, checked = ? WHERE round < ?",
+                (round, now, round),
+            ).rowcount:
+                db.execute("DELETE FROM entries WHERE round < ?", (round,))
+            else:
+                db.execute("UPDATE latest SET checked = ?", (now,))
+
+    def stale(self):
+        (checked,) = self._db().execute("SELECT checked FROM latest").fetchone()
+        return time.time() - checked > ROUND_CHECK
+
+    def latest(self):
+        (round,) = self._db().execute("SELECT round FROM latest").fetchone()
+        return round
+
+
+def open_cache(path=None):
+    return MemoryCache() if path is None else SqliteCache(path)
@@ -17,20 +17,214 @@
 
 import base64
 import hashlib
+import json
 import os
 import sys
+import time
 from typing import Optional
+from urllib import parse
 
-from algosdk import kmd, encoding
+from algosdk import constants, error, kmd, encoding
 from algosdk.v2client import algod
 import click
 from os import path
 
+from algovault import trace
+from algovault.transport import PooledTransport
+
 ALGORAND_DATA = None
 kcl: Optional[kmd.KMDClient]
 kcl = None
 acl: Optional[algod.AlgodClient]
 acl = None
+# Shared by every client; see algovault.transport.
+transport = PooledTransport()
+# If set, algod requests are spread over the nodes listed in this file instead
+# of going to $ALGORAND_DATA's node; see algovault.routing.
+endpoints_file = None
+# If set, algod is replaced by a snapshot loaded from this file and sent
+# transactions are written to offline_out instead; see algovault.offline.
+offline_file = None
+offline_out = None
+# Round-versioned account/app info cache (see algovault.cache), set up by
+# get_algod. Set account_cache_file first to share it between processes.
+account_cache = None
+account_cache_file = None
+# Password of the wallet get_wallet opens, set from the root --wallet_password
+# option. It also keys the on-disk secret cache (see algovault.secret_cache).
+wallet_password = ""
+# Id of the wallet get_wallet opened, and its handle with the time (monotonic)
+# we stop trusting it and the password it was opened with. kmd hands out 60
+# second leases.
+wallet_id = None
+_wallet_handle = None
+WALLET_HANDLE_LEASE = 45
+
+
+def set_transport(new_transport):
+    global transport
+    transport = new_transport
+
+
+def _send(service, method, url, headers, data, via=None):
+    tracer = trace.tracer
+    start = time.perf_counter()
+    body = b""
+    outcome = "ok"
+    try:
+        status, body = (via or transport).request(method, url, headers, data)
+        if status >= 400:
+            outcome = f"http {status}"
+    except Exception as e:
+        outcome = type(e).__name__
+        raise
+    finally:
+        if tracer is not None:
+            tracer.record(
+                service,
+                method,
+                url[url.index("/", url.index("//") + 2) :],
+                time.perf_counter() - start,
+                len(data) if data else 0,
+                len(body),
+                outcome,
+            )
+    if status >= 400:
+        raise _HTTPFailure(status, body)
+    return body
+
+
+class _HTTPFailure(Exception):
+    def __init__(self, code, body):
+        self.code = code
+        self.body = body
+
+    def message(self):
+        text = self.body.decode("utf-8", "replace")
+        try:
+            return json.loads(text)["message"]
+        except Exception:
+            return text
+
+
+# The SDK clients do their own urlopen, which leaves us no way to see what each
+# call cost. These are drop-in replacements which route every request through
+# _send instead.
+class AlgodClient(algod.AlgodClient):
+    # Set on an instance to use something other than the shared transport.
+    transport = None
+
+    def algod_request(
+        self,
+        method,
+        requrl,
+        params=None,
+        data=None,
+        headers=None,
+        response_format="json",
+    ):
+        header = {}
+        if self.headers:
+            header.update(self.headers)
+        if headers:
+            header.update(headers)
+        if requrl not in constants.no_auth:
+            header[constants.algod_auth_header] = self.algod_token
+        if requrl not in constants.unversioned_paths:
+            requrl = algod.api_version_path_prefix + requrl
+        if params:
+            requrl = requrl + "?" + parse.urlencode(params)
+        try:
+            body = _send(
+                "algod",
+                method,
+                self.algod_address + requrl,
+                header,
+                data,
+                self.transport,
+            )
+        except _HTTPFailure as e:
+            raise error.AlgodHTTPError(e.message(), e.code)
+        if response_format == "json":
+            try:
+                return json.loads(body)
+            except Exception as e:
+                raise error.AlgodResponseError(
+                    "Failed to parse JSON response from algod"
+                ) from e
+        return body
+
+    # Cached lookups. Anything with extra request options goes straight through.
+    def _cached(self, kind, key, fetch):
+        if account_cache is None:
+            return fetch()
+        if account_cache.stale():
+            self.status()
+        value = account_cache.get(kind, key)
+        if value is None:
+            # application_info carries no round, so fall back on the round we
+            # knew of before asking; the response is at least that recent.
+            round = account_cache.latest()
+            value = fetch()
+            account_cache.put(kind, key, max(value.get("round", 0), round), value)
+        return value
+
+    def account_info(self, address, **kwargs):
+        if kwargs:
+            return super().account_info(address, **kwargs)
+        return self._cached(
+            "account", address, lambda: super(AlgodClient, self).account_info(address)
+        )
+
+    def application_info(self, application_id, **kwargs):
+        if kwargs:
+            return super().application_info(application_id, **kwargs)
+        return self._cached(
+            "application",
+            str(application_id),
+            lambda: super(AlgodClient, self).application_info(application_id),
+        )
+
+    def status(self, **kwargs):
+        result = super().status(**kwargs)
+        if account_cache is not None:
+            account_cache.observe(result["last-round"])
+        return result
+
+    def status_after_block(self, block_num, **kwargs):
+        result = super().status_after_block(block_num, **kwargs)
+        if account_cache is not None:
+            account_cache.observe(result["last-round"])
+        return result
+
+    def pending_transaction_info(self, transaction_id, **kwargs):
+        result = super().pending_transaction_info(transaction_id, **kwargs)
+        if (
+            account_cache is not None
+            and isinstance(result, dict)
+            and result.get("confirmed-round")
+        ):
+            account_cache.observe(result["confirmed-round"])
+        return result
+
+
+class KMDClient(kmd.KMDClient):
+    def kmd_request(self, method, requrl, params=None, data=None):
+        if requrl in constants.no_auth:
+            header = {}
+        else:
+            header = {constants.kmd_auth_header: self.kmd_token}
+        if requrl not in constants.unversioned_paths:
+            requrl = kmd.api_version_path_prefix + requrl
+        if params:
+            requrl = requrl + "?" + parse.urlencode(params)
+        if data:
+            data = json.dumps(data).encode("utf-8")
+        try:
+            body = _send("kmd", method, self.kmd_address + requrl, header, data)
+        except _HTTPFailure as e:
+            raise error.KMDHTTPError(e.message())
+        return json.loads(body)
 
 
 def _read_string_path(path):
@@ -39,21 +233,66 @@ def _read_string_path(path):
 
 
 def get_algod():
-    assert acl is not None
+    global acl, account_cache
+    if acl is None and offline_file is not None:
+        from algovault import offline
+
+        acl = offline.load_client(offline_file, offline_out)
+    elif acl is None and endpoints_file is not None:
+        from algovault import routing
+
+        acl = routing.load_endpoints(endpoints_file)
+    elif acl is None:
+        algod_url, algod_token = _load_environ()["algod"]
+        acl = AlgodClient(algod_token, algod_url)
+    if account_cache is None:
+        from algovault import cache
+
+        account_cache = cache.open_cache(account_cache_file)
     return acl
 
 
 def get_kmd():
-    assert kcl is not None
+    global kcl
+    if kcl is None:
+        kmd_url, kmd_token = _discover_kmd()
+        kcl = KMDClient(kmd_token, kmd_url)
     return kcl
 
 
 def get_wallet():
+    # The handle is reused while its kmd lease is still good, which matters
+    # for long-running processes like the daemon.
+    global wallet_id, _wallet_handle
     kcl = get_kmd()
     acl = get_algod()
-    wallets = kcl.list_wallets()
-    wallet_handle = kcl.init_wallet_handle(wallets[0]["id"], "")
-    return (kcl, acl, wallet_handle, "")
+    if (
+        _wallet_handle is None
+        or time.monotonic() > _wallet_handle[1]
+        or _wallet_handle[2] != wallet_password
+    ):
+        wallets = kcl.list_wallets()
+        wallet_id = wallets[0]["id"]
+        _wallet_handle = (
+            kcl.init_wallet_handle(wallet_id, wallet_password),
+            time.monotonic() + WALLET_HANDLE_LEASE,
+            wallet_password,
+        )
+    return (kcl, acl, _wallet_handle[0], wallet_password)
+
+
+def get_block(acl, round):
+    """
+    Fetches a block as msgpack and decodes it. Block and apply data fields
+    come back under their short msgpack names ("txns", "snd", "dt", ...).
+    """
+    import msgpack
+
+    # TEAL byte values are msgpack strings but needn't be valid UTF-8.
+    return msgpack.unpackb(
+        acl.block_info(round, response_format="msgpack"),
+        unicode_errors="surrogateescape",
+    )
 
 
 def raw_signing_address(signer):
@@ -66,28 +305,105 @@ def sha512_256(data):
     return h.digest()
 
 
-def init_environ():
-    global kcl, acl, ALGORAND_DATA
+def state_path(name):
+    base = os.environ.get("XDG_CACHE_HOME") or path.join(path.expanduser("~"), ".cache")
+    return path.join(base, "algovault", name)
+
+
+def read_state(name):
+    try:
+        with open(state_path(name), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_state(name, state):
+    # Best effort: if the cache dir isn't writable we just rediscover next time.
+    state_file = state_path(name)
+    tmp_file = f"{state_file}.{os.getpid()}"
+    try:
+        os.makedirs(path.dirname(state_file), mode=0o700, exist_ok=True)
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_file, state_file)
+    except OSError:
+        pass
+
+
+_environ = None
+
+
+def _load_environ():
+    # The endpoint config for $ALGORAND_DATA is cached in a state file keyed by
+    # the data dir's mtime (algod rewrites algod.net on restart, which bumps
+    # it), so most invocations don't have to touch the data dir at all.
+    global ALGORAND_DATA, _environ
+    if _environ is not None:
+        return _environ
     if not "ALGORAND_DATA" in os.environ:
         click.echo("ALGORAND_DATA environment variable must be set.", err=True)
         sys.exit(1)
-    ALGORAND_DATA = os.environ["ALGORAND_DATA"]
-    algod_net_path = path.join(ALGORAND_DATA, "algod.net")
-    algod_token_path = path.join(ALGORAND_DATA, "algod.token")
+    ALGORAND_DATA = path.abspath(os.environ["ALGORAND_DATA"])
+    mtime = os.stat(ALGORAND_DATA).st_mtime_ns
+    state = read_state("environ.json")
+    _environ = state.get(ALGORAND_DATA)
+    if _environ is None or _environ["mtime"] != mtime:
+        algod_net_path = path.join(ALGORAND_DATA, "algod.net")
+        algod_token_path = path.join(ALGORAND_DATA, "algod.token")
+        _environ = {
+            "mtime": mtime,
+            "algod": [
+                f"http://{_read_string_path(algod_net_path)}",
+                _read_string_path(algod_token_path),
+            ],
+            "kmd": None,
+        }
+        state[ALGORAND_DATA] = _environ
+        write_state("environ.json", state)
+    return _environ
+
+
+def _discover_kmd():
+    environ = _load_environ()
+    kmd_config = environ["kmd"]
+    # Entries written by older versions still hold the token; rediscovering
+    # rewrites them without it.
+    if kmd_config is not None and "token" not in kmd_config:
+        try:
+            if os.stat(kmd_config["dir"]).st_mtime_ns == kmd_config["mtime"]:
+                # The token is read fresh each time rather than kept in the
+                # state dir, where the secret cache lives.
+                token = _read_string_path(path.join(kmd_config["dir"], "kmd.token"))
+                return kmd_config["url"], token
+        except OSError:
+            pass
     kmd_base_path = None
     for dir in os.listdir(ALGORAND_DATA):
         if dir.startswith("kmd-"):
             kmd_base_path = path.join(ALGORAND_DATA, dir)
     if not kmd_base_path:
         click.echo(
-            "Could not find kmd directory in $ALGORAND_DATA. Make sure it's running."
+            "Could not find kmd directory in $ALGORAND_DATA. Make sure it's running.",
+            err=True,
         )
         sys.exit(1)
     kmd_net_path = path.join(kmd_base_path, "kmd.net")
     kmd_token_path = path.join(kmd_base_path, "kmd.token")
-    algod_url = f"http://{_read_string_path(algod_net_path)}"
-    algod_token = _read_string_path(algod_token_path)
-    kmd_url = f"http://{_read_string_path(kmd_net_path)}"
-    kmd_token = _read_string_path(kmd_token_path)
-    kcl = kmd.KMDClient(kmd_token, kmd_url)
-    acl = algod.AlgodClient(algod_token, algod_url)
+    environ["kmd"] = {
+        "dir": kmd_base_path,
+        "mtime": os.stat(kmd_base_path).st_mtime_ns,
+        "url": f"http://{_read_string_path(kmd_net_path)}",
+    }
+    state = read_state("environ.json")
+    state[ALGORAND_DATA] = environ
+    write_state("environ.json", state)
+    return environ["kmd"]["url"], _read_string_path(kmd_token_path)
+
+
+def init_environ():
+    # Eagerly set up both clients. Commands should generally just call
+    # get_algod/get_kmd, which only set up what they need.
+    get_algod()
+    get_kmd()
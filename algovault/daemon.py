@@ -0,0 +1,183 @@
+# Copyright 2021 Mackenzie Straight
+#
+# This file is part of algovault.
+#
+# algovault is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# algovault is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with algovault.  If not, see <https://www.gnu.org/licenses/>.
+
+# Resident daemon. Keeps the expensive per-invocation setup warm (imports,
+# $ALGORAND_DATA discovery, algod/kmd clients and their pooled connections,
+# the account and secret caches) and runs forwarded commands in-process. Run
+# it with `./algovault.py daemon`, then set ALGOVAULT_DAEMON to its socket
+# path and use algovault.py exactly as before; see daemon_client.
+#
+# Protocol, one JSON object per line. The client sends
+#   {"argv": [...], "cwd": ..., "algorand_data": ..., "env": {...}}
+# and gets back any number of {"fd": 1 or 2, "data": "..."} as the command
+# writes, then {"exit": code}, or {"exit": null} if this daemon can't serve it
+# (e.g. it's pointed at a different $ALGORAND_DATA).
+#
+# Commands run one at a time, since they print through the process-wide
+# stdout and set module-level options. Whatever the root options changed is
+# put back after each command.
+import contextlib
+import io
+import json
+import os
+import socketserver
+import sys
+import traceback
+
+import click
+
+from algovault import client, fees, secret_cache, trace
+
+# Module-level settings a command may change, restored after each one.
+_SESSION = [
+    (client, "endpoints_file"),
+    (client, "offline_file"),
+    (client, "offline_out"),
+    (client, "account_cache_file"),
+    (client, "transport"),
+    (client, "acl"),
+    (client, "account_cache"),
+    (client, "wallet_password"),
+    (fees, "target_rounds"),
+    (fees, "_estimate"),
+    (fees, "_checked"),
+    (secret_cache, "ttl"),
+    (secret_cache, "on_disk"),
+    (trace, "tracer"),
+]
+_PRELOAD = [
+    "algovault.naming",
+    "algovault.naming_teal",
+    "algovault.subscription",
+    "algovault.subscription_teal",
+    "algovault.teal_profile",
+    "algovault.token",
+]
+
+
+class _FrameWriter(io.TextIOBase):
+    def __init__(self, wfile, fd):
+        self.wfile = wfile
+        self.fd = fd
+
+    @property
+    def encoding(self):
+        return "utf-8"
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        # click probes streams with write(b"") to see if they're binary.
+        if not isinstance(data, str):
+            raise TypeError("write() argument must be str")
+        if data:
+            _send(self.wfile, {"fd": self.fd, "data": data})
+        return len(data)
+
+
+def _send(wfile, reply):
+    wfile.write(json.dumps(reply).encode("utf-8") + b"\n")
+    wfile.flush()
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        request = json.loads(line)
+        if request.get("algorand_data") != os.environ.get("ALGORAND_DATA"):
+            _send(self.wfile, {"exit": None})
+            return
+        _send(self.wfile, {"exit": self.server.run(request, self.wfile)})
+
+
+class Daemon(socketserver.UnixStreamServer):
+    def __init__(self, socket_path, cli):
+        self.cli = cli
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        # Anyone who can connect can sign with the wallet.
+        old_umask = os.umask(0o177)
+        try:
+            super().__init__(socket_path, _Handler)
+        finally:
+            os.umask(old_umask)
+        self.session = [
+            (module, name, getattr(module, name)) for module, name in _SESSION
+        ]
+
+    def run(self, request, wfile):
+        saved_env = {key: os.environ.get(key) for key in request["env"]}
+        os.environ.update(request["env"])
+        cwd = os.getcwd()
+        try:
+            os.chdir(request["cwd"])
+            with contextlib.redirect_stdout(
+                _FrameWriter(wfile, 1)
+            ), contextlib.redirect_stderr(_FrameWriter(wfile, 2)):
+                try:
+                    self.cli.main(request["argv"], prog_name="algovault.py")
+                    return 0
+                except SystemExit as e:
+                    if e.code is None or isinstance(e.code, int):
+                        return e.code or 0
+                    print(e.code, file=sys.stderr)
+                    return 1
+                except Exception:
+                    traceback.print_exc()
+                    return 1
+        finally:
+            os.chdir(cwd)
+            for key, value in saved_env.items():
+                if value is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
+            for module, name, value in self.session:
+                setattr(module, name, value)
+
+
+def serve(socket_path, cli):
+    import importlib
+
+    for module in _PRELOAD:
+        importlib.import_module(module)
+    client.init_environ()
+    daemon = Daemon(socket_path, cli)
+    click.echo(f"algovault daemon listening on {socket_path}", err=True)
+    try:
+        daemon.serve_forever()
+    finally:
+        daemon.server_close()
+        os.unlink(socket_path)
+
+
+@click.command("daemon")
+@click.option(
+    "--socket",
+    "socket_path",
+    type=click.Path(dir_okay=False),
+    help="Socket to listen on (default: algovault/daemon.sock in the state dir).",
+)
+@click.pass_context
+def command(ctx, socket_path):
+    if socket_path is None:
+        socket_path = client.state_path("daemon.sock")
+        os.makedirs(os.path.dirname(socket_path), mode=0o700, exist_ok=True)
+    serve(socket_path, ctx.find_root().command)
@@ -0,0 +1,58 @@
+# Copyright 2021 Mackenzie Straight
+#
+# This file is part of algovault.
+#
+# algovault is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# algovault is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with algovault.  If not, see <https://www.gnu.org/licenses/>.
+
+# Thin client for `algovault.py daemon`. Kept free of click/algosdk imports so
+# forwarding a command costs little more than interpreter startup. Returns
+# None if there's no usable daemon, in which case the caller runs the command
+# itself.
+import json
+import os
+import socket
+import sys
+
+# Forwarded so the daemon sees the same envvar-backed options.
+ENV_PREFIX = "ALGOVAULT_"
+
+
+def forward(socket_path, argv):
+    request = {
+        "argv": argv,
+        "cwd": os.getcwd(),
+        "algorand_data": os.environ.get("ALGORAND_DATA"),
+        "env": {
+            key: value
+            for key, value in os.environ.items()
+            if key.startswith(ENV_PREFIX) and key != "ALGOVAULT_DAEMON"
+        },
+    }
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(socket_path)
+    except OSError:
+        return None
+    with sock, sock.makefile("rb") as replies:
+        sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        for line in replies:
+            reply = json.loads(line)
+            if "exit" in reply:
+                return reply["exit"]
+            stream = sys.stdout if reply["fd"] == 1 else sys.stderr
+            stream.write(reply["data"])
+            stream.flush()
+    # The daemon went away mid-command.
+    print("algovault daemon closed the connection", file=sys.stderr)
+    return 1
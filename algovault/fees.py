@@ -0,0 +1,172 @@
+# Copyright 2021 Mackenzie Straight
+#
+# This file is part of algovault.
+#
+# algovault is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# algovault is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with algovault.  If not, see <https://www.gnu.org/licenses/>.
+
+# Fee engine. Picks a per-byte fee from how much is queued ahead of us and, for
+# each group, moves the whole fee onto one payer transaction (fee pooling) so
+# nobody else in the group has to hold spare algos for fees.
+#
+# The pending pool is ordered by fee per byte, and a block takes at most
+# MAX_BLOCK_BYTES. To land within target_rounds blocks we need to outbid
+# everything past the first target_rounds blocks' worth of pending bytes. When
+# the pool is deeper than that, recent blocks are sampled too: a nearly full
+# block turned something away, so the cheapest transaction it took is the going
+# rate, and we bid at least the median of those.
+#
+# Inner transactions (the app paying out sub tokens) always cost the minimum
+# fee and come out of the app account under TEAL v5, so the payer covers them
+# with the payment amount instead: pool_fees(group, estimate, inner=n).
+import time
+
+import msgpack
+
+from algovault.client import get_block, read_state, write_state
+
+DEFAULT_TARGET_ROUNDS = 2
+SAMPLE_BLOCKS = 4
+# Consensus MaxTxnBytesPerBlock.
+MAX_BLOCK_BYTES = 5 * 1024 * 1024
+FULL_BLOCK = 0.9
+# An estimate is reused by later invocations until the chain moves this many
+# rounds past it.
+MAX_AGE_ROUNDS = 2
+# A long-running process (the daemon) looks at the round again at most this
+# often to tell whether its estimate has aged out.
+RECHECK_SECONDS = 1.0
+# Set from the root --fee_target option.
+target_rounds = DEFAULT_TARGET_ROUNDS
+
+_estimate = None
+_checked = 0.0
+
+
+class FeeEstimate:
+    __slots__ = ("round", "fee_per_byte", "min_fee", "pool_bytes", "target_rounds")
+
+    def __init__(self, round, fee_per_byte, min_fee, pool_bytes=0, target_rounds=0):
+        self.round = round
+        self.fee_per_byte = fee_per_byte
+        self.min_fee = min_fee
+        self.pool_bytes = pool_bytes
+        self.target_rounds = target_rounds
+
+    def txn_fee(self, size):
+        return max(self.min_fee, self.fee_per_byte * size)
+
+    def to_dict(self):
+        return {key: getattr(self, key) for key in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(**d)
+
+
+def _rates(signed_txns):
+    # (fee per byte, encoded size) for raw msgpack-decoded signed transactions.
+    for stxn in signed_txns:
+        size = len(
+            msgpack.packb(stxn, use_bin_type=True, unicode_errors="surrogateescape")
+        )
+        yield stxn["txn"].get("fee", 0) / size, size
+
+
+def _block_floor(acl, round):
+    block = get_block(acl, round)
+    rates = list(_rates(block["block"].get("txns", [])))
+    if sum(size for _, size in rates) < FULL_BLOCK * MAX_BLOCK_BYTES:
+        return None
+    return min(rate for rate, _ in rates)
+
+
+def sample(acl, target_rounds=DEFAULT_TARGET_ROUNDS, sample_blocks=SAMPLE_BLOCKS):
+    sp = acl.suggested_params()
+    pool = msgpack.unpackb(
+        acl.pending_transactions(0, response_format="msgpack"),
+        unicode_errors="surrogateescape",
+    )
+    rates = sorted(_rates(pool.get("top-transactions") or []), reverse=True)
+    pool_bytes = sum(size for _, size in rates)
+    # algod's own suggestion is already per byte (and 0 when uncongested).
+    fee_per_byte = sp.fee
+    budget = target_rounds * MAX_BLOCK_BYTES
+    if pool_bytes > budget:
+        ahead = 0
+        for rate, size in rates:
+            ahead += size
+            if ahead > budget:
+                fee_per_byte = max(fee_per_byte, int(rate) + 1)
+                break
+        floors = sorted(
+            floor
+            for floor in (
+                _block_floor(acl, round)
+                for round in range(max(1, sp.first - sample_blocks + 1), sp.first + 1)
+            )
+            if floor is not None
+        )
+        if floors:
+            fee_per_byte = max(fee_per_byte, int(floors[len(floors) // 2]) + 1)
+    return FeeEstimate(sp.first, fee_per_byte, sp.min_fee, pool_bytes, target_rounds)
+
+
+def current(acl):
+    """
+    The estimate for this process, good until the chain moves MAX_AGE_ROUNDS
+    past it. A recent enough one from an earlier invocation is reused, and
+    clients that can't sample (offline mode) hand theirs over with
+    fee_estimate().
+    """
+    global _estimate, _checked
+    if hasattr(acl, "fee_estimate"):
+        if _estimate is None:
+            _estimate = acl.fee_estimate()
+        return _estimate
+    if _estimate is not None and time.monotonic() - _checked < RECHECK_SECONDS:
+        return _estimate
+    last_round = acl.status()["last-round"]
+    _checked = time.monotonic()
+    if (
+        _estimate is not None
+        and _estimate.target_rounds == target_rounds
+        and last_round - _estimate.round <= MAX_AGE_ROUNDS
+    ):
+        return _estimate
+    state = read_state("fees.json")
+    if (
+        state.get("target_rounds") == target_rounds
+        and 0 <= last_round - state.get("round", -MAX_AGE_ROUNDS - 1) <= MAX_AGE_ROUNDS
+    ):
+        _estimate = FeeEstimate.from_dict(state)
+    else:
+        _estimate = sample(acl, target_rounds)
+        write_state("fees.json", _estimate.to_dict())
+    return _estimate
+
+
+def pool_fees(group, estimate, payer=0, inner=None):
+    """
+    Sets group[payer]'s fee to the whole group's fee and zeroes the others.
+    Must be called before assign_group_id. If inner is given, group[payer] is
+    the payment topping up the app account and its amount is set to cover
+    that many inner transactions.
+    """
+    total = sum(estimate.txn_fee(txn.estimate_size()) for txn in group)
+    for txn in group:
+        txn.fee = 0
+    group[payer].fee = total
+    if inner is not None:
+        group[payer].amt = estimate.min_fee * inner
+    return total
@@ -25,11 +25,10 @@ import base64
 import sys
 
 from algosdk import encoding
-from algosdk.constants import MIN_TXN_FEE
 from algosdk.future import template, transaction
 import click
-from pyteal import *
 
+from algovault import fees
 from algovault.client import get_algod, get_kmd, raw_signing_address, sha512_256
 
 # testnet app id
@@ -43,31 +42,6 @@ def _lsig(program, txn):
     return transaction.LogicSigTransaction(txn, transaction.LogicSigAccount(program))
 
 
-def _approval_program():
-    success = Return(Int(1))
-    on_set = Seq(
-        [
-            App.localPut(
-                Txn.sender(), Txn.application_args[1], Txn.application_args[2]
-            ),
-            Return(Int(1)),
-        ]
-    )
-    on_noop = Cond([Txn.application_args[0] == Bytes("Set"), on_set])
-    program = Cond(
-        [Txn.application_id() == Int(0), success],
-        [Txn.on_completion() == OnComplete.OptIn, success],
-        [Txn.on_completion() == OnComplete.CloseOut, success],
-        [Txn.on_completion() == OnComplete.NoOp, on_noop],
-    )
-    return compileTeal(program, Mode.Application, version=5)
-
-
-def _clear_state_program():
-    program = Return(Int(1))
-    return compileTeal(program, Mode.Application, version=5)
-
-
 class NamedAccount(template.Template):
     def __init__(self, name_service_id, name):
         self.name_service_id = name_service_id
@@ -88,17 +62,19 @@ class NamedAccount(template.Template):
         program.extend([0x48, 0x48, 0x81, 0x01])
         return bytes(program)
 
-    def initialize(self, sp, funding_address, update_authority):
-        acl = get_algod()
+    def initialize(self, sp, funding_address, update_authority, estimate=None):
+        if estimate is None:
+            estimate = fees.current(get_algod())
         program = self.get_program()
         addr = self.get_address()
-        fund_txn = transaction.PaymentTxn(
-            funding_address, sp, addr, MINIMUM_BALANCE + MIN_TXN_FEE
-        )
+        # The opt-in's fee is pooled onto the funding payment, so the account
+        # only needs its minimum balance.
+        fund_txn = transaction.PaymentTxn(funding_address, sp, addr, MINIMUM_BALANCE)
         optin_txn = transaction.ApplicationOptInTxn(
-            addr, sp, DEFAULT_APP_ID, rekey_to=update_authority
+            addr, sp, self.name_service_id, rekey_to=update_authority
         )
         group = [fund_txn, optin_txn]
+        fees.pool_fees(group, estimate)
         transaction.assign_group_id(group)
         return (fund_txn, _lsig(program, optin_txn))
 
@@ -106,14 +82,16 @@ class NamedAccount(template.Template):
         return transaction.ApplicationCallTxn(
             self.get_address(),
             sp,
-            DEFAULT_APP_ID,
+            self.name_service_id,
             transaction.OnComplete.NoOpOC.real,
             app_args=[b"Set", data_index, data],
         )
 
-    def close(self, sp, remainder_to):
+    def close(self, sp, remainder_to, estimate=None):
+        if estimate is None:
+            estimate = fees.current(get_algod())
         close_out = transaction.ApplicationCloseOutTxn(
-            self.get_address(), sp, DEFAULT_APP_ID
+            self.get_address(), sp, self.name_service_id
         )
         payback = transaction.PaymentTxn(
             self.get_address(),
@@ -122,10 +100,24 @@ class NamedAccount(template.Template):
             0,
             close_remainder_to=remainder_to,
         )
+        fees.pool_fees([close_out, payback], estimate)
         transaction.assign_group_id([close_out, payback])
         return close_out, payback
 
 
+def _get_data(info, acct, index):
+    b64_index = base64.b64encode(index.encode("utf-8")).decode("utf-8")
+    for app_state in info["apps-local-state"]:
+        if app_state["id"] == acct.name_service_id:
+            if "key-value" in app_state:
+                for key_value in app_state["key-value"]:
+                    if key_value["key"] == b64_index:
+                        return base64.b64decode(key_value["value"]["bytes"]).decode(
+                            "utf-8"
+                        )
+    return None
+
+
 @click.group("name")
 def command_group():
     pass
@@ -133,13 +125,15 @@ def command_group():
 
 @command_group.command("deploy")
 def name_deploy():
+    from algovault import naming_teal
+
     kcl = get_kmd()
     acl = get_algod()
     wallets = kcl.list_wallets()
     wallet_handle = kcl.init_wallet_handle(wallets[0]["id"], "")
     creator = kcl.list_keys(wallet_handle)[0]
-    approval_bytecode = acl.compile(_approval_program())
-    clear_state_bytecode = acl.compile(_clear_state_program())
+    approval_bytecode = acl.compile(naming_teal.approval_program())
+    clear_state_bytecode = acl.compile(naming_teal.clear_state_program())
     suggested_params = acl.suggested_params()
     global_schema = transaction.StateSchema(0, 0)
     local_schema = transaction.StateSchema(0, 16)
@@ -228,20 +222,9 @@ def name_update(signer, name, index, data):
 @click.argument("name")
 @click.argument("index")
 def name_get(name, index):
-    acl = get_algod()
     acct = NamedAccount(DEFAULT_APP_ID, name)
-    info = acl.account_info(acct.get_address())
-    b64_index = base64.b64encode(index.encode("utf-8")).decode("utf-8")
-    for app_state in info["apps-local-state"]:
-        if app_state["id"] == DEFAULT_APP_ID:
-            if "key-value" in app_state:
-                for key_value in app_state["key-value"]:
-                    if key_value["key"] == b64_index:
-                        print(
-                            base64.b64decode(key_value["value"]["bytes"]).decode(
-                                "utf-8"
-                            )
-                        )
-                        return
-    click.echo("couldn't find a value for the given key", err=True)
-    sys.exit(1)
+    value = _get_data(get_algod().account_info(acct.get_address()), acct, index)
+    if value is None:
+        click.echo("couldn't find a value for the given key", err=True)
+        sys.exit(1)
+    print(value)
@@ -0,0 +1,49 @@
+# Copyright 2021 Mackenzie Straight
+#
+# This file is part of algovault.
+#
+# algovault is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# algovault is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with algovault.  If not, see <https://www.gnu.org/licenses/>.
+
+# PyTeal source for the name service app, split out so that the name commands
+# which only read or sign don't have to import PyTeal.
+from pyteal import *
+
+
+def approval_expr():
+    success = Return(Int(1))
+    on_set = Seq(
+        [
+            App.localPut(
+                Txn.sender(), Txn.application_args[1], Txn.application_args[2]
+            ),
+            Return(Int(1)),
+        ]
+    )
+    on_noop = Cond([Txn.application_args[0] == Bytes("Set"), on_set])
+    program = Cond(
+        [Txn.application_id() == Int(0), success],
+        [Txn.on_completion() == OnComplete.OptIn, success],
+        [Txn.on_completion() == OnComplete.CloseOut, success],
+        [Txn.on_completion() == OnComplete.NoOp, on_noop],
+    )
+    return program
+
+
+def approval_program():
+    return compileTeal(approval_expr(), Mode.Application, version=5)
+
+
+def clear_state_program():
+    program = Return(Int(1))
+    return compileTeal(program, Mode.Application, version=5)
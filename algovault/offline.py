@@ -0,0 +1,212 @@
+# Copyright 2021 Mackenzie Straight
+#
+# This file is part of algovault.
+#
+# algovault is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# algovault is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with algovault.  If not, see <https://www.gnu.org/licenses/>.
+
+# Offline transaction construction. An online host exports a snapshot of the
+# suggested params and the state of whichever accounts the commands will look
+# at; a signing host without node access then runs the usual commands with
+# `--offline snapshot.json --offline_out signed.jsonl`. Instead of going to
+# algod, each signed group is appended to the output as a JSON line, to be
+# sent later by `offline submit` on a host that does have a node.
+#
+# Snapshot format:
+#
+# {
+#   "round": 12345,
+#   "params": {"fee": 0, "first": 12345, "last": 13345, "gh": "...", ...},
+#   "accounts": {"ADDRESS": {<account_info response>}, ...},
+#   "applications": {"APP_ID": {<application_info response>}, ...},
+#   "fees": {<fees.FeeEstimate>}
+# }
+#
+# Accounts and apps missing from the snapshot are an error rather than treated
+# as empty, since e.g. the sub account slot search would happily reuse a live
+# slot. Sub account addresses are derived from the kmd secret, so get the ones
+# the search will probe from `subscription slot-addresses` on the signing host
+# and export with `--address_file`.
+import base64
+import json
+import sys
+
+from algosdk import encoding
+from algosdk.future import transaction
+from algosdk.v2client import algod
+import click
+
+from algovault import fees, pipeline, teal_asm
+from algovault.client import get_algod
+
+
+class OfflineAlgodClient(algod.AlgodClient):
+    def __init__(self, snapshot, snapshot_file, out):
+        super().__init__("", "http://offline")
+        self.snapshot = snapshot
+        self.snapshot_file = snapshot_file
+        self.out = out
+        self.sent = set()
+
+    def algod_request(self, method, requrl, *args, **kwargs):
+        # Anything not answered from the snapshot would need a live node.
+        click.echo(f"{method} {requrl} isn't available in offline mode.", err=True)
+        sys.exit(1)
+
+    def status(self, **kwargs):
+        return {"last-round": self.snapshot["round"]}
+
+    def status_after_block(self, block_num, **kwargs):
+        return self.status()
+
+    def suggested_params(self, **kwargs):
+        return transaction.SuggestedParams(**self.snapshot["params"])
+
+    def account_info(self, address, **kwargs):
+        info = self.snapshot["accounts"].get(address)
+        if info is None:
+            click.echo(
+                f"{address} isn't in the offline snapshot {self.snapshot_file}; "
+                "add it with `offline export --address`.",
+                err=True,
+            )
+            sys.exit(1)
+        return info
+
+    def application_info(self, application_id, **kwargs):
+        info = self.snapshot.get("applications", {}).get(str(application_id))
+        if info is None:
+            click.echo(
+                f"App {application_id} isn't in the offline snapshot "
+                f"{self.snapshot_file}; add it with `offline export --app_id`.",
+                err=True,
+            )
+            sys.exit(1)
+        return info
+
+    def fee_estimate(self):
+        if "fees" in self.snapshot:
+            return fees.FeeEstimate.from_dict(self.snapshot["fees"])
+        params = self.snapshot["params"]
+        return fees.FeeEstimate(
+            self.snapshot["round"], params["fee"], params["min_fee"]
+        )
+
+    def compile(self, source, **kwargs):
+        program = teal_asm.assemble(source)
+        return {
+            "hash": encoding.encode_address(encoding.checksum(b"Program" + program)),
+            "result": base64.b64encode(program).decode("utf-8"),
+        }
+
+    def send_transaction(self, txn, **kwargs):
+        return self.send_transactions([txn])
+
+    def send_transactions(self, txns, **kwargs):
+        txids = [txn.get_txid() for txn in txns]
+        record = {
+            "txids": txids,
+            "group": [encoding.msgpack_encode(txn) for txn in txns],
+        }
+        self.out.write(json.dumps(record) + "\n")
+        self.out.flush()
+        self.sent.update(txids)
+        return txids[0]
+
+    def pending_transaction_info(self, transaction_id, **kwargs):
+        if transaction_id not in self.sent:
+            return self.algod_request("GET", f"/transactions/pending/{transaction_id}")
+        # Nothing to wait for here; whether it lands is up to the submitter.
+        return {"confirmed-round": None}
+
+
+def load_client(snapshot_file, out_file):
+    with open(snapshot_file, "r") as f:
+        snapshot = json.load(f)
+    out = sys.stdout if out_file == "-" else open(out_file, "a")
+    return OfflineAlgodClient(snapshot, snapshot_file, out)
+
+
+@click.group("offline")
+def command_group():
+    pass
+
+
+@command_group.command()
+@click.option("--out_file", type=click.Path(), required=True)
+@click.option("--address", multiple=True)
+@click.option(
+    "--address_file",
+    type=click.Path(exists=True),
+    help="More addresses to include, one per line.",
+)
+@click.option("--app_id", type=click.INT, multiple=True, help="Apps to include.")
+def export(out_file, address, address_file, app_id):
+    acl = get_algod()
+    addresses = list(address)
+    if address_file:
+        with open(address_file, "r") as f:
+            addresses.extend(line.strip() for line in f if line.strip())
+    params = acl.suggested_params()
+    snapshot = {
+        "round": acl.status()["last-round"],
+        "params": vars(params),
+        "accounts": {
+            address: acl.account_info(address) for address in dict.fromkeys(addresses)
+        },
+        "applications": {
+            str(app): acl.application_info(app) for app in dict.fromkeys(app_id)
+        },
+        "fees": fees.current(acl).to_dict(),
+    }
+    with open(out_file, "w") as f:
+        json.dump(snapshot, f)
+    print(
+        f"Exported {len(snapshot['accounts'])} accounts and "
+        f"{len(snapshot['applications'])} apps at round "
+        f"{snapshot['round']}, valid until round {params.last}"
+    )
+
+
+@command_group.command()
+@click.option("--in_file", type=click.Path(exists=True), required=True)
+@click.option("--out_file", type=click.Path(), required=True)
+@click.option(
+    "--window",
+    type=click.INT,
+    default=pipeline.DEFAULT_WINDOW,
+    help="Groups to keep in flight at once.",
+)
+def submit(in_file, out_file, window):
+    # Sends the groups written by an offline run, one result line per group.
+    acl = get_algod()
+    with open(in_file, "r") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    groups = (
+        [encoding.future_msgpack_decode(txn) for txn in record["group"]]
+        for record in records
+    )
+    results = [None] * len(records)
+    for index, txid, confirmed_round, err in pipeline.submit_groups(
+        acl, groups, window
+    ):
+        results[index] = {"txid": txid, "round": confirmed_round, "error": err}
+        if err is not None:
+            click.echo(f"Group {txid} failed: {err}", err=True)
+    with open(out_file, "w") as f:
+        for result in results:
+            f.write(json.dumps(result) + "\n")
+    failed = sum(1 for result in results if result["error"] is not None)
+    print(f"Confirmed {len(records) - failed} of {len(records)} groups")
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,76 @@
+# Copyright 2021 Mackenzie Straight
+#
+# This file is part of algovault.
+#
+# algovault is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# algovault is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with algovault.  If not, see <https://www.gnu.org/licenses/>.
+
+# Windowed submission for batches of transaction groups. Rather than sending a
+# group and blocking until it confirms, up to `window` groups are kept in
+# flight, and each round the pending ones are checked and the window refilled.
+# A batch of N groups then takes roughly N / window rounds instead of N.
+#
+# Results come back in completion order as (index, txid, confirmed_round,
+# error), with exactly one of confirmed_round and error set.
+from algosdk import error
+
+DEFAULT_WINDOW = 8
+
+
+def submit_groups(acl, groups, window=DEFAULT_WINDOW):
+    """
+    Sends an iterable of signed groups (lists of SignedTransaction or
+    LogicSigTransaction) with at most `window` of them unconfirmed at a time,
+    yielding a result per group as it settles. A group that is rejected on
+    send, kicked out of the pool, or not confirmed by its last valid round
+    is reported with an error instead of raising.
+    """
+    groups = enumerate(groups)
+    # txid -> (index, last valid round)
+    in_flight = {}
+    current_round = acl.status()["last-round"]
+    exhausted = False
+    while True:
+        while not exhausted and len(in_flight) < window:
+            item = next(groups, None)
+            if item is None:
+                exhausted = True
+                break
+            index, group = item
+            txid = group[0].get_txid()
+            try:
+                acl.send_transactions(group)
+            except error.AlgodHTTPError as e:
+                yield index, txid, None, str(e)
+                continue
+            last_valid = min(txn.transaction.last_valid_round for txn in group)
+            in_flight[txid] = (index, last_valid)
+        if not in_flight:
+            return
+        current_round = acl.status_after_block(current_round)["last-round"]
+        for txid, (index, last_valid) in list(in_flight.items()):
+            try:
+                info = acl.pending_transaction_info(txid)
+            except error.AlgodHTTPError as e:
+                # Not in the pool and not recently confirmed either.
+                info = {"pool-error": str(e)}
+            if info.get("confirmed-round"):
+                result = (index, txid, info["confirmed-round"], None)
+            elif info.get("pool-error"):
+                result = (index, txid, None, info["pool-error"])
+            elif current_round > last_valid:
+                result = (index, txid, None, "expired before confirmation")
+            else:
+                continue
+            del in_flight[txid]
+            yield result
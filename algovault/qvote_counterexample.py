@@ -86,7 +86,7 @@ from algosdk.future import transaction
 import click
 
 from algovault import QVOTE_CONTRACTS_DIR, token
-from algovault.client import get_wallet
+from algovault.client import get_algod, get_wallet
 
 DEFAULT_TOKEN_ID = 48922235
 
@@ -266,7 +266,7 @@ def attack_vote(address_file, proposal, option, amount):
 @command_group.command()
 @click.option("--proposal", required=True)
 def status(proposal):
-    _, acl, _, _ = get_wallet()
+    acl = get_algod()
     info = acl.application_info(proposal)
     for state in info["params"]["global-state"]:
         decoded_key = base64.b64decode(state["key"]).decode()
@@ -0,0 +1,365 @@
+# Copyright 2021 Mackenzie Straight
+#
+# This file is part of algovault.
+#
+# algovault is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# algovault is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with algovault.  If not, see <https://www.gnu.org/licenses/>.
+
+# Reconciliation of subscription payments against the chain. Follows blocks
+# from a checkpoint and keeps a SQLite store of every subscription the app
+# holds and every interval it was owed:
+#
+#   subscriptions  one row per subscription, with its current blob fields and
+#                  the rounds it was created and closed in
+#   payments       one row per (subscription, due time): paid, late (paid after
+#                  being marked missed), missed, or mismatch (the transfers in
+#                  the dispensing call didn't add up to what was owed)
+#
+# A subscription is named by its sub account's address, with "/key" appended
+# for the ones in packed sub accounts.
+#
+# Everything comes from the block itself: the app's local state deltas give
+# each sub account's new blob, so comparing `next` before and after says
+# which intervals a Dispense/DispenseDue/DispenseMany paid, and the inner
+# clawback transfers in the same call say what actually moved. The checkpoint
+# is committed with each block's rows, so a restart picks up exactly where it
+# stopped.
+#
+# A due time counts as missed once it's `grace` seconds past without a
+# dispense; those are kept in a heap by deadline so each block only looks at
+# subscriptions that have actually fallen due.
+import heapq
+import sqlite3
+import sys
+
+from algosdk import encoding, error
+import click
+
+from algovault.client import get_algod, get_block
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS checkpoint (
+    app_id INTEGER PRIMARY KEY,
+    round INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS subscriptions (
+    address TEXT PRIMARY KEY,
+    sender TEXT NOT NULL,
+    receiver TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    interval INTEGER NOT NULL,
+    next INTEGER NOT NULL,
+    created_round INTEGER,
+    closed_round INTEGER
+);
+CREATE TABLE IF NOT EXISTS payments (
+    address TEXT NOT NULL,
+    due INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    round INTEGER,
+    PRIMARY KEY (address, due)
+);
+"""
+
+DEFAULT_GRACE = 86400
+_ON_CLOSE = (2, 3)  # CloseOut, ClearState
+_DISPENSE_OPS = (b"Dispense", b"DispenseDue", b"DispenseMany")
+# EvalDelta action for a deleted local key.
+_DELETE_ACTION = 3
+
+
+def _as_bytes(value):
+    # get_block leaves TEAL byte strings as surrogate-escaped str.
+    if isinstance(value, str):
+        return value.encode("utf-8", "surrogateescape")
+    return value
+
+
+def _sub_id(address, key):
+    # key is the packed local key, or None for the blob under "".
+    return address if key is None else f"{address}/{key}"
+
+
+class Subscription:
+    __slots__ = ("sender", "receiver", "amount", "interval", "next")
+
+    def __init__(self, sender, receiver, amount, interval, next):
+        self.sender = sender
+        self.receiver = receiver
+        self.amount = amount
+        self.interval = interval
+        self.next = next
+
+    @classmethod
+    def decode(cls, blob):
+        return cls(
+            encoding.encode_address(blob[0:32]),
+            encoding.encode_address(blob[32:64]),
+            int.from_bytes(blob[64:72], "big"),
+            int.from_bytes(blob[72:80], "big"),
+            int.from_bytes(blob[80:88], "big"),
+        )
+
+
+class Reconciler:
+    def __init__(self, db, app_id, grace=DEFAULT_GRACE):
+        self.db = db
+        self.app_id = app_id
+        self.app_address = encoding.decode_address(
+            encoding.encode_address(
+                encoding.checksum(b"appID" + app_id.to_bytes(8, "big"))
+            )
+        )
+        self.grace = grace
+        db.executescript(SCHEMA)
+        row = db.execute(
+            "SELECT round FROM checkpoint WHERE app_id = ?", (app_id,)
+        ).fetchone()
+        self.round = row[0] if row else None
+        self.subs = {}
+        self.deadlines = []
+        for address, *fields in db.execute(
+            "SELECT address, sender, receiver, amount, interval, next"
+            " FROM subscriptions WHERE closed_round IS NULL"
+        ):
+            self.subs[address] = Subscription(*fields)
+            self._schedule(address, fields[-1])
+
+    def _schedule(self, address, due):
+        heapq.heappush(self.deadlines, (due + self.grace, address, due))
+
+    def _store_sub(self, address, sub, created_round=None):
+        # A new Subscribe replaces whatever closed subscription last used the
+        # slot; anything else just moves `next`.
+        self.db.execute(
+            "INSERT INTO subscriptions VALUES (?, ?, ?, ?, ?, ?, ?, NULL)"
+            + (
+                " ON CONFLICT (address) DO UPDATE SET next = excluded.next"
+                if created_round is None
+                else " ON CONFLICT (address) DO UPDATE SET"
+                " sender = excluded.sender, receiver = excluded.receiver,"
+                " amount = excluded.amount, interval = excluded.interval,"
+                " next = excluded.next, created_round = excluded.created_round,"
+                " closed_round = NULL"
+            ),
+            (
+                address,
+                sub.sender,
+                sub.receiver,
+                sub.amount,
+                sub.interval,
+                sub.next,
+                created_round,
+            ),
+        )
+
+    def _paid(self, address, due, amount, status, round):
+        self.db.execute(
+            "INSERT INTO payments VALUES (?, ?, ?, ?, ?)"
+            " ON CONFLICT (address, due) DO UPDATE SET"
+            " status = CASE WHEN payments.status = 'missed' AND excluded.status"
+            " = 'paid' THEN 'late' ELSE excluded.status END,"
+            " amount = excluded.amount, round = excluded.round",
+            (address, due, status, amount, round),
+        )
+
+    def seed(self, acl, addresses):
+        # Pick up subscriptions that predate the first block we'll scan.
+        from algovault.subscription import _get_sub_account_blobs
+
+        for address in addresses:
+            blobs = _get_sub_account_blobs(acl.account_info(address), self.app_id)
+            for key, blob in blobs.items():
+                sub_id = _sub_id(address, key)
+                if sub_id in self.subs:
+                    continue
+                sub = Subscription.decode(blob)
+                self.subs[sub_id] = sub
+                self._store_sub(sub_id, sub)
+                self._schedule(sub_id, sub.next)
+
+    def _close(self, sub_id, round):
+        if self.subs.pop(sub_id, None) is not None:
+            self.db.execute(
+                "UPDATE subscriptions SET closed_round = ? WHERE address = ?",
+                (round, sub_id),
+            )
+
+    def _call(self, stxn, round):
+        txn = stxn["txn"]
+        on_complete = txn.get("apan", 0)
+        if on_complete in _ON_CLOSE:
+            # Takes every subscription in the sub account with it.
+            address = encoding.encode_address(txn["snd"])
+            for sub_id in [
+                sub_id
+                for sub_id in self.subs
+                if sub_id == address or sub_id.startswith(address + "/")
+            ]:
+                self._close(sub_id, round)
+            return
+        args = txn.get("apaa") or [b""]
+        apply_data = stxn.get("dt", {})
+        accounts = [txn["snd"]] + txn.get("apat", [])
+        # (sender, receiver) -> [owed, moved], since a DispenseMany call may
+        # pay several subscriptions between the same pair.
+        pairs = {}
+        paid = []
+        for index, delta in apply_data.get("ld", {}).items():
+            for key, value in delta.items():
+                key = _as_bytes(key)
+                address = _sub_id(
+                    encoding.encode_address(accounts[index]), key[0] if key else None
+                )
+                if value.get("at") == _DELETE_ACTION:
+                    # Cancel of a packed subscription.
+                    self._close(address, round)
+                    continue
+                if "bs" not in value:
+                    continue
+                sub = Subscription.decode(_as_bytes(value["bs"]))
+                old = self.subs.get(address)
+                self.subs[address] = sub
+                if args[0] == b"Subscribe":
+                    self._store_sub(address, sub, round)
+                    # The initial payment is the group's outer transfer.
+                    self._paid(
+                        address, sub.next - sub.interval, sub.amount, "paid", round
+                    )
+                else:
+                    self._store_sub(address, sub)
+                self._schedule(address, sub.next)
+                if args[0] not in _DISPENSE_OPS:
+                    continue
+                if old is None:
+                    # Unseen before the scan started; the transfer says how many
+                    # intervals this was.
+                    old = Subscription(
+                        sub.sender, sub.receiver, sub.amount, sub.interval, None
+                    )
+                due = old.next
+                owed = pairs.setdefault((sub.sender, sub.receiver), [0, 0])
+                if due is None:
+                    paid.append((address, sub, None))
+                    continue
+                while due < sub.next:
+                    paid.append((address, sub, due))
+                    owed[0] += sub.amount
+                    due += sub.interval
+        for inner in apply_data.get("itx", []):
+            itxn = inner["txn"]
+            # Only the app's own clawbacks count as payments.
+            if itxn.get("snd") != self.app_address:
+                continue
+            if "asnd" not in itxn or "arcv" not in itxn:
+                continue
+            pair = (
+                encoding.encode_address(itxn["asnd"]),
+                encoding.encode_address(itxn["arcv"]),
+            )
+            if pair in pairs:
+                pairs[pair][1] += itxn.get("aamt", 0)
+        for address, sub, due in paid:
+            owed, moved = pairs[(sub.sender, sub.receiver)]
+            if due is None:
+                # Only safe to infer when it's the pair's only subscription.
+                if owed == 0 and sub.amount:
+                    for k in range(1, moved // sub.amount + 1):
+                        self._paid(
+                            address,
+                            sub.next - k * sub.interval,
+                            sub.amount,
+                            "paid",
+                            round,
+                        )
+                continue
+            status = "paid" if owed == moved else "mismatch"
+            self._paid(address, due, sub.amount, status, round)
+
+    def _expire(self, now):
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, address, due = heapq.heappop(self.deadlines)
+            sub = self.subs.get(address)
+            if sub is None or sub.next > due:
+                continue
+            self.db.execute(
+                "INSERT OR IGNORE INTO payments VALUES (?, ?, 'missed', ?, NULL)",
+                (address, due, sub.amount),
+            )
+            self._schedule(address, due + sub.interval)
+
+    def ingest(self, block, round):
+        with self.db:
+            for stxn in block["block"].get("txns", []):
+                if stxn["txn"].get("apid") == self.app_id:
+                    self._call(stxn, round)
+            self._expire(block["block"].get("ts", 0))
+            self.db.execute(
+                "INSERT INTO checkpoint VALUES (?, ?) ON CONFLICT (app_id)"
+                " DO UPDATE SET round = excluded.round",
+                (self.app_id, round),
+            )
+        self.round = round
+
+
+@click.command("reconcile")
+@click.option("--db", "db_file", type=click.Path(), required=True)
+@click.option("--app_id", type=click.INT, required=True)
+@click.option(
+    "--from_round",
+    type=click.INT,
+    help="Round to start from when the store has no checkpoint yet.",
+)
+@click.option(
+    "--address_file",
+    type=click.Path(exists=True),
+    help="Sub accounts (one per line) to load the current state of first.",
+)
+@click.option(
+    "--grace",
+    type=click.INT,
+    default=DEFAULT_GRACE,
+    help="Seconds after a due time before it counts as missed.",
+)
+@click.option("--until_round", type=click.INT, help="Stop after this round.")
+def command(db_file, app_id, from_round, address_file, grace, until_round):
+    acl = get_algod()
+    db = sqlite3.connect(db_file)
+    db.execute("PRAGMA journal_mode = WAL")
+    db.execute("PRAGMA synchronous = NORMAL")
+    reconciler = Reconciler(db, app_id, grace)
+    if reconciler.round is None:
+        if from_round is None:
+            click.echo("No checkpoint in the store yet; pass --from_round.", err=True)
+            sys.exit(1)
+        reconciler.round = from_round - 1
+    if address_file:
+        with open(address_file, "r") as f:
+            addresses = [line.strip() for line in f if line.strip()]
+        with db:
+            reconciler.seed(acl, addresses)
+    last_round = acl.status()["last-round"]
+    while until_round is None or reconciler.round < until_round:
+        round = reconciler.round + 1
+        if round > last_round:
+            last_round = acl.status_after_block(last_round)["last-round"]
+            continue
+        try:
+            block = get_block(acl, round)
+        except error.AlgodHTTPError as e:
+            click.echo(f"Couldn't fetch round {round}: {e}", err=True)
+            sys.exit(1)
+        reconciler.ingest(block, round)
+    counts = dict(db.execute("SELECT status, count(*) FROM payments GROUP BY status"))
+    print(f"Reconciled through round {reconciler.round}: {counts}")
@@ -0,0 +1,168 @@
+# Copyright 2021 Mackenzie Straight
+#
+# This file is part of algovault.
+#
+# algovault is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# algovault is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with algovault.  If not, see <https://www.gnu.org/licenses/>.
+
+# Routing for a set of algod nodes. Reads of account/app/asset state and
+# /status go to whichever healthy reader currently answers fastest; everything
+# else (sending, pending transaction info, waiting for blocks) goes to the
+# designated submitter, since the pending pool is per-node.
+#
+# Readers are probed in the background. A reader is ejected when its last round
+# falls more than max_lag behind the best one, when a probe fails, or when a
+# routed read fails, and comes back once a probe says it's caught up again.
+#
+# Endpoint file format:
+#
+# {
+#   "submitter": {"url": "http://10.0.0.1:8080", "token": "..."},
+#   "readers": [
+#     {"url": "http://10.0.0.2:8080", "token": "..."},
+#     {"url": "http://10.0.0.3:8080", "token": "..."}
+#   ],
+#   "max_lag": 2,
+#   "probe_interval": 5,
+#   "timeout": 2
+# }
+import http.client
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from algosdk import error
+
+from algovault import client
+from algovault.transport import PooledTransport
+
+_READ_PREFIXES = ("/accounts/", "/applications/", "/assets/")
+
+# Weight of the newest sample in the per-node latency average.
+_LATENCY_ALPHA = 0.3
+
+
+class Endpoint:
+    def __init__(self, url, token, transport=None):
+        self.url = url
+        self.client = client.AlgodClient(token, url)
+        self.client.transport = transport
+        self.latency = None
+        self.last_round = None
+        self.healthy = False
+        self.error = None
+
+    def observe(self, duration):
+        if self.latency is None:
+            self.latency = duration
+        else:
+            self.latency += _LATENCY_ALPHA * (duration - self.latency)
+
+    def eject(self, reason):
+        self.healthy = False
+        self.error = reason
+
+
+class RoutedAlgodClient(client.AlgodClient):
+    def __init__(self, submitter, readers, max_lag=2, probe_interval=5.0, timeout=2.0):
+        super().__init__(submitter["token"], submitter["url"])
+        # Reads get their own pool with a short timeout so a wedged node costs
+        # at most `timeout` before we fail over.
+        read_transport = PooledTransport(timeout=timeout)
+        self.submitter = Endpoint(submitter["url"], submitter["token"])
+        self.readers = [
+            Endpoint(reader["url"], reader["token"], read_transport)
+            for reader in readers
+        ]
+        self.max_lag = max_lag
+        self.probe_interval = probe_interval
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max(1, len(self.readers)))
+        self.probe()
+        if self.readers:
+            threading.Thread(target=self._probe_loop, daemon=True).start()
+
+    def _probe_one(self, endpoint):
+        start = time.perf_counter()
+        try:
+            last_round = endpoint.client.status()["last-round"]
+        except Exception as e:
+            with self.lock:
+                endpoint.eject(f"probe failed: {e}")
+            return None
+        with self.lock:
+            endpoint.observe(time.perf_counter() - start)
+            endpoint.last_round = last_round
+        return last_round
+
+    def probe(self):
+        rounds = list(self.executor.map(self._probe_one, self.readers))
+        best = max((r for r in rounds if r is not None), default=None)
+        with self.lock:
+            for endpoint, last_round in zip(self.readers, rounds):
+                if last_round is None:
+                    continue
+                if best - last_round > self.max_lag:
+                    endpoint.eject(f"lagging {best - last_round} rounds")
+                else:
+                    endpoint.healthy = True
+                    endpoint.error = None
+
+    def _probe_loop(self):
+        while True:
+            time.sleep(self.probe_interval)
+            self.probe()
+
+    def _ranked_readers(self):
+        with self.lock:
+            healthy = [r for r in self.readers if r.healthy]
+        return sorted(healthy, key=lambda r: r.latency)
+
+    def algod_request(self, method, requrl, *args, **kwargs):
+        if method != "GET" or not (
+            requrl == "/status" or requrl.startswith(_READ_PREFIXES)
+        ):
+            return self.submitter.client.algod_request(method, requrl, *args, **kwargs)
+        for reader in self._ranked_readers():
+            start = time.perf_counter()
+            try:
+                result = reader.client.algod_request(method, requrl, *args, **kwargs)
+            except error.AlgodHTTPError as e:
+                # 4xx is about the request (e.g. unknown app id), not the node.
+                if e.code is not None and e.code < 500:
+                    raise
+                with self.lock:
+                    reader.eject(str(e))
+                continue
+            except (OSError, http.client.HTTPException) as e:
+                with self.lock:
+                    reader.eject(str(e))
+                continue
+            with self.lock:
+                reader.observe(time.perf_counter() - start)
+            return result
+        # Every reader is down or lagging; the submitter is the last resort.
+        return self.submitter.client.algod_request(method, requrl, *args, **kwargs)
+
+
+def load_endpoints(endpoints_file):
+    with open(endpoints_file, "r") as f:
+        config = json.load(f)
+    return RoutedAlgodClient(
+        config["submitter"],
+        config.get("readers", []),
+        max_lag=config.get("max_lag", 2),
+        probe_interval=config.get("probe_interval", 5.0),
+        timeout=config.get("timeout", 2.0),
+    )
@@ -0,0 +1,121 @@
+# Copyright 2021 Mackenzie Straight
+#
+# This file is part of algovault.
+#
+# algovault is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# algovault is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with algovault.  If not, see <https://www.gnu.org/licenses/>.
+
+# Session cache for the per-(sender, app) subscription secret, which otherwise
+# costs a kmd key export plus a signature on every request/list. Secrets are
+# kept in memory for `ttl` seconds, which is all a long-running process needs.
+#
+# With on_disk set, they're also written under the state dir, encrypted with
+# a SecretBox key stretched from the wallet password (scrypt, salted with the
+# wallet id), so the cache file is useless without the password, and a
+# different wallet or a changed password just misses and re-derives. The CLI
+# gets the password from --wallet_password, and refuses --secret_cache
+# without one; other callers with an empty password only get the in-memory
+# cache.
+import base64
+import hashlib
+import json
+import time
+
+import nacl.exceptions
+import nacl.secret
+
+from algovault import client
+
+DEFAULT_TTL = 15 * 60
+# Set from the root --secret_ttl/--secret_cache options.
+ttl = DEFAULT_TTL
+on_disk = False
+
+_memory = {}
+_boxes = {}
+
+
+def _box(pw, wallet_id):
+    # scrypt costs ~50ms, so only once per process and wallet.
+    box = _boxes.get((wallet_id, pw))
+    if box is None:
+        key = hashlib.scrypt(
+            pw.encode("utf-8"),
+            salt=b"algovault secret cache\0" + wallet_id.encode("utf-8"),
+            n=2**14,
+            r=8,
+            p=1,
+            dklen=nacl.secret.SecretBox.KEY_SIZE,
+        )
+        box = _boxes[wallet_id, pw] = nacl.secret.SecretBox(key)
+    return box
+
+
+def _state_name(wallet_id):
+    return f"secrets-{hashlib.sha256(wallet_id.encode('utf-8')).hexdigest()[:16]}.json"
+
+
+def _entry_name(sender, app_id):
+    return hashlib.sha256(f"{sender}:{app_id}".encode("utf-8")).hexdigest()
+
+
+def _load(pw, wallet_id, sender, app_id, now):
+    entry = client.read_state(_state_name(wallet_id)).get(_entry_name(sender, app_id))
+    if entry is None:
+        return None
+    try:
+        plain = _box(pw, wallet_id).decrypt(base64.b64decode(entry))
+    except (nacl.exceptions.CryptoError, ValueError):
+        return None
+    record = json.loads(plain)
+    if record["expires"] <= now:
+        return None
+    return record["expires"], base64.b64decode(record["secret"])
+
+
+def _store(pw, wallet_id, sender, app_id, expires, secret, now):
+    name = _state_name(wallet_id)
+    state = client.read_state(name)
+    box = _box(pw, wallet_id)
+    # Drop anything expired (or no longer readable) while we're here.
+    for key in list(state):
+        try:
+            if json.loads(box.decrypt(base64.b64decode(state[key])))["expires"] <= now:
+                del state[key]
+        except (nacl.exceptions.CryptoError, ValueError):
+            del state[key]
+    record = {"expires": expires, "secret": base64.b64encode(secret).decode("utf-8")}
+    state[_entry_name(sender, app_id)] = base64.b64encode(
+        box.encrypt(json.dumps(record).encode("utf-8"))
+    ).decode("utf-8")
+    client.write_state(name, state)
+
+
+def get(pw, wallet_id, sender, app_id, derive):
+    """
+    Returns the cached secret for (wallet, sender, app_id), calling derive()
+    to make it on a miss.
+    """
+    key = (wallet_id, sender, app_id)
+    now = time.time()
+    hit = _memory.get(key)
+    if hit is not None and hit[0] > now:
+        return hit[1]
+    persist = on_disk and bool(pw)
+    hit = _load(pw, wallet_id, sender, app_id, now) if persist else None
+    if hit is None:
+        hit = (now + ttl, derive())
+        if persist and ttl > 0:
+            _store(pw, wallet_id, sender, app_id, *hit, now)
+    _memory[key] = hit
+    return hit[1]
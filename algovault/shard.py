@@ -0,0 +1,283 @@
+# Copyright 2021 Mackenzie Straight
+#
+# This file is part of algovault.
+#
+# algovault is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# algovault is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with algovault.  If not, see <https://www.gnu.org/licenses/>.
+
+
+# Sharded subscription apps. A single app account makes every inner transfer
+# and holds the whole swap pool for its asset pair, so large merchants can
+# spread senders over several deployments instead. Each shard is its own
+# subscription app with its own sub token (an asset has exactly one clawback,
+# and the app needs to be it), all sharing the cash asset.
+#
+# The routing table is a name service record: key "0", "1", ... holds
+# "app_id:sub_asset_id", so one record's 16 local keys hold up to 16 shards.
+# A sender belongs to the shard with the highest sha512_256(sender || app_id)
+# (rendezvous hashing), which anyone can work out from the table alone and
+# which only moves about 1/N of senders when a shard is added. Subscriptions
+# made before that stay where they are; list and dispense look at every shard
+# anyway.
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from algosdk import encoding
+from algosdk.future import transaction
+import click
+
+from algovault import naming, subscription, token
+from algovault.client import (
+    get_wallet,
+    raw_signing_address,
+    read_state,
+    sha512_256,
+    write_state,
+)
+from algovault.naming import NamedAccount
+from algovault.subscription import DEFAULT_CASH_ID
+
+MAX_SHARDS = 16
+# Shards part way through deploying, by table name.
+DEPLOY_STATE = "shard_deploy.json"
+LOOKUP_WORKERS = 16
+
+
+def read_table(info, record):
+    # [(app_id, sub_asset_id)] from the record's account info.
+    shards = []
+    while len(shards) < MAX_SHARDS:
+        value = naming._get_data(info, record, str(len(shards)))
+        if value is None:
+            break
+        app_id, sub_asset_id = value.split(":")
+        shards.append((int(app_id), int(sub_asset_id)))
+    return shards
+
+
+def _load_table(acl, name):
+    record = NamedAccount(naming.DEFAULT_APP_ID, name)
+    shards = read_table(acl.account_info(record.get_address()), record)
+    if not shards:
+        click.echo(f"No shards in the table {name!r}", err=True)
+        sys.exit(1)
+    return shards
+
+
+def route(shards, sender):
+    """
+    Index of the shard sender's subscriptions and swaps go to.
+    """
+    key = encoding.decode_address(sender)
+    return max(
+        range(len(shards)),
+        key=lambda i: sha512_256(key + shards[i][0].to_bytes(8, "big")),
+    )
+
+
+def _write_entry(kcl, acl, wallet_handle, pw, record, authority, index, shard):
+    txn = record.update_data(
+        acl.suggested_params(),
+        str(index).encode("utf-8"),
+        "{}:{}".format(*shard).encode("utf-8"),
+    )
+    signed_txn = kcl.sign_transaction(
+        wallet_handle, pw, txn, signing_address=raw_signing_address(authority)
+    )
+    acl.send_transaction(signed_txn)
+    transaction.wait_for_confirmation(acl, signed_txn.get_txid(), 5)
+
+
+@click.group("shard")
+def command_group():
+    pass
+
+
+@command_group.command()
+@click.option("--creator", required=True)
+@click.option("--name", required=True, help="Name record holding the table.")
+@click.option("--count", type=click.INT, required=True, help="Total shards wanted.")
+@click.option("--cash_asset_id", type=click.INT, required=True, default=DEFAULT_CASH_ID)
+@click.option("--authority", help="Update authority of the name (default creator).")
+@click.option("--optimize/--no_optimize", default=True)
+@click.option(
+    "--template_version",
+    type=click.INT,
+    help="Sub account LogicSig version the apps accept (default latest).",
+)
+def deploy(creator, name, count, cash_asset_id, authority, optimize, template_version):
+    # Adds shards to the table until it has count of them. Each step of each
+    # shard is checkpointed, so rerunning after a failure picks up where it
+    # stopped rather than leaving orphaned tokens or apps.
+    if count > MAX_SHARDS:
+        click.echo(f"A table holds at most {MAX_SHARDS} shards", err=True)
+        sys.exit(1)
+    authority = authority or creator
+    kcl, acl, wallet_handle, pw = get_wallet()
+    record = NamedAccount(naming.DEFAULT_APP_ID, name)
+    info = acl.account_info(record.get_address())
+    if not any(
+        app["id"] == naming.DEFAULT_APP_ID for app in info.get("apps-local-state", [])
+    ):
+        click.echo(f"No name {name!r}, create it first with `name create`", err=True)
+        sys.exit(1)
+    shards = read_table(info, record)
+    state = read_state(DEPLOY_STATE)
+    while len(shards) < count:
+        pending = state.setdefault(name, {})
+        if pending.get("app_id") in {app_id for app_id, _ in shards}:
+            # Made it into the table last time.
+            pending.clear()
+        if "sub_asset_id" not in pending:
+            pending["sub_asset_id"] = token.create_max_token(
+                creator,
+                "SUB",
+                "Subscription Token",
+                manager=creator,
+                reserve=creator,
+            )
+            write_state(DEPLOY_STATE, state)
+        sub_asset_id = pending["sub_asset_id"]
+        if "app_id" not in pending:
+            pending["app_id"] = subscription._deploy_app(
+                creator, cash_asset_id, sub_asset_id, optimize, template_version
+            )
+            write_state(DEPLOY_STATE, state)
+        app_id = pending["app_id"]
+        if not pending.get("initialized"):
+            subscription._initialize_app(creator, app_id, cash_asset_id, sub_asset_id)
+            pending["initialized"] = True
+            write_state(DEPLOY_STATE, state)
+        if not pending.get("attached"):
+            subscription._attach_asset(creator, sub_asset_id, app_id)
+            pending["attached"] = True
+            write_state(DEPLOY_STATE, state)
+        _write_entry(
+            kcl,
+            acl,
+            wallet_handle,
+            pw,
+            record,
+            authority,
+            len(shards),
+            (app_id, sub_asset_id),
+        )
+        print(f"Shard {len(shards)}: app-id {app_id} sub-asset-id {sub_asset_id}")
+        shards.append((app_id, sub_asset_id))
+        del state[name]
+        write_state(DEPLOY_STATE, state)
+
+
+@command_group.command("table")
+@click.option("--name", required=True)
+def table_cmd(name):
+    kcl, acl, wallet_handle, pw = get_wallet()
+    for index, (app_id, sub_asset_id) in enumerate(_load_table(acl, name)):
+        print(
+            f"Shard {index}: app-id {app_id} sub-asset-id {sub_asset_id}"
+            f" account {subscription._encode_app_address(app_id)}"
+        )
+
+
+@command_group.command("route")
+@click.option("--name", required=True)
+@click.option("--sender", required=True)
+def route_cmd(name, sender):
+    # The --app_id and --sub_asset_id to use for sender's requests and swaps.
+    kcl, acl, wallet_handle, pw = get_wallet()
+    shards = _load_table(acl, name)
+    index = route(shards, sender)
+    app_id, sub_asset_id = shards[index]
+    print(json.dumps({"shard": index, "app_id": app_id, "sub_asset_id": sub_asset_id}))
+
+
+@command_group.command("list")
+@click.option("--name", required=True)
+@click.option("--sender", required=True)
+def list_cmd(name, sender):
+    kcl, acl, wallet_handle, pw = get_wallet()
+    shards = _load_table(acl, name)
+    # Secrets first, one at a time, since they share a cache file.
+    slots = [
+        subscription.SubscriptionSlots(
+            acl,
+            subscription._get_sub_account_secret(
+                kcl, wallet_handle, pw, sender, app_id
+            ),
+            sender,
+            app_id,
+        )
+        for app_id, _ in shards
+    ]
+    with ThreadPoolExecutor(len(shards)) as pool:
+        results = list(pool.map(subscription._read_subs, slots))
+    for shard_slots, subs in zip(slots, results):
+        for (i, key), sub_data in subs.items():
+            print(
+                "Account:",
+                shard_slots.account(i).get_address(),
+                *(() if key is None else ("key:", key)),
+                "app-id:",
+                shard_slots.app_id,
+                sub_data.to_dict(),
+            )
+
+
+@command_group.command()
+@click.option("--name", required=True)
+@click.option("--sub_address", required=True, multiple=True)
+@click.option(
+    "--max_intervals",
+    type=click.INT,
+    default=0,
+    help="Pay at most this many overdue intervals (0 pays all of them).",
+)
+def dispense(name, sub_address, max_intervals):
+    # Works out each sub account's shard from the app it's opted into, then
+    # dispenses every shard's subs at once.
+    kcl, acl, wallet_handle, pw = get_wallet()
+    shards = dict(_load_table(acl, name))
+    addresses = list(dict.fromkeys(sub_address))
+    with ThreadPoolExecutor(LOOKUP_WORKERS) as pool:
+        infos = list(pool.map(acl.account_info, addresses))
+    by_app = {}
+    for address, info in zip(addresses, infos):
+        app_ids = [
+            app["id"] for app in info.get("apps-local-state", []) if app["id"] in shards
+        ]
+        if not app_ids:
+            click.echo(f"{address} isn't in any shard, skipping.", err=True)
+            continue
+        by_app.setdefault(app_ids[0], []).append(address)
+    if not by_app:
+        return
+    suggested_params = acl.suggested_params()
+    with ThreadPoolExecutor(len(by_app)) as pool:
+        jobs = [
+            pool.submit(
+                subscription._dispense_many,
+                kcl,
+                acl,
+                wallet_handle,
+                pw,
+                suggested_params,
+                addresses,
+                shards[app_id],
+                app_id,
+                max_intervals,
+            )
+            for app_id, addresses in by_app.items()
+        ]
+        for job in jobs:
+            job.result()
@@ -47,8 +47,10 @@
 #    NamedAccounts using a secret only the wallet owner knows, plus a sequence
 #    number. The NamedAccount is then rekeyed to a LogicSig which implements the
 #    cancellation logic. An unlimited number of subscriptions are supported by
-#    storing the payment state inside local storage on the per-subscription
-#    account, which never contains any funds other than minimum balances.
+#    storing the payment state inside local storage on the sub accounts, which
+#    never contain any funds other than minimum balances. Apps deployed with
+#    template version 3 or later pack up to 16 subscriptions into each sub
+#    account, one per local key, so listing them takes 1/16th the lookups.
 #
 #    Enumerability means that a dapp or wallet can provide a management UI that
 #    shows all of your subscriptions, their payment dates, your spend over time,
@@ -58,6 +60,8 @@
 #    separately for each one. Accounts do exist for each subscription, but they
 #    never hold the actual funds.
 # 4. Receiver pays most fees, including the minimum balance for the sub account.
+#    (Packed sub accounts are shared between receivers, so there the sender
+#    funds them and gets the balance back when closing an empty one.)
 #
 # The downside is, well, it's still not fully automatic. But you can just grab a
 # bag of these tokens and they're as good as cash for anyone who receives them.
@@ -78,21 +82,21 @@
 #   instead of just frictionless spherical 4 week months ;)
 import base64
 import json
+import os.path
 import sys
+import threading
+import time
 
 from algosdk.future import template, transaction
 from algosdk import encoding, logic, util
 from algosdk.kmd import KMDClient
 from algosdk.v2client.algod import AlgodClient
 import click
-from pyteal import *
-from algovault import token
+from algovault import client, fees, pipeline, secret_cache, token
 
-from algovault.client import get_wallet
+from algovault.client import get_algod, get_block, get_wallet, read_state, write_state
 from algovault.naming import NamedAccount
 
-DEBUG_MODE = True
-
 # TestNet
 DEFAULT_APP_ID = 48056122
 DEFAULT_CASH_ID = 47862693
@@ -105,228 +109,118 @@ def _encode_app_address(app_id):
     )
 
 
+TEMPLATES_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "subscription_templates.json"
+)
+_templates = None
+
+
+def _load_templates():
+    # {version: {"program": base64, "offsets": {placeholder: offset}}}, written
+    # by gen_template.
+    global _templates
+    if _templates is None:
+        with open(TEMPLATES_FILE, "r") as f:
+            _templates = {
+                int(version): entry for version, entry in json.load(f).items()
+            }
+    return _templates
+
+
+def latest_template_version():
+    return max(_load_templates())
+
+
+# From this template version on, a sub account belongs to its sender and holds
+# up to SLOTS_PER_ACCOUNT subscriptions in local state, one per 1-byte key,
+# instead of a single one under "".
+PACKED_TEMPLATE_VERSION = 3
+SLOTS_PER_ACCOUNT = 16
+# Base account + app opt-in + a byte slice per local key.
+PACKED_ACCOUNT_BALANCE = 100000 + 100000 + SLOTS_PER_ACCOUNT * 50000
+# Global uint holding the template version an app takes.
+TEMPLATE_VERSION_KEY = "template_version"
+
+
 class SubscriptionAccount(template.Template):
     # See gen_template for the source code to this signature program.
-    CODE = base64.b64decode(
-        "BSADAQACJgEDU3VigCBDQ0NDQ0NDQ0NDQ0NDQ0NDQ0NDQ0NDQ0NDQ0NDQ0NDQzUAg"
-        "CBCQkJCQkJCQkJCQkJCQkJCQkJCQkJCQkJCQkJCQkJCQjUBKDEXUC00AQQoMRdQLT"
-        "QABBFEMSAyAxJEMQEjEkQyBIEDEkQzABAiEkQzAAcxABJEMwEAMQASRDMCADEAEkQ"
-        "xECISQAAkMRCBBhJAAAEAMRYiEkQxGBaACEFBQUFBQUFBEkQxGSQSRCJDMRYkEkQx"
-        "CCMSRDEJNAASRCJD"
-    )
+    FIELD_SIZES = {"receiver": 32, "sender": 32, "app_id": 8}
 
-    def __init__(self, app_id, sender, receiver):
+    def __init__(self, app_id, sender, receiver=None, version=None):
         self.app_id = app_id
         self.sender = sender
         self.receiver = receiver
+        self.version = latest_template_version() if version is None else version
+
+    @classmethod
+    def segments(cls, version=None):
+        """
+        The template split around its placeholders: bytes for the constant
+        parts (the first one prefixed with b"Program", as hashed for the
+        address) and placeholder names in between.
+        """
+        templates = _load_templates()
+        entry = templates[max(templates) if version is None else version]
+        code = base64.b64decode(entry["program"])
+        segments = []
+        pos = 0
+        for name, offset in sorted(entry["offsets"].items(), key=lambda kv: kv[1]):
+            segments.append(code[pos:offset])
+            segments.append(name)
+            pos = offset + cls.FIELD_SIZES[name]
+        segments.append(code[pos:])
+        segments[0] = b"Program" + segments[0]
+        return segments
 
     def get_program(self):
-        def replace(arr, new_val, offset, old_len):
-            return arr[:offset] + new_val + arr[offset + old_len :]
-
-        code = SubscriptionAccount.CODE
-        code = replace(code, encoding.decode_address(self.receiver), 14, 32)
-        code = replace(code, encoding.decode_address(self.sender), 50, 32)
-        code = replace(code, self.app_id.to_bytes(8, "big"), 172, 8)
-        return code
-
-    def get_address_pyteal(sender, receiver, app_id):
-        return Sha512_256(
-            Concat(
-                Bytes(b"Program" + SubscriptionAccount.CODE[0:14]),
-                receiver,
-                Bytes(SubscriptionAccount.CODE[46:50]),
-                sender,
-                Bytes(SubscriptionAccount.CODE[82:172]),
-                app_id,
-                Bytes(SubscriptionAccount.CODE[180:]),
-            )
+        # Packed templates have no receiver.
+        values = {
+            "sender": encoding.decode_address(self.sender),
+            "app_id": self.app_id.to_bytes(8, "big"),
+        }
+        if self.receiver is not None:
+            values["receiver"] = encoding.decode_address(self.receiver)
+        parts = [
+            values[segment] if isinstance(segment, str) else segment
+            for segment in self.segments(self.version)
+        ]
+        return b"".join(parts)[len(b"Program") :]
+
+    def signature_args(self, private_key, txid, signer):
+        # LogicSig args authorizing txid, signed by the sender or receiver.
+        program = self.get_program()
+        signature = logic.teal_sign_from_program(
+            private_key,
+            b"Sub" + base64.b32decode(encoding._correct_padding(txid)),
+            program,
         )
+        if self.version == 1 or self.version >= PACKED_TEMPLATE_VERSION:
+            return [signature]
+        return [signature, (1 if signer == self.receiver else 0).to_bytes(1, "big")]
 
+    @classmethod
+    def for_address(cls, auth_address, app_id, sender, receiver=None):
+        # Works out which template version a sub account was rekeyed to.
+        for version in sorted(_load_templates(), reverse=True):
+            if version < PACKED_TEMPLATE_VERSION and receiver is None:
+                continue
+            account = cls(app_id, sender, receiver, version)
+            if account.get_address() == auth_address:
+                return account
+        return None
 
-def _subtoken_approval(cash_asset_id, sub_asset_id):
-    related_index = ScratchVar(TealType.uint64)
-    scratch_subscribe_blob = ScratchVar(TealType.bytes)
-    success = Return(Int(1))
-    data_key = Bytes("")
-    # Aliases for subscribe call arguments.
-    arg_payment_sender = Txn.sender()
-    arg_sub_account = Txn.application_args[1]
-    arg_payment_receiver = Txn.application_args[2]
-    arg_amount = Txn.application_args[3]
-    arg_interval = Txn.application_args[4]
-    on_subscribe = Seq(
-        # Check arg lengths
-        Assert(Len(arg_sub_account) == Int(32)),
-        Assert(Len(arg_payment_receiver) == Int(32)),
-        Assert(Len(arg_amount) == Int(8)),
-        Assert(Len(arg_interval) == Int(8)),
-        Assert(App.optedIn(arg_sub_account, Global.current_application_id())),
-        # Must not already be a subscription
-        Assert(App.localGet(arg_sub_account, data_key) == Int(0)),
-        App.localPut(
-            arg_sub_account,
-            data_key,
-            Concat(
-                # 0
-                arg_payment_sender,
-                # 32
-                arg_payment_receiver,
-                # 64
-                arg_amount,
-                # 72
-                arg_interval,
-                # 80
-                Itob(Global.latest_timestamp() + Btoi(arg_interval)),
-            ),
-        ),
-        success,
-    )
-    on_dispense = Seq(
-        scratch_subscribe_blob.store(App.localGet(arg_sub_account, data_key)),
-        Assert(
-            Txn.sender() == Substring(scratch_subscribe_blob.load(), Int(32), Int(64))
-        ),
-        Assert(
-            Global.latest_timestamp()
-            >= Btoi(Substring(scratch_subscribe_blob.load(), Int(80), Int(88)))
-        ),
-        InnerTxnBuilder.Begin(),
-        InnerTxnBuilder.SetFields(
-            {
-                TxnField.type_enum: TxnType.AssetTransfer,
-                TxnField.asset_sender: Substring(
-                    scratch_subscribe_blob.load(), Int(0), Int(32)
-                ),
-                TxnField.asset_receiver: Substring(
-                    scratch_subscribe_blob.load(), Int(32), Int(64)
-                ),
-                TxnField.asset_amount: Btoi(
-                    Substring(scratch_subscribe_blob.load(), Int(64), Int(72))
-                ),
-                TxnField.xfer_asset: Int(sub_asset_id),
-            }
-        ),
-        InnerTxnBuilder.Submit(),
-        App.localPut(
-            arg_sub_account,
-            data_key,
-            Concat(
-                Substring(scratch_subscribe_blob.load(), Int(0), Int(80)),
-                Itob(
-                    Btoi(Substring(scratch_subscribe_blob.load(), Int(80), Int(88)))
-                    + Btoi(Substring(scratch_subscribe_blob.load(), Int(72), Int(80)))
-                ),
-            ),
-        ),
-        success,
-    )
-    on_opt_in = Seq(
-        # Subscribe transaction must follow opt-in in the group
-        Assert(Txn.group_index() + Int(1) < Global.group_size()),
-        related_index.store(Txn.group_index() + Int(1)),
-        Assert(Gtxn[related_index.load()].type_enum() == TxnType.ApplicationCall),
-        Assert(Gtxn[related_index.load()].on_completion() == OnComplete.NoOp),
-        Assert(Gtxn[related_index.load()].application_args[0] == Bytes(b"Subscribe")),
-        # And must be sent to the same app
-        Assert(
-            Gtxn[related_index.load()].application_id()
-            == Global.current_application_id()
-        ),
-        # And must be subscribing this sub account
-        Assert(Gtxn[related_index.load()].application_args[1] == Txn.sender()),
-        # And must rekey to the sub control LogicSig to allow cancellation
-        Assert(
-            Txn.rekey_to()
-            == SubscriptionAccount.get_address_pyteal(
-                sender=Gtxn[related_index.load()].sender(),
-                receiver=Gtxn[related_index.load()].application_args[2],
-                app_id=Itob(Global.current_application_id()),
-            )
-        ),
-        success,
-    )
-    on_initialize = Seq(
-        Assert(Txn.sender() == Global.creator_address()),
-        InnerTxnBuilder.Begin(),
-        InnerTxnBuilder.SetFields(
-            {
-                TxnField.type_enum: TxnType.AssetTransfer,
-                TxnField.asset_receiver: Global.current_application_address(),
-                TxnField.asset_amount: Int(0),
-                TxnField.xfer_asset: Int(sub_asset_id),
-            }
-        ),
-        InnerTxnBuilder.Submit(),
-        InnerTxnBuilder.Begin(),
-        InnerTxnBuilder.SetFields(
-            {
-                TxnField.type_enum: TxnType.AssetTransfer,
-                TxnField.asset_receiver: Global.current_application_address(),
-                TxnField.asset_amount: Int(0),
-                TxnField.xfer_asset: Int(cash_asset_id),
-            }
-        ),
-        InnerTxnBuilder.Submit(),
-        success,
-    )
-
-    def _token_swap(receive_asset, send_asset):
-        return Seq(
-            Assert(Txn.group_index() > Int(0)),
-            related_index.store(Txn.group_index() - Int(1)),
-            Assert(
-                And(
-                    Gtxn[related_index.load()].type_enum() == TxnType.AssetTransfer,
-                    Gtxn[related_index.load()].asset_receiver()
-                    == Global.current_application_address(),
-                    Gtxn[related_index.load()].xfer_asset() == Int(receive_asset),
-                )
-            ),
-            InnerTxnBuilder.Begin(),
-            InnerTxnBuilder.SetFields(
-                {
-                    TxnField.type_enum: TxnType.AssetTransfer,
-                    TxnField.asset_amount: Gtxn[related_index.load()].asset_amount(),
-                    TxnField.asset_receiver: Txn.application_args[1],
-                    TxnField.xfer_asset: Int(send_asset),
-                }
-            ),
-            InnerTxnBuilder.Submit(),
-            success,
-        )
 
-    on_cash_in = _token_swap(cash_asset_id, sub_asset_id)
-    on_cash_out = _token_swap(sub_asset_id, cash_asset_id)
-    on_noop = Cond(
-        [Txn.application_args[0] == Bytes("Initialize"), on_initialize],
-        [Txn.application_args[0] == Bytes("CashIn"), on_cash_in],
-        [Txn.application_args[0] == Bytes("CashOut"), on_cash_out],
-        [Txn.application_args[0] == Bytes("Subscribe"), on_subscribe],
-        [Txn.application_args[0] == Bytes("Dispense"), on_dispense],
-    )
-    debug_conds = []
-    if DEBUG_MODE:
-        on_update_app = Seq(Assert(Txn.sender() == Global.creator_address()), success)
-        debug_conds = [
-            [Txn.on_completion() == OnComplete.UpdateApplication, on_update_app],
-            [Txn.on_completion() == OnComplete.DeleteApplication, on_update_app],
-        ]
-    program = Cond(
-        [Txn.application_id() == Int(0), success],
-        [Txn.on_completion() == OnComplete.OptIn, on_opt_in],
-        # Close-out is always allowed. Sub account logicsig controls approval
-        # and disbursement of remaining balance.
-        [Txn.on_completion() == OnComplete.CloseOut, success],
-        [Txn.on_completion() == OnComplete.NoOp, on_noop],
-        *debug_conds
-    )
-    return compileTeal(program, Mode.Application, version=5)
+def _approval_teal(cash_asset_id, sub_asset_id, optimize, template_version=None):
+    from algovault import subscription_teal
 
+    approval = subscription_teal.subtoken_approval(
+        cash_asset_id, sub_asset_id, template_version
+    )
+    if optimize:
+        from algovault import teal_optimize
 
-def _clear_state_program():
-    program = Return(Int(1))
-    return compileTeal(program, Mode.Application, version=5)
+        approval = teal_optimize.optimize(approval)
+    return approval
 
 
 @click.group("subscription")
@@ -337,21 +231,51 @@ def command_group():
 @command_group.command()
 @click.option("--cash_asset_id", type=click.INT, required=True, default=DEFAULT_CASH_ID)
 @click.option("--sub_asset_id", type=click.INT, required=True, default=DEFAULT_SUB_ID)
-def teal(cash_asset_id, sub_asset_id):
-    print(_subtoken_approval(cash_asset_id, sub_asset_id))
+@click.option("--optimize/--no_optimize", default=True)
+@click.option(
+    "--template_version",
+    type=click.INT,
+    help="Sub account LogicSig version the app accepts (default latest).",
+)
+def teal(cash_asset_id, sub_asset_id, optimize, template_version):
+    print(_approval_teal(cash_asset_id, sub_asset_id, optimize, template_version))
 
 
 @command_group.command()
 @click.option("--creator", required=True)
 @click.option("--cash_asset_id", type=click.INT, required=True, default=DEFAULT_CASH_ID)
 @click.option("--sub_asset_id", type=click.INT, required=True, default=DEFAULT_SUB_ID)
-def deploy(creator, cash_asset_id, sub_asset_id):
+@click.option("--optimize/--no_optimize", default=True)
+@click.option(
+    "--template_version",
+    type=click.INT,
+    help="Sub account LogicSig version the app accepts (default latest).",
+)
+def deploy(creator, cash_asset_id, sub_asset_id, optimize, template_version):
+    app_id = _deploy_app(
+        creator, cash_asset_id, sub_asset_id, optimize, template_version
+    )
+    print("Created new app-id:", app_id, "account:", _encode_app_address(app_id))
+
+
+def _deploy_app(creator, cash_asset_id, sub_asset_id, optimize, template_version):
+    from algovault import subscription_teal
+
     kcl, acl, wallet_handle, pw = get_wallet()
-    approval_bytecode = acl.compile(_subtoken_approval(cash_asset_id, sub_asset_id))
-    clear_state_bytecode = acl.compile(_clear_state_program())
+    approval_bytecode = acl.compile(
+        _approval_teal(cash_asset_id, sub_asset_id, optimize, template_version)
+    )
+    clear_state_bytecode = acl.compile(subscription_teal.clear_state_program())
     suggested_params = acl.suggested_params()
-    global_schema = transaction.StateSchema(0, 0)
-    local_schema = transaction.StateSchema(0, 1)
+    if template_version is None:
+        template_version = latest_template_version()
+    # The template version, see _app_template_version.
+    global_schema = transaction.StateSchema(1, 0)
+    # One byte slice per subscription a sub account can hold.
+    if template_version >= PACKED_TEMPLATE_VERSION:
+        local_schema = transaction.StateSchema(0, SLOTS_PER_ACCOUNT)
+    else:
+        local_schema = transaction.StateSchema(0, 1)
     txn = transaction.ApplicationCreateTxn(
         creator,
         suggested_params,
@@ -365,8 +289,7 @@ def deploy(creator, cash_asset_id, sub_asset_id):
     acl.send_transaction(signed_txn)
     transaction.wait_for_confirmation(acl, signed_txn.get_txid(), 5)
     transaction_response = acl.pending_transaction_info(signed_txn.get_txid())
-    app_id = transaction_response["application-index"]
-    print("Created new app-id:", app_id, "account:", _encode_app_address(app_id))
+    return transaction_response["application-index"]
 
 
 @command_group.command()
@@ -374,17 +297,41 @@ def deploy(creator, cash_asset_id, sub_asset_id):
 @click.option("--cash_asset_id", type=click.INT, required=True, default=DEFAULT_CASH_ID)
 @click.option("--sub_asset_id", type=click.INT, required=True, default=DEFAULT_SUB_ID)
 @click.option("--app_id", type=click.INT, required=True, default=DEFAULT_APP_ID)
-def update(creator, cash_asset_id, sub_asset_id, app_id):
+@click.option("--optimize/--no_optimize", default=True)
+@click.option(
+    "--template_version",
+    type=click.INT,
+    help="Sub account LogicSig version the app accepts (default latest).",
+)
+def update(creator, cash_asset_id, sub_asset_id, app_id, optimize, template_version):
+    from algovault import subscription_teal
+
     kcl, acl, wallet_handle, pw = get_wallet()
-    approval_bytecode = acl.compile(_subtoken_approval(cash_asset_id, sub_asset_id))
-    clear_state_bytecode = acl.compile(_clear_state_program())
+    template_version = _app_template_version(acl, app_id, template_version, latest=True)
+    approval_bytecode = acl.compile(
+        _approval_teal(cash_asset_id, sub_asset_id, optimize, template_version)
+    )
+    clear_state_bytecode = acl.compile(subscription_teal.clear_state_program())
     suggested_params = acl.suggested_params()
+    global_schema = acl.application_info(app_id)["params"].get(
+        "global-state-schema", {}
+    )
+    app_args = None
+    if global_schema.get("num-uint", 0):
+        app_args = [template_version.to_bytes(8, "big")]
+    elif template_version != 1:
+        click.echo(
+            f"App {app_id} predates recording its template version, so pass"
+            f" --template_version {template_version} when making requests",
+            err=True,
+        )
     txn = transaction.ApplicationUpdateTxn(
         creator,
         suggested_params,
         app_id,
         base64.b64decode(approval_bytecode["result"]),
         base64.b64decode(clear_state_bytecode["result"]),
+        app_args=app_args,
     )
     signed_txn = kcl.sign_transaction(wallet_handle, pw, txn)
     acl.send_transaction(signed_txn)
@@ -397,6 +344,10 @@ def update(creator, cash_asset_id, sub_asset_id, app_id):
 @click.option("--cash_asset_id", type=click.INT, required=True, default=DEFAULT_CASH_ID)
 @click.option("--sub_asset_id", type=click.INT, required=True, default=DEFAULT_SUB_ID)
 def initialize(creator, app_id, cash_asset_id, sub_asset_id):
+    _initialize_app(creator, app_id, cash_asset_id, sub_asset_id)
+
+
+def _initialize_app(creator, app_id, cash_asset_id, sub_asset_id):
     app_address = _encode_app_address(app_id)
     kcl, acl, wallet_handle, pw = get_wallet()
     suggested_params = acl.suggested_params()
@@ -410,6 +361,7 @@ def initialize(creator, app_id, cash_asset_id, sub_asset_id):
         foreign_assets=[cash_asset_id, sub_asset_id],
     )
     group = [fund_txn, init_txn]
+    fees.pool_fees(group, fees.current(acl))
     transaction.assign_group_id(group)
     group = [kcl.sign_transaction(wallet_handle, pw, tx) for tx in group]
     group_txid = acl.send_transactions(group)
@@ -421,6 +373,10 @@ def initialize(creator, app_id, cash_asset_id, sub_asset_id):
 @click.option("--sub_asset_id", type=click.INT, required=True)
 @click.option("--app_id", type=click.INT, required=True, default=DEFAULT_APP_ID)
 def attach(creator, sub_asset_id, app_id):
+    _attach_asset(creator, sub_asset_id, app_id)
+
+
+def _attach_asset(creator, sub_asset_id, app_id):
     app_address = _encode_app_address(app_id)
     kcl, acl, wallet_handle, pw = get_wallet()
     suggested_params = acl.suggested_params()
@@ -438,29 +394,90 @@ def attach(creator, sub_asset_id, app_id):
     transaction.wait_for_confirmation(acl, signed_txn.get_txid(), 5)
 
 
-def _atomic_swap(op, sender, amount, input_asset_id, output_asset_id, app_id):
-    app_address = _encode_app_address(app_id)
-    kcl, acl, wallet_handle, pw = get_wallet()
-    suggested_params = acl.suggested_params()
-    fee_txn = transaction.PaymentTxn(sender, suggested_params, app_address, 1000)
+def _swap_txns(op, sender, amount, input_asset_id, output_asset_id, sp, app_id):
+    # The app pays out whatever the transfer right before the call sent it.
     fund_txn = transaction.AssetTransferTxn(
-        sender, suggested_params, app_address, amount, input_asset_id
+        sender, sp, _encode_app_address(app_id), amount, input_asset_id
     )
     recv_txn = transaction.ApplicationCallTxn(
         sender,
-        suggested_params,
+        sp,
         app_id,
         transaction.OnComplete.NoOpOC.real,
         app_args=[op, encoding.decode_address(sender)],
         foreign_assets=[input_asset_id, output_asset_id],
     )
-    group = [fee_txn, fund_txn, recv_txn]
+    return [fund_txn, recv_txn]
+
+
+def _swap_group(
+    op, sender, amount, input_asset_id, output_asset_id, sp, estimate, app_id
+):
+    fee_txn = transaction.PaymentTxn(sender, sp, _encode_app_address(app_id), 0)
+    group = [fee_txn] + _swap_txns(
+        op, sender, amount, input_asset_id, output_asset_id, sp, app_id
+    )
+    fees.pool_fees(group, estimate, inner=1)
     transaction.assign_group_id(group)
+    return group
+
+
+def _atomic_swap(op, sender, amount, input_asset_id, output_asset_id, app_id):
+    kcl, acl, wallet_handle, pw = get_wallet()
+    group = _swap_group(
+        op,
+        sender,
+        amount,
+        input_asset_id,
+        output_asset_id,
+        acl.suggested_params(),
+        fees.current(acl),
+        app_id,
+    )
     signed_group = [kcl.sign_transaction(wallet_handle, pw, txn) for txn in group]
     group_txid = acl.send_transactions(signed_group)
     transaction.wait_for_confirmation(acl, group_txid, 5)
 
 
+# One pooled fee payment plus a transfer and call per swap.
+SWAPS_PER_GROUP = (transaction.constants.tx_group_limit - 1) // 2
+SWAP_DIRECTIONS = {"in": b"CashIn", "out": b"CashOut"}
+
+
+def _swap_groups(fee_payer, rows, acl, app_id, cash_asset_id, sub_asset_id):
+    # rows are (account, direction, amount). Yields (rows, group) with one
+    # payment from fee_payer covering the whole group's fees, inner transfers
+    # included. Params are fetched per group, since the submit window only
+    # pulls the next one once there's room and a long batch can outlast them.
+    app_address = _encode_app_address(app_id)
+    for i in range(0, len(rows), SWAPS_PER_GROUP):
+        chunk = rows[i : i + SWAPS_PER_GROUP]
+        sp = acl.suggested_params()
+        group = [transaction.PaymentTxn(fee_payer, sp, app_address, 0)]
+        for account, direction, amount in chunk:
+            op = SWAP_DIRECTIONS[direction]
+            if op == b"CashIn":
+                assets = (cash_asset_id, sub_asset_id)
+            else:
+                assets = (sub_asset_id, cash_asset_id)
+            group.extend(_swap_txns(op, account, amount, *assets, sp, app_id))
+        fees.pool_fees(group, fees.current(acl), inner=len(chunk))
+        transaction.assign_group_id(group)
+        yield chunk, group
+
+
+def _swap_row_error(row):
+    if row.get("direction") not in SWAP_DIRECTIONS:
+        return f"unknown direction {row.get('direction')!r}"
+    account = row.get("account")
+    if not isinstance(account, str) or not encoding.is_valid_address(account):
+        return f"bad account {account!r}"
+    amount = row.get("amount")
+    if not isinstance(amount, int) or isinstance(amount, bool) or amount < 0:
+        return f"bad amount {amount!r}"
+    return None
+
+
 @command_group.command()
 @click.option("--sender", required=True)
 @click.option("--amount", type=click.INT, required=True)
@@ -481,30 +498,472 @@ def cash_out(sender, amount, cash_asset_id, sub_asset_id, app_id):
     _atomic_swap(b"CashOut", sender, amount, sub_asset_id, cash_asset_id, app_id)
 
 
-def _get_sub_account_secret(kcl, wallet_handle, pw, sender, app_id):
-    private_key = kcl.export_key(wallet_handle, pw, sender)
-    secret = base64.b64decode(
-        util.sign_bytes(b"Subscription" + app_id.to_bytes(8, "big"), private_key)
+@command_group.command()
+@click.option("--in_file", type=click.Path(exists=True), required=True)
+@click.option("--out_file", type=click.Path(), required=True)
+@click.option("--fee_payer", required=True)
+@click.option("--cash_asset_id", type=click.INT, required=True, default=DEFAULT_CASH_ID)
+@click.option("--sub_asset_id", type=click.INT, required=True, default=DEFAULT_SUB_ID)
+@click.option("--app_id", type=click.INT, required=True, default=DEFAULT_APP_ID)
+@click.option(
+    "--window",
+    type=click.INT,
+    default=pipeline.DEFAULT_WINDOW,
+    help="Groups to keep in flight at once.",
+)
+def cash_batch(
+    in_file, out_file, fee_payer, cash_asset_id, sub_asset_id, app_id, window
+):
+    # in_file is JSON lines of {"account": ..., "direction": "in"|"out",
+    # "amount": ...}; out_file gets one JSON line per input row saying which
+    # group it went out in and whether that confirmed.
+    kcl, acl, wallet_handle, pw = get_wallet()
+    results = []
+    rows = []
+    with open(in_file, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            result = {"row": len(results), **row, "txid": None, "round": None}
+            results.append(result)
+            result["error"] = _swap_row_error(row)
+            if result["error"] is None:
+                rows.append((row["account"], row["direction"], row["amount"], result))
+    row_results = [row[3] for row in rows]
+    group_count = -(-len(rows) // SWAPS_PER_GROUP)
+
+    def signed_groups():
+        for _, group in _swap_groups(
+            fee_payer,
+            [row[:3] for row in rows],
+            acl,
+            app_id,
+            cash_asset_id,
+            sub_asset_id,
+        ):
+            yield [kcl.sign_transaction(wallet_handle, pw, tx) for tx in group]
+
+    confirmed = 0
+    for index, txid, confirmed_round, err in pipeline.submit_groups(
+        acl, signed_groups(), window
+    ):
+        start = index * SWAPS_PER_GROUP
+        for result in row_results[start : start + SWAPS_PER_GROUP]:
+            result.update(txid=txid, round=confirmed_round, error=err)
+        if err is None:
+            confirmed += 1
+        else:
+            click.echo(f"Group {txid} failed: {err}", err=True)
+    with open(out_file, "w") as f:
+        for result in results:
+            f.write(json.dumps(result) + "\n")
+    print(f"Confirmed {confirmed} of {group_count} groups ({len(rows)} swaps)")
+    if any(result["error"] for result in results):
+        sys.exit(1)
+
+
+def _get_sub_account_secret(kcl, wallet_handle, pw, sender, app_id, wallet_id=None):
+    def derive():
+        private_key = kcl.export_key(wallet_handle, pw, sender)
+        return base64.b64decode(
+            util.sign_bytes(b"Subscription" + app_id.to_bytes(8, "big"), private_key)
+        )
+
+    if wallet_id is None:
+        wallet_id = client.wallet_id
+    return secret_cache.get(pw, wallet_id, sender, app_id, derive)
+
+
+class SubscriptionRecord:
+    """
+    Decoded form of the 88-byte subscription blob kept in a sub account's local
+    state. Addresses are kept as raw 32-byte keys and only checksummed and
+    encoded when asked for.
+    """
+
+    __slots__ = (
+        "sender_key",
+        "receiver_key",
+        "amount",
+        "interval",
+        "next",
+        "_sender",
+        "_receiver",
     )
-    return secret
 
+    def __init__(self, sender_key, receiver_key, amount, interval, next):
+        self.sender_key = sender_key
+        self.receiver_key = receiver_key
+        self.amount = amount
+        self.interval = interval
+        self.next = next
+        self._sender = None
+        self._receiver = None
+
+    @classmethod
+    def decode(cls, data):
+        return cls(
+            data[0:32],
+            data[32:64],
+            int.from_bytes(data[64:72], "big"),
+            int.from_bytes(data[72:80], "big"),
+            int.from_bytes(data[80:88], "big"),
+        )
+
+    @property
+    def sender(self):
+        if self._sender is None:
+            self._sender = encoding.encode_address(self.sender_key)
+        return self._sender
+
+    @property
+    def receiver(self):
+        if self._receiver is None:
+            self._receiver = encoding.encode_address(self.receiver_key)
+        return self._receiver
+
+    def to_dict(self):
+        return {
+            "sender": self.sender,
+            "receiver": self.receiver,
+            "amount": self.amount,
+            "interval": self.interval,
+            "next": self.next,
+        }
+
+    def __repr__(self):
+        return f"SubscriptionRecord({self.to_dict()})"
+
+
+def _local_key(key):
+    # Local state key of a packed subscription.
+    return bytes([key])
+
+
+def _opted_in(info, app_id):
+    return any(app_state["id"] == app_id for app_state in info["apps-local-state"])
 
-def _get_sub_account_data(info, app_id):
+
+def _get_sub_account_blobs(info, app_id):
+    # Key -> blob for every subscription in a sub account: None for the one
+    # stored under "" by single subscription accounts, else the packed key.
+    blobs = {}
     for app_state in info["apps-local-state"]:
         if app_state["id"] == app_id:
-            for kv in app_state["key-value"]:
-                if kv["key"] == "":
-                    data = base64.b64decode(kv["value"]["bytes"])
-                    return {
-                        "sender": encoding.encode_address(data[0:32]),
-                        "receiver": encoding.encode_address(data[32:64]),
-                        "amount": int.from_bytes(data[64:72], "big"),
-                        "interval": int.from_bytes(data[72:80], "big"),
-                        "next": int.from_bytes(data[80:88], "big"),
-                    }
+            for kv in app_state.get("key-value", []):
+                key = base64.b64decode(kv["key"])
+                blobs[key[0] if key else None] = base64.b64decode(kv["value"]["bytes"])
+    return blobs
+
+
+def _get_sub_account_blob(info, app_id, key=None):
+    return _get_sub_account_blobs(info, app_id).get(key)
+
+
+def _get_sub_account_data(info, app_id, key=None):
+    data = _get_sub_account_blob(info, app_id, key)
+    if data is None:
+        return None
+    return SubscriptionRecord.decode(data)
+
+
+def _get_sub_account_subs(info, app_id):
+    return {
+        key: SubscriptionRecord.decode(data)
+        for key, data in _get_sub_account_blobs(info, app_id).items()
+    }
+
+
+def _recorded_template_version(params):
+    for state in params.get("global-state", []):
+        if base64.b64decode(state["key"]) == TEMPLATE_VERSION_KEY.encode("utf-8"):
+            return state["value"]["uint"]
     return None
 
 
+def _app_template_version(acl, app_id, template_version=None, latest=False):
+    # Apps record the sub account template version they take in global state
+    # when created, and `update` keeps it current. Apps deployed before that
+    # have no global state, and only ever took version 1 unless updated since
+    # (in which case pass the version explicitly, which also skips the
+    # lookup). Apps for packed sub accounts have a local byte slice per key,
+    # and the schema can't change after creation, so without a recorded
+    # version that settles it. With latest, the default is the newest version
+    # the app could be updated to instead.
+    if template_version is not None:
+        return template_version
+    params = acl.application_info(app_id)["params"]
+    schema = params.get("local-state-schema", {})
+    packed = schema.get("num-byte-slice", 0) >= SLOTS_PER_ACCOUNT
+    if latest:
+        return latest_template_version() if packed else PACKED_TEMPLATE_VERSION - 1
+    recorded = _recorded_template_version(params)
+    if recorded is not None:
+        return recorded
+    return PACKED_TEMPLATE_VERSION if packed else 1
+
+
+# Sub accounts are NamedAccounts named secret || index, so finding a free one
+# or listing them means probing indices with account_info. Slots get handed
+# out lowest first, but closing a subscription empties its account and leaves
+# a hole behind. Per (app, sender) we cache the frontier (one past the highest
+# slot ever seen in use) and an occupancy bitmap of the slots below it, so the
+# usual case is one probe at the frontier plus confirming any cached holes.
+# Finding a free slot can take any empty one it comes across, but listing needs
+# the real frontier, which a cold cache can't tell from a hole, so the first
+# list walks every slot (remembered as "walked").
+SLOTS_STATE = "subscription_slots.json"
+# The walk keeps probing at least this many slots past the last one in use.
+SLOT_LOOKAHEAD = 8
+
+
+class SubscriptionSlots:
+    # The state file is shared by every (app, sender), and read-modify-written.
+    _save_lock = threading.Lock()
+
+    def __init__(self, acl, secret, sender, app_id):
+        self.acl = acl
+        self.secret = secret
+        self.app_id = app_id
+        self.key = f"{app_id}:{sender}"
+        entry = read_state(SLOTS_STATE).get(self.key)
+        self.walked = entry is not None and entry.get("walked", False)
+        if entry is None:
+            self.frontier = 0
+            self.occupied = 0
+        else:
+            self.frontier = entry["frontier"]
+            self.occupied = int(entry["occupied"], 16)
+        self.info = {}
+
+    def account(self, index):
+        return NamedAccount(self.app_id, self.secret + index.to_bytes(8, "big"))
+
+    def used(self, index):
+        if index not in self.info:
+            address = self.account(index).get_address()
+            self.info[index] = self.acl.account_info(address)
+        used = self.info[index]["amount"] != 0
+        if used:
+            self.occupied |= 1 << index
+            self.frontier = max(self.frontier, index + 1)
+        else:
+            self.occupied &= ~(1 << index)
+        return used
+
+    def refresh(self, index):
+        self.info.pop(index, None)
+        return self.used(index)
+
+    def holes(self):
+        return [i for i in range(self.frontier) if not self.occupied >> i & 1]
+
+    def free_keys(self, index):
+        # Keys left in a packed sub account that's in use.
+        if not _opted_in(self.info[index], self.app_id):
+            return []
+        taken = _get_sub_account_blobs(self.info[index], self.app_id)
+        return [key for key in range(SLOTS_PER_ACCOUNT) if key not in taken]
+
+    def _search(self, start):
+        # Gallop out from start until we hit an empty slot, then binary search
+        # back for the first empty one. Assumes everything in between is
+        # packed, which holds past a known frontier since slots are handed out
+        # lowest first.
+        lo, step = start, 1
+        while self.used(lo + step - 1):
+            lo += step
+            step *= 2
+        hi = lo + step - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.used(mid):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find_frontier(self):
+        if self.walked:
+            # Anything allocated since we last looked went in at the frontier.
+            return self._search(self.frontier)
+        # Cold: probe every slot in order so the bitmap below the frontier is
+        # all real. Holes can be any length, so keep going until the run of
+        # empty slots is as long as what we've found in use so far (and at
+        # least SLOT_LOOKAHEAD). Anything past a longer hole needs list
+        # --max_index to turn up.
+        index = 0
+        while index - self.frontier < max(SLOT_LOOKAHEAD, self.frontier):
+            self.used(index)
+            index += 1
+        self.walked = True
+        return self.frontier
+
+    def trim(self):
+        # Only valid once every slot below the frontier has been probed.
+        while self.frontier and not self.occupied >> (self.frontier - 1) & 1:
+            self.frontier -= 1
+
+    def find_free(self):
+        for index in self.holes():
+            if not self.used(index):
+                return index
+        # Any empty slot will do, so this needn't be the real frontier (which
+        # a cold cache can't tell) and the walk can wait for list.
+        index = self._search(self.frontier)
+        if not self.walked:
+            # Take what the search skipped over as in use rather than hand
+            # out holes one probe at a time; the walk checks them all anyway.
+            for skipped in range(self.frontier):
+                if skipped not in self.info:
+                    self.occupied |= 1 << skipped
+        return index
+
+    def find_free_key(self):
+        # Packed layout: the first sub account in use with a key to spare, or
+        # else a fresh account. Returns (index, key, whether it's fresh).
+        if not self.walked:
+            # As for find_free, don't walk everything just to find room.
+            index = 0
+            while self.used(index):
+                keys = self.free_keys(index)
+                if keys:
+                    return index, keys[0], False
+                index += 1
+            return index, 0, True
+        for index in range(self.find_frontier()):
+            if self.used(index):
+                keys = self.free_keys(index)
+                if keys:
+                    return index, keys[0], False
+        return self.find_free(), 0, True
+
+    def save(self):
+        with self._save_lock:
+            state = read_state(SLOTS_STATE)
+            state[self.key] = {
+                "frontier": self.frontier,
+                "occupied": format(self.occupied, "x"),
+                "walked": self.walked,
+            }
+            write_state(SLOTS_STATE, state)
+
+
+def _dispense_due_args(sub_address, key=None, max_intervals=0):
+    # DispenseDue pays every overdue interval in one go, so a lapsed
+    # subscription doesn't need one Dispense call per interval.
+    args = [b"DispenseDue", encoding.decode_address(sub_address)]
+    if key is not None:
+        args.append(_local_key(key))
+    if max_intervals:
+        args.append(max_intervals.to_bytes(8, "big"))
+    return args
+
+
+# Per app call limit on Txn.accounts.
+MAX_CALL_ACCOUNTS = 4
+# Subscriptions a packed DispenseMany call can pay before running out of
+# opcode budget, with or without the optimizer. tests/test_teal_profile.py
+# checks it against teal-profile's bound for the loop.
+MAX_CALL_DISPENSES = 3
+
+
+def _pack_dispense_many(subs):
+    """
+    Packs (sub_address, record) pairs into account lists for DispenseMany
+    calls. Each sub needs its sender in the array as well, so a call settles
+    two subs with different senders or up to three sharing one.
+    """
+    calls = []
+    accounts = []
+    for sub_address, record in subs:
+        needed = [a for a in (sub_address, record.sender) if a not in accounts]
+        if len(accounts) + len(needed) > MAX_CALL_ACCOUNTS:
+            calls.append(accounts)
+            accounts = [sub_address, record.sender]
+        else:
+            accounts.extend(needed)
+    if accounts:
+        calls.append(accounts)
+    return calls
+
+
+def _pack_dispense_keys(subs):
+    """
+    Packs (sub_address, key, record) triples into (accounts, targets) for
+    packed DispenseMany calls, targets holding an (index into Txn.accounts,
+    key) byte pair per subscription. Keys of one sub account share its slot in
+    the account list, but a call only gets through MAX_CALL_DISPENSES.
+    """
+    calls = []
+    accounts = []
+    targets = bytearray()
+    for sub_address, key, record in subs:
+        needed = [a for a in (sub_address, record.sender) if a not in accounts]
+        if (
+            len(targets) == 2 * MAX_CALL_DISPENSES
+            or len(accounts) + len(needed) > MAX_CALL_ACCOUNTS
+        ):
+            calls.append((accounts, bytes(targets)))
+            accounts = []
+            targets = bytearray()
+            needed = [sub_address, record.sender]
+        accounts.extend(needed)
+        # Txn.accounts[0] is the caller.
+        targets += bytes([accounts.index(sub_address) + 1, key])
+    if targets:
+        calls.append((accounts, bytes(targets)))
+    return calls
+
+
+def _dispense_many_groups(
+    receiver, subs, suggested_params, estimate, app_id, sub_asset_id, max_intervals=0
+):
+    # One top-up payment covering every inner transfer and the group's fees,
+    # then up to 15 DispenseMany calls. subs are (sub_address, key, record)
+    # triples, all from one layout.
+    cap = [max_intervals.to_bytes(8, "big")] if max_intervals else []
+    if subs[0][1] is None:
+        sub_addresses = {sub_address for sub_address, _, _ in subs}
+        calls = [
+            (
+                [b"DispenseMany"] + cap,
+                accounts,
+                sum(1 for a in accounts if a in sub_addresses),
+            )
+            for accounts in _pack_dispense_many(
+                [(sub_address, record) for sub_address, _, record in subs]
+            )
+        ]
+    else:
+        calls = [
+            ([b"DispenseMany", targets] + cap, accounts, len(targets) // 2)
+            for accounts, targets in _pack_dispense_keys(subs)
+        ]
+    app_address = _encode_app_address(app_id)
+    groups = []
+    for i in range(0, len(calls), 15):
+        chunk = calls[i : i + 15]
+        group = [transaction.PaymentTxn(receiver, suggested_params, app_address, 0)]
+        for args, accounts, _ in chunk:
+            group.append(
+                transaction.ApplicationCallTxn(
+                    receiver,
+                    suggested_params,
+                    app_id,
+                    transaction.OnComplete.NoOpOC.real,
+                    app_args=args,
+                    accounts=accounts,
+                    foreign_assets=[sub_asset_id],
+                )
+            )
+        fees.pool_fees(group, estimate, inner=sum(n for _, _, n in chunk))
+        transaction.assign_group_id(group)
+        groups.append(group)
+    return groups
+
+
 def _find_free_sub_account(
     kcl: KMDClient,
     acl: AlgodClient,
@@ -512,16 +971,22 @@ def _find_free_sub_account(
     pw: str,
     sender: str,
     app_id: int,
-    max_index: int = 64,
+    wallet_id: str = None,
 ):
-    secret = _get_sub_account_secret(kcl, wallet_handle, pw, sender, app_id)
-    for i in range(max_index):
-        account = NamedAccount(app_id, secret + i.to_bytes(8, "big"))
-        address = account.get_address()
-        info = acl.account_info(address)
-        if info["amount"] == 0:
-            return account, i
-    raise Exception("Couldn't find a free subscription slot to use.")
+    secret = _get_sub_account_secret(kcl, wallet_handle, pw, sender, app_id, wallet_id)
+    slots = SubscriptionSlots(acl, secret, sender, app_id)
+    index = slots.find_free()
+    slots.save()
+    return slots.account(index), index
+
+
+def _find_free_sub_key(kcl, acl, wallet_handle, pw, sender, app_id, wallet_id=None):
+    # Packed counterpart of _find_free_sub_account: (account, key, fresh).
+    secret = _get_sub_account_secret(kcl, wallet_handle, pw, sender, app_id, wallet_id)
+    slots = SubscriptionSlots(acl, secret, sender, app_id)
+    index, key, fresh = slots.find_free_key()
+    slots.save()
+    return slots.account(index), key, fresh
 
 
 @command_group.command()
@@ -534,6 +999,11 @@ def _find_free_sub_account(
 @click.option("--out_file", type=click.Path(), required=True)
 @click.option("--sign_sender/--no_sign_sender", default=False)
 @click.option("--sign_receiver/--no_sign_receiver", default=False)
+@click.option(
+    "--template_version",
+    type=click.INT,
+    help="Sub account LogicSig version the app accepts (default latest).",
+)
 def request(
     sender,
     receiver,
@@ -544,8 +1014,48 @@ def request(
     out_file,
     sign_sender,
     sign_receiver,
+    template_version,
 ):
     kcl, acl, wallet_handle, pw = get_wallet()
+    output = _request_parts(
+        kcl,
+        acl,
+        wallet_handle,
+        pw,
+        sender,
+        receiver,
+        amount,
+        interval,
+        sub_asset_id,
+        app_id,
+        sign_sender,
+        sign_receiver,
+        fees.current(acl),
+        template_version,
+    )
+    with open(out_file, "w") as f:
+        json.dump(output, f)
+
+
+def _request_parts(
+    kcl,
+    acl,
+    wallet_handle,
+    pw,
+    sender,
+    receiver,
+    amount,
+    interval,
+    sub_asset_id,
+    app_id,
+    sign_sender,
+    sign_receiver,
+    estimate,
+    template_version=None,
+    wallet_id=None,
+):
+    # Builds the Subscribe group and signs whichever side's parts we hold the
+    # keys for. The result is what `request` writes to its out_file.
     suggested_params = acl.suggested_params()
     # TODO(eiz): This is kind of brutal. The sender and receiver need to agree
     # on a valid round range, but since we're just regenerating the transactions
@@ -558,9 +1068,30 @@ def request(
     # to use, but I'm keeping it this way for CLI purposes for now.
     suggested_params.first = suggested_params.first // 200 * 200
     suggested_params.last = suggested_params.first + 1000
-    sub_account, _ = _find_free_sub_account(kcl, acl, wallet_handle, pw, sender, app_id)
+    template_version = _app_template_version(acl, app_id, template_version)
+    if template_version >= PACKED_TEMPLATE_VERSION:
+        return _request_packed_parts(
+            kcl,
+            acl,
+            wallet_handle,
+            pw,
+            suggested_params,
+            sender,
+            receiver,
+            amount,
+            interval,
+            sub_asset_id,
+            app_id,
+            sign_sender,
+            estimate,
+            template_version,
+            wallet_id,
+        )
+    sub_account, _ = _find_free_sub_account(
+        kcl, acl, wallet_handle, pw, sender, app_id, wallet_id
+    )
     sub_address = sub_account.get_address()
-    sig_account = SubscriptionAccount(app_id, sender, receiver)
+    sig_account = SubscriptionAccount(app_id, sender, receiver, template_version)
     fund_txn = transaction.PaymentTxn(receiver, suggested_params, sub_address, 251000)
     optin_txn = transaction.ApplicationOptInTxn(
         sub_address, suggested_params, app_id, rekey_to=sig_account.get_address()
@@ -605,56 +1136,406 @@ def request(
         output["fund"] = encoding.msgpack_encode(
             kcl.sign_transaction(wallet_handle, pw, fund_txn)
         )
-    with open(out_file, "w") as f:
-        json.dump(output, f)
+    return output
+
+
+def _request_packed_parts(
+    kcl,
+    acl,
+    wallet_handle,
+    pw,
+    suggested_params,
+    sender,
+    receiver,
+    amount,
+    interval,
+    sub_asset_id,
+    app_id,
+    sign_sender,
+    estimate,
+    template_version,
+    wallet_id,
+):
+    # Packed sub accounts belong to the sender, who funds a new one and
+    # otherwise vouches for the Subscribe with a no-op payment signed through
+    # the account's LogicSig. Nothing is left for the receiver to sign.
+    sub_account, key, fresh = _find_free_sub_key(
+        kcl, acl, wallet_handle, pw, sender, app_id, wallet_id
+    )
+    sub_address = sub_account.get_address()
+    sig_account = SubscriptionAccount(app_id, sender, version=template_version)
+    if fresh:
+        prefix = [
+            transaction.PaymentTxn(
+                sender, suggested_params, sub_address, PACKED_ACCOUNT_BALANCE
+            ),
+            transaction.ApplicationOptInTxn(
+                sub_address,
+                suggested_params,
+                app_id,
+                rekey_to=sig_account.get_address(),
+            ),
+        ]
+    else:
+        prefix = [transaction.PaymentTxn(sub_address, suggested_params, sub_address, 0)]
+    sub_txn = transaction.ApplicationCallTxn(
+        sender,
+        suggested_params,
+        app_id,
+        transaction.OnComplete.NoOpOC,
+        app_args=[
+            b"Subscribe",
+            encoding.decode_address(sub_address),
+            encoding.decode_address(receiver),
+            amount.to_bytes(8, "big"),
+            interval.to_bytes(8, "big"),
+            _local_key(key),
+        ],
+        accounts=[sub_address],
+    )
+    initial_payment_txn = transaction.AssetTransferTxn(
+        sender,
+        suggested_params,
+        receiver,
+        amount,
+        sub_asset_id,
+    )
+    group = prefix + [sub_txn, initial_payment_txn]
+    # The sub account pays nothing, so fees go on the funding payment or the
+    # Subscribe call.
+    fees.pool_fees(group, estimate, payer=0 if fresh else 1)
+    transaction.assign_group_id(group)
+    output = {}
+    if not sign_sender:
+        return output
+    if fresh:
+        output["fund"] = encoding.msgpack_encode(
+            kcl.sign_transaction(wallet_handle, pw, group[0])
+        )
+        output["optin"] = encoding.msgpack_encode(
+            transaction.LogicSigTransaction(
+                group[1], transaction.LogicSigAccount(sub_account.get_program())
+            )
+        )
+    else:
+        private_key = kcl.export_key(wallet_handle, pw, sender)
+        output["touch"] = encoding.msgpack_encode(
+            transaction.LogicSigTransaction(
+                group[0],
+                transaction.LogicSigAccount(
+                    sig_account.get_program(),
+                    sig_account.signature_args(
+                        private_key, group[0].get_txid(), sender
+                    ),
+                ),
+            )
+        )
+    output["sub"] = encoding.msgpack_encode(
+        kcl.sign_transaction(wallet_handle, pw, sub_txn)
+    )
+    output["initial_payment"] = encoding.msgpack_encode(
+        kcl.sign_transaction(wallet_handle, pw, initial_payment_txn)
+    )
+    return output
 
 
 @command_group.command()
-@click.option("--receiver_file", type=click.Path(), required=True)
+@click.option(
+    "--receiver_file",
+    type=click.Path(),
+    help="Receiver's half of the request (not needed with packed sub accounts).",
+)
 @click.option("--sender_file", type=click.Path(), required=True)
 def submit(sender_file, receiver_file):
-    _, acl, _, _ = get_wallet()
+    acl = get_algod()
     with open(sender_file, "r") as f:
         sender_json = json.load(f)
-    with open(receiver_file, "r") as f:
-        receiver_json = json.load(f)
-    group = [
-        encoding.future_msgpack_decode(receiver_json["fund"]),
-        encoding.future_msgpack_decode(sender_json["optin"]),
-        encoding.future_msgpack_decode(sender_json["sub"]),
-        encoding.future_msgpack_decode(sender_json["initial_payment"]),
-    ]
-    group_txid = acl.send_transactions(group)
+    receiver_json = {}
+    if receiver_file is not None:
+        with open(receiver_file, "r") as f:
+            receiver_json = json.load(f)
+    group_txid = acl.send_transactions(_submit_group(sender_json, receiver_json))
     transaction.wait_for_confirmation(acl, group_txid, 5)
 
 
+# Group order of the parts `request` writes, for either layout.
+SUBMIT_PARTS = ("fund", "optin", "touch", "sub", "initial_payment")
+
+
+def _submit_group(sender_parts, receiver_parts):
+    parts = {**receiver_parts, **sender_parts}
+    return [
+        encoding.future_msgpack_decode(parts[name])
+        for name in SUBMIT_PARTS
+        if name in parts
+    ]
+
+
 @command_group.command("list")
 @click.option("--sender", required=True)
 @click.option("--app_id", type=click.INT, required=True, default=DEFAULT_APP_ID)
-@click.option("--max_index", type=click.INT, required=True, default=64)
-def list_cmd(sender, app_id, max_index):
+@click.option(
+    "--max_index",
+    type=click.INT,
+    help="Probe this many slots instead of searching for the frontier.",
+)
+@click.option(
+    "--watch",
+    is_flag=True,
+    help="Keep following new blocks, printing changes as JSON lines.",
+)
+def list_cmd(sender, app_id, max_index, watch):
     kcl, acl, wallet_handle, pw = get_wallet()
     secret = _get_sub_account_secret(kcl, wallet_handle, pw, sender, app_id)
-    for i in range(max_index):
-        account = NamedAccount(app_id, secret + i.to_bytes(8, "big"))
-        info = acl.account_info(account.get_address())
-        sub_data = _get_sub_account_data(info, app_id)
-        if sub_data is not None:
-            print("Account:", account.get_address(), sub_data)
+    slots = SubscriptionSlots(acl, secret, sender, app_id)
+    last_round = acl.status()["last-round"] if watch else None
+    subs = _read_subs(slots, max_index)
+    for (i, key), sub_data in subs.items():
+        if watch:
+            _emit_sub_event("existing", last_round, slots, i, key, sub_data)
+        else:
+            print(
+                "Account:",
+                slots.account(i).get_address(),
+                *(() if key is None else ("key:", key)),
+                sub_data.to_dict(),
+            )
+    if watch:
+        _watch_subs(acl, slots, subs, last_round, max_index)
+
+
+@command_group.command()
+@click.option("--sender", required=True)
+@click.option("--app_id", type=click.INT, required=True, default=DEFAULT_APP_ID)
+@click.option(
+    "--max_index",
+    type=click.INT,
+    help="Write this many slots instead of as far as a cold walk would look.",
+)
+@click.option("--out_file", type=click.Path(), required=True)
+def slot_addresses(sender, app_id, max_index, out_file):
+    # Sub account addresses come from the kmd secret, so a node host can't
+    # tell which to put in an offline snapshot. Run this on the signing host
+    # and pass the file to `offline export --address_file`. By default it
+    # covers the slots the search probes from what's cached here, or what a
+    # cold walk would (if slots past that turn out in use, the offline run
+    # stops on the first one missing and a bigger --max_index is needed).
+    kcl, _, wallet_handle, pw = get_wallet()
+    secret = _get_sub_account_secret(kcl, wallet_handle, pw, sender, app_id)
+    slots = SubscriptionSlots(None, secret, sender, app_id)
+    if max_index is None:
+        max_index = slots.frontier + max(SLOT_LOOKAHEAD, slots.frontier)
+    with open(out_file, "w") as f:
+        for i in range(max_index):
+            f.write(slots.account(i).get_address() + "\n")
+    print(f"Wrote {max_index} sub account addresses for {sender}")
+
+
+def _read_subs(slots, max_index=None):
+    # (index, key) -> SubscriptionRecord for every subscription held by a sub
+    # account below max_index, or below the frontier if that's not given. The
+    # key is None for single subscription accounts.
+    end = slots.find_frontier() if max_index is None else max_index
+    subs = {}
+    for i in range(end):
+        if not slots.used(i):
+            continue
+        for key, sub_data in _get_sub_account_subs(slots.info[i], slots.app_id).items():
+            subs[i, key] = sub_data
+    if end >= slots.frontier:
+        slots.trim()
+    slots.save()
+    return subs
+
+
+def _emit_sub_event(event, round, slots, index, key, sub_data):
+    print(
+        json.dumps(
+            {
+                "event": event,
+                "round": round,
+                "index": index,
+                "key": key,
+                "address": slots.account(index).get_address(),
+                "subscription": sub_data.to_dict(),
+            }
+        ),
+        flush=True,
+    )
+
+
+def _block_addresses(block):
+    # Raw keys of every account a block's transactions touch, inner
+    # transactions included. Sub accounts show up as the sender of a close, or
+    # in the foreign accounts of Subscribe/Dispense calls.
+    keys = set()
+
+    def visit(stxn):
+        txn = stxn["txn"]
+        for field in ("snd", "rcv", "close", "asnd", "arcv", "aclose"):
+            if field in txn:
+                keys.add(txn[field])
+        keys.update(txn.get("apat", []))
+        for inner in stxn.get("dt", {}).get("itx", []):
+            visit(inner)
+
+    for stxn in block["block"].get("txns", []):
+        visit(stxn)
+    return keys
+
+
+def _watch_subs(acl, slots, subs, last_round, max_index):
+    # Follow the chain one block at a time and only re-read the sub accounts
+    # that a block touched. New subscriptions land at a hole or just past the
+    # frontier, so that far is watched too.
+    watched = {}
+
+    def watch_up_to(end):
+        for i in range(len(watched), end):
+            address = slots.account(i).get_address()
+            watched[encoding.decode_address(address)] = i
+
+    def watch_end():
+        if max_index is not None:
+            return max_index
+        return slots.frontier + SLOT_LOOKAHEAD
+
+    watch_up_to(watch_end())
+    while True:
+        acl.status_after_block(last_round)
+        last_round += 1
+        block = get_block(acl, last_round)
+        touched = sorted(
+            watched[key] for key in _block_addresses(block) if key in watched
+        )
+        for i in touched:
+            olds = {key: subs.pop((j, key)) for j, key in list(subs) if j == i}
+            news = {}
+            if slots.refresh(i):
+                news = _get_sub_account_subs(slots.info[i], slots.app_id)
+            for key, new in news.items():
+                subs[i, key] = new
+            for key in sorted(olds.keys() | news.keys(), key=lambda k: k or 0):
+                old, new = olds.get(key), news.get(key)
+                if old is None:
+                    _emit_sub_event("new", last_round, slots, i, key, new)
+                elif new is None:
+                    _emit_sub_event("cancelled", last_round, slots, i, key, old)
+                elif new.next != old.next:
+                    _emit_sub_event("dispensed", last_round, slots, i, key, new)
+                elif new.to_dict() != old.to_dict():
+                    _emit_sub_event("updated", last_round, slots, i, key, new)
+        if touched:
+            slots.save()
+            watch_up_to(watch_end())
 
 
 @command_group.command()
 @click.option("--signer", required=True)
 @click.option("--sub_address", required=True)
 @click.option("--app_id", type=click.INT, required=True, default=DEFAULT_APP_ID)
-def close(signer, sub_address, app_id):
+@click.option(
+    "--key",
+    type=click.IntRange(0, SLOTS_PER_ACCOUNT - 1),
+    help="Subscription to cancel in a packed sub account.",
+)
+def close(signer, sub_address, app_id, key):
     kcl, acl, wallet_handle, pw = get_wallet()
-    suggested_params = acl.suggested_params()
-    sub_data = _get_sub_account_data(acl.account_info(sub_address), app_id)
-    sub_account = SubscriptionAccount(app_id, sub_data["sender"], sub_data["receiver"])
-    if sub_data is None:
+    info = acl.account_info(sub_address)
+    subs = _get_sub_account_subs(info, app_id)
+    sub_data = subs.pop(key, None)
+    if key is not None:
+        if sub_data is None:
+            click.echo("Couldn't find a subscription under the given key", err=True)
+            sys.exit(1)
+        if subs or signer != sub_data.sender:
+            # The account stays open for the sender's other subscriptions, so
+            # just drop this one.
+            group = _cancel_group(
+                kcl,
+                wallet_handle,
+                pw,
+                acl.suggested_params(),
+                fees.current(acl),
+                signer,
+                sub_address,
+                key,
+                app_id,
+            )
+            group_txid = acl.send_transactions(group)
+            transaction.wait_for_confirmation(acl, group_txid, 5)
+            return
+        # Otherwise it's the sender's last one, and closing the account out
+        # deletes it along with the rest of local state.
+    elif subs:
+        click.echo(
+            "Sub account holds several subscriptions, pick one with --key", err=True
+        )
+        sys.exit(1)
+    elif sub_data is None and not _opted_in(info, app_id):
         click.echo("Couldn't find a subscription at the given address", err=True)
         sys.exit(1)
+    if key is not None or sub_data is None:
+        # Packed sub accounts go back to the sender that funded them.
+        remainder_to = signer
+        sub_account = SubscriptionAccount.for_address(
+            info.get("auth-addr"), app_id, signer
+        )
+    else:
+        remainder_to = sub_data.receiver
+        sub_account = SubscriptionAccount.for_address(
+            info.get("auth-addr"),
+            app_id,
+            sub_data.sender,
+            sub_data.receiver,
+        )
+    if sub_account is None:
+        click.echo("Sub account isn't controlled by a known template", err=True)
+        sys.exit(1)
+    group = _close_group(
+        kcl,
+        wallet_handle,
+        pw,
+        acl.suggested_params(),
+        fees.current(acl),
+        signer,
+        sub_address,
+        remainder_to,
+        sub_account,
+        app_id,
+    )
+    group_txid = acl.send_transactions(group)
+    transaction.wait_for_confirmation(acl, group_txid, 5)
+
+
+def _cancel_group(
+    kcl, wallet_handle, pw, suggested_params, estimate, signer, sub_address, key, app_id
+):
+    # Packed layout: drop one subscription, leaving the sub account open.
+    txn = transaction.ApplicationCallTxn(
+        signer,
+        suggested_params,
+        app_id,
+        transaction.OnComplete.NoOpOC.real,
+        app_args=[b"Cancel", encoding.decode_address(sub_address), _local_key(key)],
+        accounts=[sub_address],
+    )
+    fees.pool_fees([txn], estimate)
+    return [kcl.sign_transaction(wallet_handle, pw, txn)]
+
+
+def _close_group(
+    kcl,
+    wallet_handle,
+    pw,
+    suggested_params,
+    estimate,
+    signer,
+    sub_address,
+    remainder_to,
+    sub_account,
+    app_id,
+):
     fee_txn = transaction.PaymentTxn(signer, suggested_params, sub_address, 0)
     optout_txn = transaction.ApplicationCloseOutTxn(
         sub_address, suggested_params, app_id
@@ -662,15 +1543,13 @@ def close(signer, sub_address, app_id):
     close_txn = transaction.PaymentTxn(
         sub_address,
         suggested_params,
-        sub_data["receiver"],
+        remainder_to,
         0,
-        close_remainder_to=sub_data["receiver"],
+        close_remainder_to=remainder_to,
     )
-    fee_txn.fee += optout_txn.fee
-    fee_txn.fee += close_txn.fee
-    optout_txn.fee = 0
-    close_txn.fee = 0
+    # The sub account's LogicSig insists on paying no fees itself.
     group = [fee_txn, optout_txn, close_txn]
+    fees.pool_fees(group, estimate)
     transaction.assign_group_id(group)
     program = sub_account.get_program()
     private_key = kcl.export_key(wallet_handle, pw, signer)
@@ -679,53 +1558,252 @@ def close(signer, sub_address, app_id):
             tx,
             transaction.LogicSigAccount(
                 program,
-                [
-                    logic.teal_sign_from_program(
-                        private_key,
-                        b"Sub"
-                        + base64.b32decode(encoding._correct_padding(tx.get_txid())),
-                        program,
-                    )
-                ],
+                sub_account.signature_args(private_key, tx.get_txid(), signer),
             ),
         )
         if tx.sender == sub_address
         else kcl.sign_transaction(wallet_handle, pw, tx)
         for tx in group
     ]
-    group_txid = acl.send_transactions(group)
-    transaction.wait_for_confirmation(acl, group_txid, 5)
+    return group
 
 
 @command_group.command()
-@click.option("--sub_address", required=True)
+@click.option("--sub_address", required=True, multiple=True)
 @click.option("--sub_asset_id", type=click.INT, required=True, default=DEFAULT_SUB_ID)
 @click.option("--app_id", type=click.INT, required=True, default=DEFAULT_APP_ID)
-def dispense(sub_address, sub_asset_id, app_id):
+@click.option(
+    "--max_intervals",
+    type=click.INT,
+    default=0,
+    help="Pay at most this many overdue intervals (0 pays all of them).",
+)
+@click.option(
+    "--key",
+    type=click.IntRange(0, SLOTS_PER_ACCOUNT - 1),
+    help="Subscription in a packed sub account (default every one due to us).",
+)
+def dispense(sub_address, sub_asset_id, app_id, max_intervals, key):
     kcl, acl, wallet_handle, pw = get_wallet()
     suggested_params = acl.suggested_params()
-    sub_data = _get_sub_account_data(acl.account_info(sub_address), app_id)
-    app_address = _encode_app_address(app_id)
+    if key is not None and len(sub_address) > 1:
+        click.echo("--key only works with a single --sub_address", err=True)
+        sys.exit(1)
+    subs = {}
+    if len(sub_address) == 1:
+        subs = _get_sub_account_subs(acl.account_info(sub_address[0]), app_id)
+    # A packed sub account on its own is dispensed like a list of them,
+    # unless --key picks out one subscription.
+    packed = subs and None not in subs
+    if len(sub_address) > 1 or (packed and key is None):
+        _dispense_many(
+            kcl,
+            acl,
+            wallet_handle,
+            pw,
+            suggested_params,
+            sub_address,
+            sub_asset_id,
+            app_id,
+            max_intervals,
+        )
+        return
+    sub_address = sub_address[0]
+    sub_data = subs.get(key)
     if not sub_data:
         click.echo("Could not find sub information at the given address.", err=True)
         sys.exit(1)
+    group = _dispense_group(
+        sub_address,
+        key,
+        sub_data,
+        suggested_params,
+        fees.current(acl),
+        sub_asset_id,
+        app_id,
+        max_intervals,
+    )
+    group = [kcl.sign_transaction(wallet_handle, pw, tx) for tx in group]
+    group_txid = acl.send_transactions(group)
+    transaction.wait_for_confirmation(acl, group_txid, 5)
+
+
+def _dispense_group(
+    sub_address,
+    key,
+    sub_data,
+    suggested_params,
+    estimate,
+    sub_asset_id,
+    app_id,
+    max_intervals,
+):
     fund_txn = transaction.PaymentTxn(
-        sub_data["receiver"], suggested_params, app_address, suggested_params.min_fee
+        sub_data.receiver, suggested_params, _encode_app_address(app_id), 0
     )
     txn = transaction.ApplicationCallTxn(
-        sub_data["receiver"],
+        sub_data.receiver,
         suggested_params,
         app_id,
         transaction.OnComplete.NoOpOC.real,
-        app_args=[b"Dispense", encoding.decode_address(sub_address)],
-        accounts=[sub_address, sub_data["sender"]],
+        app_args=_dispense_due_args(sub_address, key, max_intervals),
+        accounts=[sub_address, sub_data.sender],
         foreign_assets=[sub_asset_id],
     )
     group = [fund_txn, txn]
+    fees.pool_fees(group, estimate, inner=1)
     transaction.assign_group_id(group)
-    group = [kcl.sign_transaction(wallet_handle, pw, tx) for tx in group]
-    group_txid = acl.send_transactions(group)
-    transaction.wait_for_confirmation(acl, group_txid, 5)
+    return group
+
+
+def _dispense_many(
+    kcl,
+    acl,
+    wallet_handle,
+    pw,
+    suggested_params,
+    sub_addresses,
+    sub_asset_id,
+    app_id,
+    max_intervals,
+):
+    # Only bother with subs that are due, so the top-ups aren't wasted on
+    # calls the app will skip anyway. Packed sub accounts can also hold
+    # subscriptions paying other people, which we have no keys for.
+    now = int(time.time())
+    own = set(kcl.list_keys(wallet_handle))
+    by_receiver = {}
+    found = 0
+    for address in dict.fromkeys(sub_addresses):
+        subs = _get_sub_account_subs(acl.account_info(address), app_id)
+        if not subs:
+            click.echo(f"No sub information at {address}, skipping.", err=True)
+            continue
+        for key, sub_data in subs.items():
+            if sub_data.receiver not in own:
+                continue
+            found += 1
+            if sub_data.next > now:
+                continue
+            by_receiver.setdefault(sub_data.receiver, []).append(
+                (address, key, sub_data)
+            )
+    # Send everything first and then wait, so the groups can land in the same
+    # round.
+    txids = []
+    estimate = fees.current(acl)
+    for receiver, subs in by_receiver.items():
+        for group in _dispense_many_groups(
+            receiver,
+            subs,
+            suggested_params,
+            estimate,
+            app_id,
+            sub_asset_id,
+            max_intervals,
+        ):
+            group = [kcl.sign_transaction(wallet_handle, pw, tx) for tx in group]
+            txids.append(acl.send_transactions(group))
+    for txid in txids:
+        transaction.wait_for_confirmation(acl, txid, 5)
+    print(
+        f"Dispensed {sum(len(subs) for subs in by_receiver.values())} of "
+        f"{found} subscriptions in {len(txids)} groups"
+    )
+
+
+@command_group.command()
+@click.option("--address_file", type=click.Path(), required=True)
+@click.option("--app_id", type=click.INT, required=True, default=DEFAULT_APP_ID)
+@click.option("--out_file", type=click.Path(), required=True)
+def export_book(address_file, app_id, out_file):
+    # Snapshot the subscriptions at the given sub account addresses (one per
+    # line, e.g. collected from the receiver side of `request`) for `forecast`.
+    from algovault import book
+    import numpy as np
+
+    acl = get_algod()
+    with open(address_file, "r") as f:
+        addresses = [line.strip() for line in f if line.strip()]
+    blobs = []
+    for address in addresses:
+        blobs.extend(_get_sub_account_blobs(acl.account_info(address), app_id).values())
+    np.save(out_file, book.decode_blobs(blobs))
+    print(f"Exported {len(blobs)} subscriptions from {len(addresses)} sub accounts")
+
+
+@command_group.command()
+@click.option("--receiver", required=True)
+@click.option("--book_file", type=click.Path(exists=True), required=True)
+@click.option("--months", type=click.INT, required=True, default=3)
+@click.option("--balances_file", type=click.Path(exists=True))
+@click.option("--sub_asset_id", type=click.INT, required=True, default=DEFAULT_SUB_ID)
+@click.option("--out_file", type=click.Path())
+def forecast(receiver, book_file, months, balances_file, sub_asset_id, out_file):
+    from algovault import book
+    import numpy as np
+
+    subs = book.load(book_file)
+    subs = subs[subs["receiver"] == book.address_key(receiver)]
+    skipped = int(np.count_nonzero(subs["interval"] == 0))
+    subs = subs[subs["interval"] > 0]
+    senders = [encoding.encode_address(bytes(key)) for key in np.unique(subs["sender"])]
+    if balances_file is not None:
+        # {"ADDRESS": balance, ...}
+        with open(balances_file, "r") as f:
+            known = json.load(f)
+        balances = [known.get(sender, 0) for sender in senders]
+    else:
+        acl = get_algod()
+        balances = []
+        for sender in senders:
+            balance = 0
+            for asset in acl.account_info(sender).get("assets", []):
+                if asset["asset-id"] == sub_asset_id:
+                    balance = asset["amount"]
+            balances.append(balance)
+    start = int(time.time())
+    days = round(months * 365.25 / 12)
+    scheduled, at_risk, runout = book.forecast(subs, balances, start, days)
+
+    def day_str(day):
+        return time.strftime(
+            "%Y-%m-%d", time.gmtime(start + day * book.SECONDS_PER_DAY)
+        )
+
+    counts = np.bincount(
+        np.unique(subs["sender"], return_inverse=True)[1].reshape(-1),
+        minlength=len(senders),
+    )
+    shortfalls = sorted(
+        (
+            {
+                "sender": sender,
+                "runs_out": day_str(int(day)),
+                "balance": int(balance),
+                "subscriptions": int(count),
+            }
+            for sender, day, balance, count in zip(senders, runout, balances, counts)
+            if day < days
+        ),
+        key=lambda shortfall: shortfall["runs_out"],
+    )
+    result = {
+        "receiver": receiver,
+        "start": start,
+        "subscriptions": len(subs),
+        "skipped_zero_interval": skipped,
+        "days": [
+            {"date": day_str(day), "scheduled": total, "at_risk": risk}
+            for day, (total, risk) in enumerate(zip(scheduled, at_risk))
+        ],
+        "shortfalls": shortfalls,
+    }
+    if out_file is None:
+        print(json.dumps(result, indent=2))
+    else:
+        with open(out_file, "w") as f:
+            json.dump(result, f)
 
 
 @command_group.command()
@@ -757,67 +1835,58 @@ def create_fake_token(creator, reserve):
 
 
 @command_group.command()
-def gen_template():
-    _, acl, _, _ = get_wallet()
-    app_id = b"A" * 8
-    sender = b"B" * 32
-    receiver = b"C" * 32
-    scratch_receiver = ScratchVar(TealType.bytes)
-    scratch_sender = ScratchVar(TealType.bytes)
-    sig_blob = Concat(Bytes("Sub"), Txn.tx_id())
-    verify_payment = Seq(
-        Assert(Txn.group_index() == Int(2)),
-        # Must be a close-out transaction
-        Assert(Txn.amount() == Int(0)),
-        # Receiver always pays for the sub account, so receiver always gets the refund.
-        Assert(Txn.close_remainder_to() == scratch_receiver.load()),
-        Approve(),
-    )
-    verify_app_call = Seq(
-        Assert(Txn.group_index() == Int(1)),
-        Assert(Itob(Txn.application_id()) == Bytes(app_id)),
-        Assert(Txn.on_completion() == OnComplete.CloseOut),
-        Approve(),
-    )
-    program = Seq(
-        scratch_receiver.store(Bytes(receiver)),
-        scratch_sender.store(Bytes(sender)),
-        # Cancellation must be authorized by the designated sender or receiver.
-        Assert(
-            Or(
-                Ed25519Verify(sig_blob, Arg(0), scratch_sender.load()),
-                Ed25519Verify(sig_blob, Arg(0), scratch_receiver.load()),
+@click.option("--write", is_flag=True, help="Update subscription_templates.json.")
+@click.option("--check", is_flag=True, help="Fail if the table is out of date.")
+@click.option(
+    "--algod", "use_algod", is_flag=True, help="Assemble with algod, not locally."
+)
+def gen_template(write, check, use_algod):
+    # Regenerates every template version and finds the placeholder offsets.
+    # A version's bytes must never change once sub accounts are rekeyed to it,
+    # so run with --check after touching PyTeal or the optimizer.
+    from algovault import subscription_teal, teal_asm
+
+    table = {}
+    for version in subscription_teal.TEMPLATE_VERSIONS:
+        asm = subscription_teal.sub_logicsig_program(version)
+        if use_algod:
+            raw_bytecode = base64.b64decode(get_algod().compile(asm)["result"])
+        else:
+            raw_bytecode = teal_asm.assemble(asm)
+        offsets = {}
+        for name, placeholder in subscription_teal.template_placeholders(
+            version
+        ).items():
+            offset = raw_bytecode.find(placeholder)
+            if offset < 0 or raw_bytecode.find(placeholder, offset + 1) >= 0:
+                click.echo(
+                    f"Template version {version}: placeholder {name} must appear "
+                    "exactly once",
+                    err=True,
+                )
+                sys.exit(1)
+            offsets[name] = offset
+        table[str(version)] = {
+            "program": base64.b64encode(raw_bytecode).decode(),
+            "offsets": offsets,
+        }
+    if check:
+        with open(TEMPLATES_FILE, "r") as f:
+            current = json.load(f)
+        stale = [
+            version
+            for version in table
+            if version in current and current[version] != table[version]
+        ]
+        if stale:
+            click.echo(
+                f"Template versions {', '.join(stale)} no longer match the table",
+                err=True,
             )
-        ),
-        # Don't allow further rekeys
-        Assert(Txn.rekey_to() == Global.zero_address()),
-        # Ensure that the initiator of the cancellation pays the fee
-        # (via fee pooling)
-        Assert(Txn.fee() == Int(0)),
-        # Group must contain 3 transactions (first transaction pays fees from a
-        # different account)
-        Assert(Global.group_size() == Int(3)),
-        # First transaction must be a payment to this account
-        Assert(Gtxn[0].type_enum() == TxnType.Payment),
-        Assert(Gtxn[0].receiver() == Txn.sender()),
-        # Second and third must be the payment and closeout transactions below
-        Assert(Gtxn[1].sender() == Txn.sender()),
-        Assert(Gtxn[2].sender() == Txn.sender()),
-        Cond(
-            [Txn.type_enum() == TxnType.Payment, verify_payment],
-            [Txn.type_enum() == TxnType.ApplicationCall, verify_app_call],
-        ),
-    )
-    asm = compileTeal(program, Mode.Signature, version=5)
-    bytecode = acl.compile(asm)["result"]
-    raw_bytecode = base64.b64decode(bytecode)
-    print(
-        json.dumps(
-            {
-                "program": bytecode,
-                "app_id": raw_bytecode.find(app_id),
-                "sender": raw_bytecode.find(sender),
-                "receiver": raw_bytecode.find(receiver),
-            }
-        )
-    )
+            sys.exit(1)
+    if write:
+        with open(TEMPLATES_FILE, "w") as f:
+            json.dump(table, f, indent=2)
+            f.write("\n")
+    elif not check:
+        print(json.dumps(table, indent=2))
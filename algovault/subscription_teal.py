@@ -0,0 +1,582 @@
+# Copyright 2021 Mackenzie Straight
+#
+# This file is part of algovault.
+#
+# algovault is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# algovault is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with algovault.  If not, see <https://www.gnu.org/licenses/>.
+
+# PyTeal sources for the subscription app and the sub account LogicSig. Kept
+# out of algovault.subscription so that only the commands which actually
+# generate TEAL pay for importing PyTeal.
+from pyteal import *
+
+from algovault.subscription import (
+    PACKED_TEMPLATE_VERSION,
+    SLOTS_PER_ACCOUNT,
+    TEMPLATE_VERSION_KEY,
+    SubscriptionAccount,
+    latest_template_version,
+)
+
+DEBUG_MODE = True
+
+# Placeholders baked into the LogicSig template. SubscriptionAccount patches the
+# real values in at these offsets.
+TEMPLATE_APP_ID = b"A" * 8
+TEMPLATE_SENDER = b"B" * 32
+TEMPLATE_RECEIVER = b"C" * 32
+TEMPLATE_PLACEHOLDERS = {
+    "app_id": TEMPLATE_APP_ID,
+    "sender": TEMPLATE_SENDER,
+    "receiver": TEMPLATE_RECEIVER,
+}
+# Every version of the LogicSig which may still be in use by a sub account.
+TEMPLATE_VERSIONS = (1, 2, 3)
+
+
+def template_placeholders(template_version):
+    # Packed sub accounts are shared between receivers, so their LogicSig only
+    # names the sender.
+    if template_version >= PACKED_TEMPLATE_VERSION:
+        return {k: v for k, v in TEMPLATE_PLACEHOLDERS.items() if k != "receiver"}
+    return TEMPLATE_PLACEHOLDERS
+
+
+def subscription_account_address(sender, receiver, app_id, template_version=None):
+    # Hash of the template with the values spliced in between the constant
+    # pieces, i.e. SubscriptionAccount(...).get_address() computed on chain.
+    values = {"sender": sender, "receiver": receiver, "app_id": app_id}
+    parts = [
+        Bytes(segment) if isinstance(segment, bytes) else values[segment]
+        for segment in SubscriptionAccount.segments(template_version)
+    ]
+    return Sha512_256(Concat(*parts))
+
+
+def subtoken_approval_expr(cash_asset_id, sub_asset_id, template_version=None):
+    if template_version is None:
+        template_version = latest_template_version()
+    # From PACKED_TEMPLATE_VERSION on, each sub account holds up to
+    # SLOTS_PER_ACCOUNT subscriptions, one per 1-byte local key, and calls say
+    # which key they mean. Before that the only blob lives under "".
+    packed = template_version >= PACKED_TEMPLATE_VERSION
+    related_index = ScratchVar(TealType.uint64)
+    scratch_subscribe_blob = ScratchVar(TealType.bytes)
+    success = Return(Int(1))
+    data_key = Bytes("")
+    # Aliases for subscribe call arguments.
+    arg_payment_sender = Txn.sender()
+    arg_sub_account = Txn.application_args[1]
+    arg_payment_receiver = Txn.application_args[2]
+    arg_amount = Txn.application_args[3]
+    arg_interval = Txn.application_args[4]
+    subscribe_key = dispense_key = data_key
+    due_cap_arg = 2
+    subscribe_checks = []
+    if packed:
+        subscribe_key = Txn.application_args[5]
+        dispense_key = Txn.application_args[2]
+        due_cap_arg = 3
+        subscribe_checks = [
+            Assert(Len(subscribe_key) == Int(1)),
+            Assert(Btoi(subscribe_key) < Int(SLOTS_PER_ACCOUNT)),
+            # Whoever controls the sub account has to be in on it, so it must
+            # have sent the transaction right before (the opt-in, or a no-op
+            # payment once it's open).
+            Assert(Txn.group_index() > Int(0)),
+            Assert(Gtxn[Txn.group_index() - Int(1)].sender() == arg_sub_account),
+        ]
+    on_subscribe = Seq(
+        # Check arg lengths
+        Assert(Len(arg_sub_account) == Int(32)),
+        Assert(Len(arg_payment_receiver) == Int(32)),
+        Assert(Len(arg_amount) == Int(8)),
+        Assert(Len(arg_interval) == Int(8)),
+        *subscribe_checks,
+        Assert(App.optedIn(arg_sub_account, Global.current_application_id())),
+        # Must not already be a subscription
+        Assert(App.localGet(arg_sub_account, subscribe_key) == Int(0)),
+        App.localPut(
+            arg_sub_account,
+            subscribe_key,
+            Concat(
+                # 0
+                arg_payment_sender,
+                # 32
+                arg_payment_receiver,
+                # 64
+                arg_amount,
+                # 72
+                arg_interval,
+                # 80
+                Itob(Global.latest_timestamp() + Btoi(arg_interval)),
+            ),
+        ),
+        success,
+    )
+    on_dispense = Seq(
+        scratch_subscribe_blob.store(App.localGet(arg_sub_account, dispense_key)),
+        Assert(
+            Txn.sender() == Substring(scratch_subscribe_blob.load(), Int(32), Int(64))
+        ),
+        Assert(
+            Global.latest_timestamp()
+            >= Btoi(Substring(scratch_subscribe_blob.load(), Int(80), Int(88)))
+        ),
+        InnerTxnBuilder.Begin(),
+        InnerTxnBuilder.SetFields(
+            {
+                TxnField.type_enum: TxnType.AssetTransfer,
+                TxnField.asset_sender: Substring(
+                    scratch_subscribe_blob.load(), Int(0), Int(32)
+                ),
+                TxnField.asset_receiver: Substring(
+                    scratch_subscribe_blob.load(), Int(32), Int(64)
+                ),
+                TxnField.asset_amount: Btoi(
+                    Substring(scratch_subscribe_blob.load(), Int(64), Int(72))
+                ),
+                TxnField.xfer_asset: Int(sub_asset_id),
+            }
+        ),
+        InnerTxnBuilder.Submit(),
+        App.localPut(
+            arg_sub_account,
+            dispense_key,
+            Concat(
+                Substring(scratch_subscribe_blob.load(), Int(0), Int(80)),
+                Itob(
+                    Btoi(Substring(scratch_subscribe_blob.load(), Int(80), Int(88)))
+                    + Btoi(Substring(scratch_subscribe_blob.load(), Int(72), Int(80)))
+                ),
+            ),
+        ),
+        success,
+    )
+    intervals_due = ScratchVar(TealType.uint64)
+
+    blob = scratch_subscribe_blob.load()
+    blob_receiver = Substring(blob, Int(32), Int(64))
+    blob_interval = Btoi(Substring(blob, Int(72), Int(80)))
+    blob_next = Btoi(Substring(blob, Int(80), Int(88)))
+
+    def _pay_due(sub_account, key, max_intervals):
+        # Pays every interval which has started since `next` in one transfer
+        # (or at most max_intervals of them, 0 meaning no limit) and moves
+        # `next` forward by that many intervals. The blob must already be in
+        # scratch and known to be due.
+        return Seq(
+            intervals_due.store(
+                (Global.latest_timestamp() - blob_next) / blob_interval + Int(1)
+            ),
+            If(
+                And(max_intervals > Int(0), max_intervals < intervals_due.load()),
+                intervals_due.store(max_intervals),
+            ),
+            InnerTxnBuilder.Begin(),
+            InnerTxnBuilder.SetFields(
+                {
+                    TxnField.type_enum: TxnType.AssetTransfer,
+                    TxnField.asset_sender: Substring(blob, Int(0), Int(32)),
+                    TxnField.asset_receiver: Substring(blob, Int(32), Int(64)),
+                    TxnField.asset_amount: Btoi(Substring(blob, Int(64), Int(72)))
+                    * intervals_due.load(),
+                    TxnField.xfer_asset: Int(sub_asset_id),
+                }
+            ),
+            InnerTxnBuilder.Submit(),
+            App.localPut(
+                sub_account,
+                key,
+                Concat(
+                    Substring(blob, Int(0), Int(80)),
+                    Itob(blob_next + blob_interval * intervals_due.load()),
+                ),
+            ),
+        )
+
+    def _dispense_due(sub_account, key, max_intervals):
+        return Seq(
+            scratch_subscribe_blob.store(App.localGet(sub_account, key)),
+            Assert(Txn.sender() == blob_receiver),
+            Assert(Global.latest_timestamp() >= blob_next),
+            _pay_due(sub_account, key, max_intervals),
+        )
+
+    # Catch-up variant of Dispense. Optional last argument (after the key, if
+    # packed) is an 8-byte cap on the number of intervals to pay.
+    on_dispense_due = Seq(
+        _dispense_due(
+            arg_sub_account,
+            dispense_key,
+            If(
+                Txn.application_args.length() > Int(due_cap_arg),
+                Btoi(Txn.application_args[due_cap_arg]),
+                Int(0),
+            ),
+        ),
+        success,
+    )
+    # Settles every sub account in Txn.accounts which pays the caller and is
+    # due, skipping the rest, so a receiver can settle several subscriptions
+    # per call. Sender accounts have to be in the array too (as inner asset
+    # senders) and are skipped along with anything else that isn't a sub.
+    # Optional second argument caps intervals per subscription like
+    # DispenseDue.
+    account_index = ScratchVar(TealType.uint64)
+    loop_account = Txn.accounts[account_index.load()]
+    loop_blob = App.localGetEx(loop_account, Global.current_application_id(), data_key)
+    on_dispense_many = Seq(
+        For(
+            account_index.store(Int(1)),
+            account_index.load() <= Txn.accounts.length(),
+            account_index.store(account_index.load() + Int(1)),
+        ).Do(
+            # app_local_get_ex on an account which never opted in fails, so
+            # check that first.
+            If(App.optedIn(loop_account, Global.current_application_id())).Then(
+                Seq(
+                    loop_blob,
+                    If(loop_blob.hasValue()).Then(
+                        Seq(
+                            scratch_subscribe_blob.store(loop_blob.value()),
+                            If(
+                                And(
+                                    Txn.sender() == blob_receiver,
+                                    Global.latest_timestamp() >= blob_next,
+                                )
+                            ).Then(
+                                _pay_due(
+                                    loop_account,
+                                    data_key,
+                                    If(
+                                        Txn.application_args.length() > Int(1),
+                                        Btoi(Txn.application_args[1]),
+                                        Int(0),
+                                    ),
+                                )
+                            ),
+                        )
+                    ),
+                )
+            )
+        ),
+        success,
+    )
+    # Packed layout: the first argument lists which subscriptions to look at
+    # as (index into Txn.accounts, key) byte pairs, and the optional second
+    # caps intervals like DispenseDue. Anything not due or not paying the
+    # caller is skipped.
+    arg_targets = Txn.application_args[1]
+    target = ScratchVar(TealType.uint64)
+    target_account = Txn.accounts[GetByte(arg_targets, target.load())]
+    target_key = Extract(arg_targets, target.load() + Int(1), Int(1))
+    target_blob = App.localGetEx(
+        target_account, Global.current_application_id(), target_key
+    )
+    on_dispense_slots = Seq(
+        For(
+            target.store(Int(0)),
+            target.load() < Len(arg_targets),
+            target.store(target.load() + Int(2)),
+        ).Do(
+            If(App.optedIn(target_account, Global.current_application_id())).Then(
+                Seq(
+                    target_blob,
+                    If(target_blob.hasValue()).Then(
+                        Seq(
+                            scratch_subscribe_blob.store(target_blob.value()),
+                            If(
+                                And(
+                                    Txn.sender() == blob_receiver,
+                                    Global.latest_timestamp() >= blob_next,
+                                )
+                            ).Then(
+                                _pay_due(
+                                    target_account,
+                                    target_key,
+                                    If(
+                                        Txn.application_args.length() > Int(2),
+                                        Btoi(Txn.application_args[2]),
+                                        Int(0),
+                                    ),
+                                )
+                            ),
+                        )
+                    ),
+                )
+            )
+        ),
+        success,
+    )
+    # Packed layout only: either end of a subscription can delete it from the
+    # shared sub account. The account itself stays with its sender.
+    on_cancel = Seq(
+        scratch_subscribe_blob.store(App.localGet(arg_sub_account, dispense_key)),
+        Assert(
+            Or(
+                Txn.sender() == Substring(blob, Int(0), Int(32)),
+                Txn.sender() == blob_receiver,
+            )
+        ),
+        App.localDel(arg_sub_account, dispense_key),
+        success,
+    )
+    on_opt_in = Seq(
+        # Subscribe transaction must follow opt-in in the group
+        Assert(Txn.group_index() + Int(1) < Global.group_size()),
+        related_index.store(Txn.group_index() + Int(1)),
+        Assert(Gtxn[related_index.load()].type_enum() == TxnType.ApplicationCall),
+        Assert(Gtxn[related_index.load()].on_completion() == OnComplete.NoOp),
+        Assert(Gtxn[related_index.load()].application_args[0] == Bytes(b"Subscribe")),
+        # And must be sent to the same app
+        Assert(
+            Gtxn[related_index.load()].application_id()
+            == Global.current_application_id()
+        ),
+        # And must be subscribing this sub account
+        Assert(Gtxn[related_index.load()].application_args[1] == Txn.sender()),
+        # And must rekey to the sub control LogicSig to allow cancellation
+        Assert(
+            Txn.rekey_to()
+            == subscription_account_address(
+                sender=Gtxn[related_index.load()].sender(),
+                receiver=Gtxn[related_index.load()].application_args[2],
+                app_id=Itob(Global.current_application_id()),
+                template_version=template_version,
+            )
+        ),
+        success,
+    )
+    on_initialize = Seq(
+        Assert(Txn.sender() == Global.creator_address()),
+        InnerTxnBuilder.Begin(),
+        InnerTxnBuilder.SetFields(
+            {
+                TxnField.type_enum: TxnType.AssetTransfer,
+                TxnField.asset_receiver: Global.current_application_address(),
+                TxnField.asset_amount: Int(0),
+                TxnField.xfer_asset: Int(sub_asset_id),
+            }
+        ),
+        InnerTxnBuilder.Submit(),
+        InnerTxnBuilder.Begin(),
+        InnerTxnBuilder.SetFields(
+            {
+                TxnField.type_enum: TxnType.AssetTransfer,
+                TxnField.asset_receiver: Global.current_application_address(),
+                TxnField.asset_amount: Int(0),
+                TxnField.xfer_asset: Int(cash_asset_id),
+            }
+        ),
+        InnerTxnBuilder.Submit(),
+        success,
+    )
+
+    def _token_swap(receive_asset, send_asset):
+        return Seq(
+            Assert(Txn.group_index() > Int(0)),
+            related_index.store(Txn.group_index() - Int(1)),
+            Assert(
+                And(
+                    Gtxn[related_index.load()].type_enum() == TxnType.AssetTransfer,
+                    Gtxn[related_index.load()].asset_receiver()
+                    == Global.current_application_address(),
+                    Gtxn[related_index.load()].xfer_asset() == Int(receive_asset),
+                )
+            ),
+            InnerTxnBuilder.Begin(),
+            InnerTxnBuilder.SetFields(
+                {
+                    TxnField.type_enum: TxnType.AssetTransfer,
+                    TxnField.asset_amount: Gtxn[related_index.load()].asset_amount(),
+                    TxnField.asset_receiver: Txn.application_args[1],
+                    TxnField.xfer_asset: Int(send_asset),
+                }
+            ),
+            InnerTxnBuilder.Submit(),
+            success,
+        )
+
+    on_cash_in = _token_swap(cash_asset_id, sub_asset_id)
+    on_cash_out = _token_swap(sub_asset_id, cash_asset_id)
+    packed_conds = []
+    if packed:
+        on_dispense_many = on_dispense_slots
+        packed_conds = [[Txn.application_args[0] == Bytes("Cancel"), on_cancel]]
+    on_noop = Cond(
+        [Txn.application_args[0] == Bytes("Initialize"), on_initialize],
+        [Txn.application_args[0] == Bytes("CashIn"), on_cash_in],
+        [Txn.application_args[0] == Bytes("CashOut"), on_cash_out],
+        [Txn.application_args[0] == Bytes("Subscribe"), on_subscribe],
+        [Txn.application_args[0] == Bytes("Dispense"), on_dispense],
+        [Txn.application_args[0] == Bytes("DispenseDue"), on_dispense_due],
+        [Txn.application_args[0] == Bytes("DispenseMany"), on_dispense_many],
+        *packed_conds,
+    )
+    # Clients look up which sub account template the app takes here.
+    on_create = Seq(
+        App.globalPut(Bytes(TEMPLATE_VERSION_KEY), Int(template_version)), success
+    )
+    debug_conds = []
+    if DEBUG_MODE:
+        on_delete_app = Seq(Assert(Txn.sender() == Global.creator_address()), success)
+        # Updates run the old program, so `update` passes the new one's
+        # template version along for it to record.
+        on_update_app = Seq(
+            Assert(Txn.sender() == Global.creator_address()),
+            If(
+                Txn.application_args.length() > Int(0),
+                App.globalPut(
+                    Bytes(TEMPLATE_VERSION_KEY), Btoi(Txn.application_args[0])
+                ),
+            ),
+            success,
+        )
+        debug_conds = [
+            [Txn.on_completion() == OnComplete.UpdateApplication, on_update_app],
+            [Txn.on_completion() == OnComplete.DeleteApplication, on_delete_app],
+        ]
+    program = Cond(
+        [Txn.application_id() == Int(0), on_create],
+        [Txn.on_completion() == OnComplete.OptIn, on_opt_in],
+        # Close-out is always allowed. Sub account logicsig controls approval
+        # and disbursement of remaining balance.
+        [Txn.on_completion() == OnComplete.CloseOut, success],
+        [Txn.on_completion() == OnComplete.NoOp, on_noop],
+        *debug_conds,
+    )
+    return program
+
+
+def subtoken_approval(cash_asset_id, sub_asset_id, template_version=None):
+    return compileTeal(
+        subtoken_approval_expr(cash_asset_id, sub_asset_id, template_version),
+        Mode.Application,
+        version=5,
+    )
+
+
+def clear_state_program():
+    program = Return(Int(1))
+    return compileTeal(program, Mode.Application, version=5)
+
+
+def _sender_logicsig_expr():
+    # Packed sub accounts hold subscriptions to several receivers, so only the
+    # sender (who also funds them) controls one: it signs the no-op payment
+    # that lets a Subscribe into an open account, and closes the account out
+    # to itself once it's empty. Receivers cancel through the app instead.
+    scratch_sender = ScratchVar(TealType.bytes)
+    touch = And(
+        Txn.type_enum() == TxnType.Payment,
+        Txn.amount() == Int(0),
+        Txn.receiver() == Txn.sender(),
+        Txn.close_remainder_to() == Global.zero_address(),
+    )
+    reclaim = And(
+        Txn.type_enum() == TxnType.Payment,
+        Txn.amount() == Int(0),
+        Txn.close_remainder_to() == scratch_sender.load(),
+    )
+    close_out = And(
+        Txn.type_enum() == TxnType.ApplicationCall,
+        Itob(Txn.application_id()) == Bytes(TEMPLATE_APP_ID),
+        Txn.on_completion() == OnComplete.CloseOut,
+    )
+    return Seq(
+        scratch_sender.store(Bytes(TEMPLATE_SENDER)),
+        Assert(
+            Ed25519Verify(
+                Concat(Bytes("Sub"), Txn.tx_id()), Arg(0), scratch_sender.load()
+            )
+        ),
+        Assert(Txn.rekey_to() == Global.zero_address()),
+        # Fees are pooled onto the sender's own transactions.
+        Assert(Txn.fee() == Int(0)),
+        Return(Or(touch, reclaim, close_out)),
+    )
+
+
+def sub_logicsig_expr(template_version):
+    if template_version >= PACKED_TEMPLATE_VERSION:
+        return _sender_logicsig_expr()
+    scratch_receiver = ScratchVar(TealType.bytes)
+    scratch_sender = ScratchVar(TealType.bytes)
+    sig_blob = Concat(Bytes("Sub"), Txn.tx_id())
+    verify_payment = Seq(
+        Assert(Txn.group_index() == Int(2)),
+        # Must be a close-out transaction
+        Assert(Txn.amount() == Int(0)),
+        # Receiver always pays for the sub account, so receiver always gets the refund.
+        Assert(Txn.close_remainder_to() == scratch_receiver.load()),
+        Approve(),
+    )
+    verify_app_call = Seq(
+        Assert(Txn.group_index() == Int(1)),
+        Assert(Itob(Txn.application_id()) == Bytes(TEMPLATE_APP_ID)),
+        Assert(Txn.on_completion() == OnComplete.CloseOut),
+        Approve(),
+    )
+    program = Seq(
+        scratch_receiver.store(Bytes(TEMPLATE_RECEIVER)),
+        scratch_sender.store(Bytes(TEMPLATE_SENDER)),
+        # Cancellation must be authorized by the designated sender or receiver.
+        # From version 2 the second argument says which of them signed (1 for
+        # the receiver), so only one signature check runs.
+        Assert(
+            Or(
+                Ed25519Verify(sig_blob, Arg(0), scratch_sender.load()),
+                Ed25519Verify(sig_blob, Arg(0), scratch_receiver.load()),
+            )
+            if template_version == 1
+            else Ed25519Verify(
+                sig_blob,
+                Arg(0),
+                If(Btoi(Arg(1)), scratch_receiver.load(), scratch_sender.load()),
+            )
+        ),
+        # Don't allow further rekeys
+        Assert(Txn.rekey_to() == Global.zero_address()),
+        # Ensure that the initiator of the cancellation pays the fee
+        # (via fee pooling)
+        Assert(Txn.fee() == Int(0)),
+        # Group must contain 3 transactions (first transaction pays fees from a
+        # different account)
+        Assert(Global.group_size() == Int(3)),
+        # First transaction must be a payment to this account
+        Assert(Gtxn[0].type_enum() == TxnType.Payment),
+        Assert(Gtxn[0].receiver() == Txn.sender()),
+        # Second and third must be the payment and closeout transactions below
+        Assert(Gtxn[1].sender() == Txn.sender()),
+        Assert(Gtxn[2].sender() == Txn.sender()),
+        Cond(
+            [Txn.type_enum() == TxnType.Payment, verify_payment],
+            [Txn.type_enum() == TxnType.ApplicationCall, verify_app_call],
+        ),
+    )
+    return program
+
+
+def sub_logicsig_program(template_version):
+    """
+    TEAL for a version of the sub account LogicSig template. Versions 2 and up
+    go through teal_optimize; the output of every version is pinned by
+    subscription_templates.json, see gen_template.
+    """
+    teal = compileTeal(sub_logicsig_expr(template_version), Mode.Signature, version=5)
+    if template_version >= 2:
+        from algovault import teal_optimize
+
+        teal = teal_optimize.optimize(teal)
+    return teal
@@ -0,0 +1,689 @@
+# Copyright 2021 Mackenzie Straight
+#
+# This file is part of algovault.
+#
+# algovault is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# algovault is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with algovault.  If not, see <https://www.gnu.org/licenses/>.
+
+# A local TEAL assembler, good up to v5. It follows goal's assembler closely
+# enough to produce identical bytecode for what PyTeal emits (including the
+# v4+ constant block layout), which is what lets us size and cost programs
+# without a node. algod's /v2/teal/compile is still what we deploy with.
+import base64
+import binascii
+
+from algosdk import encoding
+
+# name: (opcode, cost, immediates)
+OPCODES = {
+    "err": (0x00, 1, ""),
+    "sha256": (0x01, 35, ""),
+    "keccak256": (0x02, 130, ""),
+    "sha512_256": (0x03, 45, ""),
+    "ed25519verify": (0x04, 1900, ""),
+    "ecdsa_verify": (0x05, 1700, "curve"),
+    "ecdsa_pk_decompress": (0x06, 650, "curve"),
+    "ecdsa_pk_recover": (0x07, 2000, "curve"),
+    "+": (0x08, 1, ""),
+    "-": (0x09, 1, ""),
+    "/": (0x0A, 1, ""),
+    "*": (0x0B, 1, ""),
+    "<": (0x0C, 1, ""),
+    ">": (0x0D, 1, ""),
+    "<=": (0x0E, 1, ""),
+    ">=": (0x0F, 1, ""),
+    "&&": (0x10, 1, ""),
+    "||": (0x11, 1, ""),
+    "==": (0x12, 1, ""),
+    "!=": (0x13, 1, ""),
+    "!": (0x14, 1, ""),
+    "len": (0x15, 1, ""),
+    "itob": (0x16, 1, ""),
+    "btoi": (0x17, 1, ""),
+    "%": (0x18, 1, ""),
+    "|": (0x19, 1, ""),
+    "&": (0x1A, 1, ""),
+    "^": (0x1B, 1, ""),
+    "~": (0x1C, 1, ""),
+    "mulw": (0x1D, 1, ""),
+    "addw": (0x1E, 1, ""),
+    "divmodw": (0x1F, 20, ""),
+    "intcblock": (0x20, 1, "intcblock"),
+    "intc": (0x21, 1, "u8"),
+    "intc_0": (0x22, 1, ""),
+    "intc_1": (0x23, 1, ""),
+    "intc_2": (0x24, 1, ""),
+    "intc_3": (0x25, 1, ""),
+    "bytecblock": (0x26, 1, "bytecblock"),
+    "bytec": (0x27, 1, "u8"),
+    "bytec_0": (0x28, 1, ""),
+    "bytec_1": (0x29, 1, ""),
+    "bytec_2": (0x2A, 1, ""),
+    "bytec_3": (0x2B, 1, ""),
+    "arg": (0x2C, 1, "u8"),
+    "arg_0": (0x2D, 1, ""),
+    "arg_1": (0x2E, 1, ""),
+    "arg_2": (0x2F, 1, ""),
+    "arg_3": (0x30, 1, ""),
+    "txn": (0x31, 1, "txn"),
+    "global": (0x32, 1, "global"),
+    "gtxn": (0x33, 1, "u8 txn"),
+    "load": (0x34, 1, "u8"),
+    "store": (0x35, 1, "u8"),
+    "txna": (0x36, 1, "txn u8"),
+    "gtxna": (0x37, 1, "u8 txn u8"),
+    "gtxns": (0x38, 1, "txn"),
+    "gtxnsa": (0x39, 1, "txn u8"),
+    "gload": (0x3A, 1, "u8 u8"),
+    "gloads": (0x3B, 1, "u8"),
+    "gaid": (0x3C, 1, "u8"),
+    "gaids": (0x3D, 1, ""),
+    "loads": (0x3E, 1, ""),
+    "stores": (0x3F, 1, ""),
+    "bnz": (0x40, 1, "label"),
+    "bz": (0x41, 1, "label"),
+    "b": (0x42, 1, "label"),
+    "return": (0x43, 1, ""),
+    "assert": (0x44, 1, ""),
+    "pop": (0x48, 1, ""),
+    "dup": (0x49, 1, ""),
+    "dup2": (0x4A, 1, ""),
+    "dig": (0x4B, 1, "u8"),
+    "swap": (0x4C, 1, ""),
+    "select": (0x4D, 1, ""),
+    "cover": (0x4E, 1, "u8"),
+    "uncover": (0x4F, 1, "u8"),
+    "concat": (0x50, 1, ""),
+    "substring": (0x51, 1, "u8 u8"),
+    "substring3": (0x52, 1, ""),
+    "getbit": (0x53, 1, ""),
+    "setbit": (0x54, 1, ""),
+    "getbyte": (0x55, 1, ""),
+    "setbyte": (0x56, 1, ""),
+    "extract": (0x57, 1, "u8 u8"),
+    "extract3": (0x58, 1, ""),
+    "extract_uint16": (0x59, 1, ""),
+    "extract_uint32": (0x5A, 1, ""),
+    "extract_uint64": (0x5B, 1, ""),
+    "balance": (0x60, 1, ""),
+    "app_opted_in": (0x61, 1, ""),
+    "app_local_get": (0x62, 1, ""),
+    "app_local_get_ex": (0x63, 1, ""),
+    "app_global_get": (0x64, 1, ""),
+    "app_global_get_ex": (0x65, 1, ""),
+    "app_local_put": (0x66, 1, ""),
+    "app_global_put": (0x67, 1, ""),
+    "app_local_del": (0x68, 1, ""),
+    "app_global_del": (0x69, 1, ""),
+    "asset_holding_get": (0x70, 1, "asset_holding"),
+    "asset_params_get": (0x71, 1, "asset_params"),
+    "app_params_get": (0x72, 1, "app_params"),
+    "min_balance": (0x78, 1, ""),
+    "pushbytes": (0x80, 1, "bytes"),
+    "pushint": (0x81, 1, "int"),
+    "callsub": (0x88, 1, "label"),
+    "retsub": (0x89, 1, ""),
+    "shl": (0x90, 1, ""),
+    "shr": (0x91, 1, ""),
+    "sqrt": (0x92, 4, ""),
+    "bitlen": (0x93, 1, ""),
+    "exp": (0x94, 1, ""),
+    "expw": (0x95, 10, ""),
+    "b+": (0xA0, 10, ""),
+    "b-": (0xA1, 10, ""),
+    "b/": (0xA2, 20, ""),
+    "b*": (0xA3, 20, ""),
+    "b<": (0xA4, 1, ""),
+    "b>": (0xA5, 1, ""),
+    "b<=": (0xA6, 1, ""),
+    "b>=": (0xA7, 1, ""),
+    "b==": (0xA8, 1, ""),
+    "b!=": (0xA9, 1, ""),
+    "b%": (0xAA, 20, ""),
+    "b|": (0xAB, 6, ""),
+    "b&": (0xAC, 6, ""),
+    "b^": (0xAD, 6, ""),
+    "b~": (0xAE, 4, ""),
+    "bzero": (0xAF, 1, ""),
+    "log": (0xB0, 1, ""),
+    "itxn_begin": (0xB1, 1, ""),
+    "itxn_field": (0xB2, 1, "txn"),
+    "itxn_submit": (0xB3, 1, ""),
+    "itxn": (0xB4, 1, "txn"),
+    "itxna": (0xB5, 1, "txn u8"),
+    "txnas": (0xC0, 1, "txn"),
+    "gtxnas": (0xC1, 1, "u8 txn"),
+    "gtxnsas": (0xC2, 1, "txn"),
+    "args": (0xC3, 1, ""),
+}
+
+# The hashes got repriced in v2.
+_V1_COSTS = {"sha256": 7, "keccak256": 26, "sha512_256": 9}
+
+BRANCHES = ("bnz", "bz", "b")
+TERMINATORS = ("b", "return", "err", "retsub")
+
+TXN_FIELDS = [
+    "Sender",
+    "Fee",
+    "FirstValid",
+    "FirstValidTime",
+    "LastValid",
+    "Note",
+    "Lease",
+    "Receiver",
+    "Amount",
+    "CloseRemainderTo",
+    "VotePK",
+    "SelectionPK",
+    "VoteFirst",
+    "VoteLast",
+    "VoteKeyDilution",
+    "Type",
+    "TypeEnum",
+    "XferAsset",
+    "AssetAmount",
+    "AssetSender",
+    "AssetReceiver",
+    "AssetCloseTo",
+    "GroupIndex",
+    "TxID",
+    "ApplicationID",
+    "OnCompletion",
+    "ApplicationArgs",
+    "NumAppArgs",
+    "Accounts",
+    "NumAccounts",
+    "ApprovalProgram",
+    "ClearStateProgram",
+    "RekeyTo",
+    "ConfigAsset",
+    "ConfigAssetTotal",
+    "ConfigAssetDecimals",
+    "ConfigAssetDefaultFrozen",
+    "ConfigAssetUnitName",
+    "ConfigAssetName",
+    "ConfigAssetURL",
+    "ConfigAssetMetadataHash",
+    "ConfigAssetManager",
+    "ConfigAssetReserve",
+    "ConfigAssetFreeze",
+    "ConfigAssetClawback",
+    "FreezeAsset",
+    "FreezeAssetAccount",
+    "FreezeAssetFrozen",
+    "Assets",
+    "NumAssets",
+    "Applications",
+    "NumApplications",
+    "GlobalNumUint",
+    "GlobalNumByteSlice",
+    "LocalNumUint",
+    "LocalNumByteSlice",
+    "ExtraProgramPages",
+    "Nonparticipation",
+    "Logs",
+    "NumLogs",
+    "CreatedAssetID",
+    "CreatedApplicationID",
+]
+
+GLOBAL_FIELDS = [
+    "MinTxnFee",
+    "MinBalance",
+    "MaxTxnLife",
+    "ZeroAddress",
+    "GroupSize",
+    "LogicSigVersion",
+    "Round",
+    "LatestTimestamp",
+    "CurrentApplicationID",
+    "CreatorAddress",
+    "CurrentApplicationAddress",
+    "GroupID",
+]
+
+_FIELDS = {
+    "txn": TXN_FIELDS,
+    "global": GLOBAL_FIELDS,
+    "asset_holding": ["AssetBalance", "AssetFrozen"],
+    "asset_params": [
+        "AssetTotal",
+        "AssetDecimals",
+        "AssetDefaultFrozen",
+        "AssetUnitName",
+        "AssetName",
+        "AssetURL",
+        "AssetMetadataHash",
+        "AssetManager",
+        "AssetReserve",
+        "AssetFreeze",
+        "AssetClawback",
+        "AssetCreator",
+    ],
+    "app_params": [
+        "AppApprovalProgram",
+        "AppClearStateProgram",
+        "AppGlobalNumUint",
+        "AppGlobalNumByteSlice",
+        "AppLocalNumUint",
+        "AppLocalNumByteSlice",
+        "AppExtraProgramPages",
+        "AppCreator",
+        "AppAddress",
+    ],
+    "curve": ["Secp256k1"],
+}
+
+NAMED_INTS = {
+    "unknown": 0,
+    "pay": 1,
+    "keyreg": 2,
+    "acfg": 3,
+    "axfer": 4,
+    "afrz": 5,
+    "appl": 6,
+    "NoOp": 0,
+    "OptIn": 1,
+    "CloseOut": 2,
+    "ClearState": 3,
+    "UpdateApplication": 4,
+    "DeleteApplication": 5,
+}
+
+# First version where the assembler reorders constants by use count and turns
+# single-use constants into pushint/pushbytes.
+_OPTIMIZE_CONSTANTS_VERSION = 4
+
+
+class TealError(Exception):
+    def __init__(self, lineno, message):
+        super().__init__(f"line {lineno}: {message}")
+        self.lineno = lineno
+
+
+class Instruction:
+    """
+    One line of TEAL after parsing. `int`, `byte` and `addr` pseudo-ops keep
+    their name with the parsed constant as the only arg; everything else is
+    an opcode with its immediates as written.
+    """
+
+    __slots__ = ("op", "args", "labels", "lineno", "pc", "size")
+
+    def __init__(self, op, args, labels, lineno):
+        self.op = op
+        self.args = args
+        self.labels = labels
+        self.lineno = lineno
+        self.pc = None
+        self.size = None
+
+    def cost(self, version):
+        if self.op in ("int", "byte", "addr"):
+            return 1
+        if version == 1 and self.op in _V1_COSTS:
+            return _V1_COSTS[self.op]
+        return OPCODES[self.op][1]
+
+    def text(self):
+        def fmt(arg):
+            return "0x" + arg.hex() if isinstance(arg, bytes) else str(arg)
+
+        args = []
+        for arg in self.args:
+            if isinstance(arg, list):
+                args.extend(fmt(a) for a in arg)
+            else:
+                args.append(fmt(arg))
+        # addr is only sugar for a byte constant.
+        return " ".join(["byte" if self.op == "addr" else self.op] + args)
+
+    def __repr__(self):
+        return f"<{self.text()}>"
+
+
+class Program:
+    def __init__(self, version, instructions, trailing_labels):
+        self.version = version
+        self.instructions = instructions
+        # Labels after the last instruction (branching there ends the program).
+        self.trailing_labels = trailing_labels
+        self.header_size = 0
+        self.size = None
+
+    def label_index(self):
+        # label -> index into instructions (len(instructions) for trailing).
+        index = {}
+        for i, ins in enumerate(self.instructions):
+            for label in ins.labels:
+                index[label] = i
+        for label in self.trailing_labels:
+            index[label] = len(self.instructions)
+        return index
+
+    def text(self):
+        lines = [f"#pragma version {self.version}"]
+        for ins in self.instructions:
+            lines.extend(f"{label}:" for label in ins.labels)
+            lines.append(ins.text())
+        lines.extend(f"{label}:" for label in self.trailing_labels)
+        return "\n".join(lines)
+
+
+def _tokenize(line, lineno):
+    tokens = []
+    i = 0
+    while i < len(line):
+        c = line[i]
+        if c.isspace():
+            i += 1
+        elif line.startswith("//", i):
+            break
+        elif c == '"':
+            j = i + 1
+            while j < len(line) and line[j] != '"':
+                j += 2 if line[j] == "\\" else 1
+            if j >= len(line):
+                raise TealError(lineno, "unterminated string")
+            tokens.append(line[i : j + 1])
+            i = j + 1
+        else:
+            j = i
+            while j < len(line) and not line[j].isspace():
+                if line.startswith("//", j):
+                    break
+                j += 1
+            tokens.append(line[i:j])
+            i = j
+    return tokens
+
+
+def _parse_string(token, lineno):
+    body = token[1:-1]
+    out = bytearray()
+    i = 0
+    escapes = {"n": 10, "r": 13, "t": 9, "\\": 92, '"': 34}
+    while i < len(body):
+        c = body[i]
+        if c != "\\":
+            out += c.encode()
+            i += 1
+            continue
+        e = body[i + 1 : i + 2]
+        if e in escapes:
+            out.append(escapes[e])
+            i += 2
+        elif e == "x":
+            out.append(int(body[i + 2 : i + 4], 16))
+            i += 4
+        else:
+            raise TealError(lineno, f"bad escape in {token}")
+    return bytes(out)
+
+
+def _parse_bytes(tokens, lineno):
+    # Returns (value, tokens consumed).
+    if not tokens:
+        raise TealError(lineno, "missing byte constant")
+    t = tokens[0]
+    try:
+        if t.startswith('"'):
+            return _parse_string(t, lineno), 1
+        if t.startswith("0x"):
+            return bytes.fromhex(t[2:]), 1
+        for prefix, decode in (
+            ("base64", base64.b64decode),
+            ("b64", base64.b64decode),
+            ("base32", lambda s: base64.b32decode(s + "=" * (-len(s) % 8))),
+            ("b32", lambda s: base64.b32decode(s + "=" * (-len(s) % 8))),
+        ):
+            if t == prefix and len(tokens) > 1:
+                return decode(tokens[1]), 2
+            if t.startswith(prefix + "(") and t.endswith(")"):
+                return decode(t[len(prefix) + 1 : -1]), 1
+    except (ValueError, binascii.Error) as e:
+        raise TealError(lineno, f"bad byte constant {t}: {e}")
+    raise TealError(lineno, f"bad byte constant {t}")
+
+
+def _parse_int(token, lineno):
+    if token in NAMED_INTS:
+        return NAMED_INTS[token]
+    try:
+        if len(token) > 1 and token[0] == "0" and token.isdigit():
+            return int(token, 8)
+        return int(token, 0)
+    except ValueError:
+        raise TealError(lineno, f"bad int {token}")
+
+
+def _parse_field(kind, token, lineno):
+    fields = _FIELDS[kind]
+    if token in fields:
+        return token
+    raise TealError(lineno, f"unknown {kind} field {token}")
+
+
+def parse(source):
+    version = 1
+    instructions = []
+    labels = []
+    for lineno, line in enumerate(source.splitlines(), 1):
+        stripped = line.strip()
+        if stripped.startswith("#pragma"):
+            parts = stripped.split()
+            if len(parts) == 3 and parts[1] == "version":
+                version = int(parts[2])
+            continue
+        tokens = _tokenize(line, lineno)
+        while tokens and tokens[0].endswith(":"):
+            labels.append(tokens.pop(0)[:-1])
+        if not tokens:
+            continue
+        op, rest = tokens[0], tokens[1:]
+        if op == "int":
+            if len(rest) != 1:
+                raise TealError(lineno, "int needs one argument")
+            args = [_parse_int(rest[0], lineno)]
+        elif op == "byte":
+            value, used = _parse_bytes(rest, lineno)
+            if used != len(rest):
+                raise TealError(lineno, "trailing tokens after byte constant")
+            args = [value]
+        elif op == "addr":
+            if len(rest) != 1:
+                raise TealError(lineno, "addr needs one argument")
+            try:
+                args = [encoding.decode_address(rest[0])]
+            except Exception:
+                raise TealError(lineno, f"bad address {rest[0]}")
+        elif op == "intcblock":
+            args = [[_parse_int(t, lineno) for t in rest]]
+        elif op == "bytecblock":
+            values = []
+            while rest:
+                value, used = _parse_bytes(rest, lineno)
+                values.append(value)
+                rest = rest[used:]
+            args = [values]
+        elif op == "pushint":
+            args = [_parse_int(rest[0], lineno)]
+        elif op == "pushbytes":
+            args = [_parse_bytes(rest, lineno)[0]]
+        elif op in OPCODES:
+            spec = OPCODES[op][2].split()
+            if len(rest) != len(spec):
+                raise TealError(lineno, f"{op} expects {len(spec)} immediates")
+            args = []
+            for kind, token in zip(spec, rest):
+                if kind == "u8":
+                    value = _parse_int(token, lineno)
+                    if not 0 <= value < 256:
+                        raise TealError(lineno, f"{op} immediate out of range")
+                    args.append(value)
+                elif kind == "label":
+                    args.append(token)
+                else:
+                    args.append(_parse_field(kind, token, lineno))
+        else:
+            raise TealError(lineno, f"unknown opcode {op}")
+        instructions.append(Instruction(op, args, labels, lineno))
+        labels = []
+    return Program(version, instructions, labels)
+
+
+def _uvarint(value):
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _constant_blocks(program):
+    # Works out intcblock/bytecblock contents the way goal does. Returns
+    # (intc, bytec, explicit) where explicit means the source declared its
+    # own blocks and the pseudo-ops should just index into them.
+    explicit_int = explicit_byte = None
+    int_uses = {}
+    byte_uses = {}
+    for ins in program.instructions:
+        if ins.op == "intcblock":
+            explicit_int = ins.args[0]
+        elif ins.op == "bytecblock":
+            explicit_byte = ins.args[0]
+        elif ins.op == "int":
+            int_uses[ins.args[0]] = int_uses.get(ins.args[0], 0) + 1
+        elif ins.op in ("byte", "addr"):
+            byte_uses[ins.args[0]] = byte_uses.get(ins.args[0], 0) + 1
+
+    def layout(uses):
+        values = list(uses)
+        if program.version >= _OPTIMIZE_CONSTANTS_VERSION:
+            # Stable, so ties stay in order of first use.
+            values.sort(key=lambda v: -uses[v])
+            values = [v for v in values if uses[v] > 1]
+        return values
+
+    return (
+        explicit_int if explicit_int is not None else layout(int_uses),
+        explicit_byte if explicit_byte is not None else layout(byte_uses),
+        explicit_int is not None or explicit_byte is not None,
+    )
+
+
+def _encode_const_ref(kind, index, value, version):
+    if kind == "int":
+        if index is None:
+            if version < 3:
+                raise ValueError("constant missing from intcblock")
+            return bytes([0x81]) + _uvarint(value)
+        if index < 4:
+            return bytes([0x22 + index])
+        return bytes([0x21, index])
+    if index is None:
+        if version < 3:
+            raise ValueError("constant missing from bytecblock")
+        return bytes([0x80]) + _uvarint(len(value)) + value
+    if index < 4:
+        return bytes([0x28 + index])
+    return bytes([0x27, index])
+
+
+def _encode(ins, intc, bytec, version, labels_pc):
+    op = ins.op
+    if op == "int":
+        value = ins.args[0]
+        index = intc.index(value) if value in intc else None
+        return _encode_const_ref("int", index, value, version)
+    if op in ("byte", "addr"):
+        value = ins.args[0]
+        index = bytec.index(value) if value in bytec else None
+        return _encode_const_ref("byte", index, value, version)
+    opcode, _, spec = OPCODES[op]
+    if op == "arg" and ins.args[0] < 4:
+        return bytes([0x2D + ins.args[0]])
+    out = bytearray([opcode])
+    if op == "intcblock":
+        out += _uvarint(len(ins.args[0]))
+        for value in ins.args[0]:
+            out += _uvarint(value)
+        return bytes(out)
+    if op == "bytecblock":
+        out += _uvarint(len(ins.args[0]))
+        for value in ins.args[0]:
+            out += _uvarint(len(value)) + value
+        return bytes(out)
+    if op == "pushint":
+        return bytes(out) + _uvarint(ins.args[0])
+    if op == "pushbytes":
+        return bytes(out) + _uvarint(len(ins.args[0])) + ins.args[0]
+    for kind, arg in zip(spec.split(), ins.args):
+        if kind == "u8":
+            out.append(arg)
+        elif kind == "label":
+            if labels_pc is None:
+                out += b"\0\0"
+            else:
+                offset = labels_pc[arg] - (ins.pc + 3)
+                if not -0x8000 <= offset < 0x8000:
+                    raise TealError(ins.lineno, f"branch to {arg} too far")
+                out += offset.to_bytes(2, "big", signed=True)
+        else:
+            out.append(_FIELDS[kind].index(arg))
+    return bytes(out)
+
+
+def assemble(program):
+    """
+    Assembles a parsed Program (or TEAL source) to bytecode, filling in pc and
+    size on every instruction and header_size/size on the program.
+    """
+    if isinstance(program, str):
+        program = parse(program)
+    version = program.version
+    intc, bytec, explicit = _constant_blocks(program)
+    header = _uvarint(version)
+    if not explicit:
+        if intc:
+            header += _encode(Instruction("intcblock", [intc], [], 0), [], [], 0, None)
+        if bytec:
+            header += _encode(
+                Instruction("bytecblock", [bytec], [], 0), [], [], 0, None
+            )
+    program.header_size = len(header)
+    # Branches are fixed width, so one sizing pass gives every pc.
+    pc = len(header)
+    labels_pc = {}
+    for ins in program.instructions:
+        for label in ins.labels:
+            labels_pc[label] = pc
+        ins.pc = pc
+        try:
+            ins.size = len(_encode(ins, intc, bytec, version, None))
+        except ValueError as e:
+            raise TealError(ins.lineno, str(e))
+        pc += ins.size
+    for label in program.trailing_labels:
+        labels_pc[label] = pc
+    for ins in program.instructions:
+        for arg, kind in zip(ins.args, OPCODES.get(ins.op, (0, 0, ""))[2].split()):
+            if kind == "label" and arg not in labels_pc:
+                raise TealError(ins.lineno, f"unknown label {arg}")
+    code = bytearray(header)
+    for ins in program.instructions:
+        code += _encode(ins, intc, bytec, version, labels_pc)
+    program.size = len(code)
+    return bytes(code)
@@ -0,0 +1,413 @@
+# Copyright 2021 Mackenzie Straight
+#
+# This file is part of algovault.
+#
+# algovault is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# algovault is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with algovault.  If not, see <https://www.gnu.org/licenses/>.
+
+# Peephole optimizer for PyTeal output, run on the TEAL text before it goes to
+# algod for assembly. Every rewrite stays inside a basic block and only
+# replaces a sequence with one that leaves the same values on the stack and in
+# scratch, and fails in exactly the same cases:
+#
+#   byte A; byte B; concat         -> byte AB
+#   int a; int b; substring3       -> extract a b-a (or substring a a)
+#   int a; int a+8; substring3; btoi -> int a; extract_uint64
+#   extract a 8; btoi              -> int a; extract_uint64
+#   load N; store N                -> (nothing)
+#   store N; load N                -> dup; store N
+#
+# plus common subexpression elimination: a pure expression computed more than
+# once in a block is kept in a scratch slot the program doesn't use (counting
+# down from 255) after the first time.
+from algovault import teal_asm
+
+# The AVM's limit on byte string length.
+_MAX_BYTES = 4096
+
+# Ops whose result depends only on their inputs and immediates (plus things
+# that can't change while the program runs, like txn fields), with the number
+# of values they pop. All of them push exactly one value. `load` is handled
+# separately since a store changes it.
+_PURE_POPS = {
+    "int": 0,
+    "byte": 0,
+    "addr": 0,
+    "pushint": 0,
+    "pushbytes": 0,
+    "txn": 0,
+    "txna": 0,
+    "gtxn": 0,
+    "gtxna": 0,
+    "global": 0,
+    "arg": 0,
+    "arg_0": 0,
+    "arg_1": 0,
+    "arg_2": 0,
+    "arg_3": 0,
+    "gload": 0,
+    "gaid": 0,
+    "gtxns": 1,
+    "gtxnsa": 1,
+    "txnas": 1,
+    "gtxnas": 1,
+    "gtxnsas": 1,
+    "gloads": 1,
+    "gaids": 1,
+    "!": 1,
+    "~": 1,
+    "len": 1,
+    "itob": 1,
+    "btoi": 1,
+    "sqrt": 1,
+    "bitlen": 1,
+    "bzero": 1,
+    "b~": 1,
+    "sha256": 1,
+    "keccak256": 1,
+    "sha512_256": 1,
+    "substring": 1,
+    "extract": 1,
+    "+": 2,
+    "-": 2,
+    "/": 2,
+    "*": 2,
+    "%": 2,
+    "<": 2,
+    ">": 2,
+    "<=": 2,
+    ">=": 2,
+    "&&": 2,
+    "||": 2,
+    "==": 2,
+    "!=": 2,
+    "|": 2,
+    "&": 2,
+    "^": 2,
+    "shl": 2,
+    "shr": 2,
+    "exp": 2,
+    "concat": 2,
+    "getbit": 2,
+    "getbyte": 2,
+    "extract_uint16": 2,
+    "extract_uint32": 2,
+    "extract_uint64": 2,
+    "b+": 2,
+    "b-": 2,
+    "b/": 2,
+    "b*": 2,
+    "b%": 2,
+    "b<": 2,
+    "b>": 2,
+    "b<=": 2,
+    "b>=": 2,
+    "b==": 2,
+    "b!=": 2,
+    "b|": 2,
+    "b&": 2,
+    "b^": 2,
+    "substring3": 3,
+    "extract3": 3,
+    "setbit": 3,
+    "setbyte": 3,
+    "ed25519verify": 3,
+}
+
+# (pops, pushes) for everything else we may see inside a block. Anything not
+# listed here (dig, cover, callsub, ...) ends the analysis of the block.
+_IMPURE_EFFECTS = {
+    "store": (1, 0),
+    "assert": (1, 0),
+    "pop": (1, 0),
+    "return": (1, 0),
+    "err": (0, 0),
+    "bnz": (1, 0),
+    "bz": (1, 0),
+    "b": (0, 0),
+    "log": (1, 0),
+    "select": (3, 1),
+    "balance": (1, 1),
+    "min_balance": (1, 1),
+    "app_opted_in": (2, 1),
+    "app_local_get": (2, 1),
+    "app_local_get_ex": (3, 2),
+    "app_global_get": (1, 1),
+    "app_global_get_ex": (2, 2),
+    "app_local_put": (3, 0),
+    "app_global_put": (2, 0),
+    "app_local_del": (2, 0),
+    "app_global_del": (1, 0),
+    "asset_holding_get": (2, 2),
+    "asset_params_get": (1, 2),
+    "app_params_get": (1, 2),
+    "itxn_begin": (0, 0),
+    "itxn_field": (1, 0),
+    "itxn_submit": (0, 0),
+    "itxn": (0, 1),
+    "itxna": (0, 1),
+    "mulw": (2, 2),
+    "addw": (2, 2),
+    "divmodw": (4, 4),
+    "expw": (2, 2),
+    "ecdsa_verify": (5, 1),
+    "ecdsa_pk_decompress": (1, 2),
+    "ecdsa_pk_recover": (4, 2),
+    "args": (1, 1),
+    "loads": (1, 1),
+    "intcblock": (0, 0),
+    "bytecblock": (0, 0),
+}
+
+
+def _ins(op, args, labels=()):
+    return teal_asm.Instruction(op, list(args), list(labels), 0)
+
+
+def _is_int(ins):
+    return ins.op in ("int", "pushint")
+
+
+def _rewrite(window, version):
+    # Returns (instructions consumed, replacement) for the first rule which
+    # matches at the start of window, or None. The caller makes sure nothing
+    # past the first instruction carries a label.
+    a = window[0]
+    b = window[1] if len(window) > 1 else None
+    c = window[2] if len(window) > 2 else None
+    d = window[3] if len(window) > 3 else None
+    if (
+        d is not None
+        and _is_int(a)
+        and _is_int(b)
+        and c.op == "substring3"
+        and d.op == "btoi"
+        and b.args[0] == a.args[0] + 8
+        and version >= 5
+    ):
+        return 4, [_ins("int", a.args, a.labels), _ins("extract_uint64", [])]
+    if (
+        b is not None
+        and a.op == "extract"
+        and a.args[1] == 8
+        and b.op == "btoi"
+        and version >= 5
+    ):
+        return 2, [_ins("int", a.args[:1], a.labels), _ins("extract_uint64", [])]
+    if (
+        c is not None
+        and _is_int(a)
+        and _is_int(b)
+        and c.op == "substring3"
+        and 0 <= a.args[0] <= b.args[0] < 256
+    ):
+        start, end = a.args[0], b.args[0]
+        # extract with length 0 means "to the end", so an empty substring
+        # stays a substring.
+        if end > start and version >= 5:
+            return 3, [_ins("extract", [start, end - start], a.labels)]
+        if version >= 2:
+            return 3, [_ins("substring", [start, end], a.labels)]
+    if (
+        c is not None
+        and a.op in ("byte", "addr", "pushbytes")
+        and b.op in ("byte", "addr", "pushbytes")
+        and c.op == "concat"
+        and len(a.args[0]) + len(b.args[0]) <= _MAX_BYTES
+    ):
+        return 3, [_ins("byte", [a.args[0] + b.args[0]], a.labels)]
+    if b is not None and a.op == "load" and b.op == "store" and a.args == b.args:
+        return 2, []
+    if b is not None and a.op == "store" and b.op == "load" and a.args == b.args:
+        return 2, [_ins("dup", [], a.labels), _ins("store", a.args)]
+    return None
+
+
+def _peephole(instructions, version):
+    changed = True
+    while changed:
+        changed = False
+        out = []
+        i = 0
+        while i < len(instructions):
+            window = instructions[i : i + 4]
+            # Cut the window at the first label past its start.
+            for j in range(1, len(window)):
+                if window[j].labels:
+                    window = window[:j]
+                    break
+            match = _rewrite(window, version)
+            # A rewrite to nothing would lose the labels of the first
+            # instruction, so leave those alone.
+            if match is None or (not match[1] and instructions[i].labels):
+                out.append(instructions[i])
+                i += 1
+                continue
+            consumed, replacement = match
+            out.extend(replacement)
+            i += consumed
+            changed = True
+        instructions = out
+    return instructions
+
+
+def _blocks(instructions):
+    start = 0
+    for i, ins in enumerate(instructions):
+        if i > start and ins.labels:
+            yield start, i
+            start = i
+        if ins.op in teal_asm.BRANCHES or ins.op in teal_asm.TERMINATORS:
+            yield start, i + 1
+            start = i + 1
+        elif ins.op == "callsub":
+            yield start, i + 1
+            start = i + 1
+    if start < len(instructions):
+        yield start, len(instructions)
+
+
+def _value_numbers(block):
+    """
+    Symbolically runs a block. Returns {key: [spans]} for every pure value
+    computed in it, where key identifies the value and each span is the
+    (start, end) range of instructions which computes it from scratch, with
+    nothing else happening in between.
+    """
+    stack = []  # (key, span or None)
+    slot_versions = {}
+    fresh = 0
+    found = {}
+    for i, ins in enumerate(block):
+        op = ins.op
+        if op == "load":
+            slot = ins.args[0]
+            key = ("load", slot, slot_versions.get(slot, 0))
+            stack.append((key, (i, i + 1)))
+            found.setdefault(key, []).append((i, i + 1))
+            continue
+        if op in _PURE_POPS:
+            pops = _PURE_POPS[op]
+            if pops > len(stack):
+                # Consumes values from before the block.
+                del stack[:]
+                fresh += 1
+                stack.append((("opaque", fresh), None))
+                continue
+            inputs = stack[len(stack) - pops :] if pops else []
+            del stack[len(stack) - pops :]
+            key = (op, tuple(_hashable(a) for a in ins.args)) + tuple(
+                k for k, _ in inputs
+            )
+            span = (i, i + 1)
+            if inputs:
+                spans = [s for _, s in inputs]
+                contiguous = all(s is not None for s in spans) and all(
+                    spans[j][1] == spans[j + 1][0] for j in range(len(spans) - 1)
+                )
+                span = (
+                    (spans[0][0], i + 1) if contiguous and spans[-1][1] == i else None
+                )
+            stack.append((key, span))
+            if span is not None:
+                found.setdefault(key, []).append(span)
+            continue
+        if op == "dup":
+            if not stack:
+                return found
+            stack.append((stack[-1][0], None))
+            continue
+        if op not in _IMPURE_EFFECTS:
+            # Not worth modelling; stop here.
+            return found
+        if op == "store":
+            slot = ins.args[0]
+            slot_versions[slot] = slot_versions.get(slot, 0) + 1
+        pops, pushes = _IMPURE_EFFECTS[op]
+        del stack[max(0, len(stack) - pops) :]
+        for _ in range(pushes):
+            fresh += 1
+            stack.append((("opaque", fresh), None))
+    return found
+
+
+def _hashable(arg):
+    return tuple(arg) if isinstance(arg, list) else arg
+
+
+def _cse_block(block, free_slots):
+    # Repeatedly caches the most profitable repeated expression until nothing
+    # is worth it or we run out of slots.
+    while free_slots:
+        best = None
+        for key, spans in _value_numbers(block).items():
+            # Drop spans overlapping an earlier one (a value nested in itself
+            # can't happen, but equal spans from dup'd keys can).
+            spans = sorted(set(spans))
+            kept = []
+            for span in spans:
+                if not kept or span[0] >= kept[-1][1]:
+                    kept.append(span)
+            if len(kept) < 2:
+                continue
+            length = kept[0][1] - kept[0][0]
+            # Later copies shrink to one load; the first grows by dup+store.
+            gain = (length - 1) * (len(kept) - 1) - 2
+            if gain > 0 and (best is None or gain > best[0]):
+                best = (gain, kept)
+        if best is None:
+            return block
+        slot = free_slots.pop()
+        _, spans = best
+        out = []
+        prev = 0
+        for n, (start, end) in enumerate(spans):
+            out.extend(block[prev:start])
+            if n == 0:
+                out.extend(block[start:end])
+                out.append(_ins("dup", []))
+                out.append(_ins("store", [slot]))
+            else:
+                out.append(_ins("load", [slot], block[start].labels))
+            prev = end
+        out.extend(block[prev:])
+        block = out
+    return block
+
+
+def _cse(instructions):
+    used = set()
+    for ins in instructions:
+        if ins.op in ("loads", "stores"):
+            # Dynamic slots; can't tell which ones are free.
+            return instructions
+        if ins.op in ("load", "store"):
+            used.add(ins.args[0])
+    free_slots = sorted(set(range(256)) - used)
+    out = []
+    for start, end in list(_blocks(instructions)):
+        out.extend(_cse_block(instructions[start:end], free_slots))
+    return out
+
+
+def optimize_program(program):
+    """Optimizes a parsed teal_asm.Program in place and returns it."""
+    instructions = _peephole(program.instructions, program.version)
+    instructions = _cse(instructions)
+    program.instructions = _peephole(instructions, program.version)
+    return program
+
+
+def optimize(source):
+    """TEAL source in, optimized TEAL source out."""
+    return optimize_program(teal_asm.parse(source)).text()
@@ -0,0 +1,535 @@
+# Copyright 2021 Mackenzie Straight
+#
+# This file is part of algovault.
+#
+# algovault is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# algovault is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with algovault.  If not, see <https://www.gnu.org/licenses/>.
+
+# Static cost and size profiles of TEAL programs. Builds the control flow graph
+# of the assembled program and takes the most expensive path through it, which
+# is what counts against the budget from v4 on (before that a LogicSig was
+# charged for every opcode in it, which we report too).
+#
+# For programs we generate with PyTeal, every branch of every Cond (e.g.
+# NoOp/Subscribe) gets a marker so we can also report the worst case of paths
+# through that branch, plus the size of the branch compiled on its own.
+# A loop inside a branch can be given an iteration bound, in which case the
+# worst pass through its body is charged that many times before the way out
+# (so every pass is assumed to take its most expensive path). Other loops are
+# counted once, and anything with one in it is flagged.
+import json
+import os.path
+import re
+import sys
+
+import click
+
+from algovault import QVOTE_CONTRACTS_DIR, teal_asm
+
+APP_BUDGET = 700
+LOGICSIG_BUDGET = 20000
+LOGICSIG_MAX_SIZE = 1000
+APP_PAGE_SIZE = 2048
+
+_MARKER_PREFIX = b"__profile:"
+
+
+class Block:
+    __slots__ = ("start", "end", "cost", "succ", "call")
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.cost = 0
+        self.succ = []
+        # Entry block of the subroutine a trailing callsub jumps to.
+        self.call = None
+
+
+class Profile:
+    def __init__(self, program, zero_cost=(), loop_bounds=None):
+        self.program = program
+        teal_asm.assemble(program)
+        version = program.version
+        instructions = program.instructions
+        labels = program.label_index()
+        self.costs = [
+            0 if i in zero_cost else ins.cost(version)
+            for i, ins in enumerate(instructions)
+        ]
+        self.static_cost = sum(self.costs)
+        leaders = {0} | set(labels.values()) | set(zero_cost)
+        for i, ins in enumerate(instructions):
+            if ins.op in teal_asm.BRANCHES or ins.op in teal_asm.TERMINATORS:
+                leaders.add(i + 1)
+            elif ins.op == "callsub":
+                leaders.add(i + 1)
+        leaders = sorted(i for i in leaders if i < len(instructions))
+        self.blocks = {}
+        for start, end in zip(leaders, leaders[1:] + [len(instructions)]):
+            block = self.blocks[start] = Block(start, end)
+            block.cost = sum(self.costs[start:end])
+        for block in self.blocks.values():
+            last = instructions[block.end - 1]
+            fallthrough = block.end if block.end < len(instructions) else None
+            if last.op in ("bnz", "bz"):
+                block.succ = [labels[last.args[0]], fallthrough]
+            elif last.op == "b":
+                block.succ = [labels[last.args[0]]]
+            elif last.op == "callsub":
+                block.call = labels[last.args[0]]
+                block.succ = [fallthrough]
+            elif last.op not in teal_asm.TERMINATORS:
+                block.succ = [fallthrough]
+            # Branching to the end of the program just ends it.
+            block.succ = [
+                s for s in block.succ if s is not None and s < len(instructions)
+            ]
+        # Extra cost charged on entering a bounded loop's header block.
+        self._extra = {}
+        self._analyze()
+        if loop_bounds:
+            self._extra = {
+                header: count * self._pass_cost(header)
+                for header, count in loop_bounds.items()
+            }
+            self._analyze()
+
+    def _analyze(self):
+        self._recursive = False
+        self._from = {}
+        self._order = []
+        self._back_edges = set()
+        self._longest_from(0, set())
+        self._to = self._longest_to()
+        self.loops = self._recursive or any(
+            header not in self._extra for _, header in self._back_edges
+        )
+
+    def _longest_from(self, start, on_stack):
+        # Worst cost from the start of a block to the end of the program (or
+        # its retsub). Back edges count as zero.
+        if start in self._from:
+            return self._from[start]
+        block = self.blocks[start]
+        on_stack.add(start)
+        call = 0
+        if block.call is not None:
+            if block.call in on_stack:
+                self._recursive = True
+            else:
+                call = self._longest_from(block.call, on_stack)
+        best = 0
+        for succ in block.succ:
+            if succ in on_stack:
+                self._back_edges.add((start, succ))
+                continue
+            best = max(best, self._longest_from(succ, on_stack))
+        on_stack.discard(start)
+        self._order.append(start)
+        self._from[start] = block.cost + call + best + self._extra.get(start, 0)
+        return self._from[start]
+
+    def _pass_cost(self, header):
+        # Worst cost of one trip from a loop's header around to its back edge,
+        # within the loop body (the blocks which reach the back edge without
+        # going through the header again).
+        latches = {start for start, succ in self._back_edges if succ == header}
+        preds = {}
+        for block in self.blocks.values():
+            for succ in block.succ:
+                preds.setdefault(succ, []).append(block.start)
+        body = {header}
+        stack = list(latches)
+        while stack:
+            index = stack.pop()
+            if index not in body:
+                body.add(index)
+                stack.extend(preds.get(index, []))
+        memo = {}
+
+        def longest(index):
+            if index in memo:
+                return memo[index]
+            block = self.blocks[index]
+            best = 0 if index in latches else None
+            for succ in block.succ:
+                if succ in body and (index, succ) not in self._back_edges:
+                    rest = longest(succ)
+                    if rest is not None and (best is None or rest > best):
+                        best = rest
+            if best is not None:
+                best += block.cost + self._from.get(block.call, 0)
+                if index != header:
+                    best += self._extra.get(index, 0)
+            memo[index] = best
+            return best
+
+        return longest(header) or 0
+
+    def _longest_to(self):
+        # Worst cost of reaching the start of each block from the entry point.
+        to = {0: 0}
+        for start in reversed(self._order):
+            if start not in to:
+                continue
+            block = self.blocks[start]
+            cost = block.cost + self._extra.get(start, 0)
+            targets = [(s, cost) for s in block.succ]
+            if block.call is not None:
+                targets = [(block.call, cost)] + [
+                    (s, cost + self._from.get(block.call, 0)) for s in block.succ
+                ]
+            for succ, weight in targets:
+                if (start, succ) in self._back_edges:
+                    continue
+                to[succ] = max(to.get(succ, 0), to[start] + weight)
+        return to
+
+    @property
+    def worst_cost(self):
+        return self._from[0]
+
+    def worst_through(self, index):
+        # Worst cost of any path which passes through the given instruction,
+        # which must start a block.
+        if index not in self._to:
+            return None
+        return self._to[index] + self._from[index]
+
+    def _reachable(self, start, skip=None):
+        seen = set()
+        stack = [start]
+        while stack:
+            index = stack.pop()
+            if index in seen or index == skip:
+                continue
+            seen.add(index)
+            block = self.blocks[index]
+            stack.extend(block.succ)
+            if block.call is not None:
+                stack.append(block.call)
+        return seen
+
+    def region(self, index):
+        # Blocks only reachable through the given block, i.e. the ones it
+        # dominates.
+        return self._reachable(index) - self._reachable(0, skip=index)
+
+    def loop_headers(self):
+        return {header for _, header in self._back_edges}
+
+    def region_size(self, index):
+        # Bytecode size of the code only reachable through the given block,
+        # leaving out zero cost markers.
+        region = self.region(index)
+        instructions = self.program.instructions
+        return sum(
+            instructions[i].size
+            for start in region
+            for i in range(start, self.blocks[start].end)
+            if self.costs[i] or instructions[i].op not in ("byte", "pop")
+        )
+
+    def label_costs(self):
+        labels = self.program.label_index()
+        return {
+            label: self._from[index]
+            for label, index in labels.items()
+            if index in self._from
+        }
+
+
+def _branch_label(cond):
+    text = str(cond)
+    match = re.search(r'utf8 bytes: "([^"]*)"', text) or re.search(
+        r"IntEnum: (\w+)", text
+    )
+    if match:
+        return match.group(1)
+    if text == "(== (Txn ApplicationID) (Int: 0))":
+        return "create"
+    return text
+
+
+def _mark_branches(expr, prefix, branches):
+    # Wraps every Cond branch reachable through Conds and Seqs in a marker, so
+    # it can be found again in the compiled output.
+    from pyteal import Bytes, Cond, Pop, Seq
+
+    if isinstance(expr, Cond):
+        for arg in expr.args:
+            name = prefix + _branch_label(arg[0])
+            branches.append(name)
+            _mark_branches(arg[1], name + "/", branches)
+            marker = Bytes(_MARKER_PREFIX + name.encode())
+            arg[1] = Seq(Pop(marker), arg[1])
+    elif isinstance(expr, Seq):
+        for arg in expr.args:
+            _mark_branches(arg, prefix, branches)
+
+
+def _parse(source, optimize):
+    program = teal_asm.parse(source)
+    if optimize:
+        from algovault import teal_optimize
+
+        teal_optimize.optimize_program(program)
+    return program
+
+
+def profile_expr(build, mode, version=5, optimize=False, loop_bounds=None):
+    """
+    Profiles a PyTeal program. `build` is called twice (once for the real
+    program, once for the marked copy) since marking modifies the tree.
+    Branch sizes are measured in the marked copy, which may lay out its
+    constants slightly differently.
+
+    loop_bounds maps branch names (e.g. "NoOp/DispenseMany") to the most
+    times loops inside them can go round. With any given, the worst case is
+    taken from the marked copy too.
+    """
+    from pyteal import Mode, compileTeal
+
+    result_mode = mode
+    mode = Mode.Signature if mode == "logicsig" else Mode.Application
+    program = _parse(compileTeal(build(), mode, version=version), optimize)
+    result = _summarize(Profile(program), result_mode)
+    marked_expr = build()
+    branches = []
+    _mark_branches(marked_expr, "", branches)
+    marked = _parse(compileTeal(marked_expr, mode, version=version), optimize)
+    markers = {}
+    for i, ins in enumerate(marked.instructions):
+        if (
+            ins.op == "byte"
+            and ins.args[0].startswith(_MARKER_PREFIX)
+            and i + 1 < len(marked.instructions)
+            and marked.instructions[i + 1].op == "pop"
+        ):
+            markers[ins.args[0][len(_MARKER_PREFIX) :].decode()] = i
+    zero_cost = set(markers.values()) | {i + 1 for i in markers.values()}
+    marked_profile = Profile(marked, zero_cost)
+    header_bounds = {}
+    for name, count in (loop_bounds or {}).items():
+        if name in markers:
+            region = marked_profile.region(markers[name])
+            for header in marked_profile.loop_headers() & region:
+                header_bounds[header] = count
+    if header_bounds:
+        marked_profile = Profile(marked, zero_cost, header_bounds)
+        result["worst_cost"] = marked_profile.worst_cost
+        result["loops"] = marked_profile.loops
+    result["branches"] = [
+        {
+            "branch": name,
+            "worst_cost": marked_profile.worst_through(markers[name]),
+            "size": marked_profile.region_size(markers[name]),
+            "iterations": (loop_bounds or {}).get(name),
+        }
+        for name in branches
+        if name in markers
+    ]
+    return result
+
+
+def profile_source(source, mode, optimize=False):
+    program = _parse(source, optimize)
+    return _summarize(Profile(program), mode)
+
+
+def _summarize(profile, mode):
+    program = profile.program
+    logicsig = mode == "logicsig"
+    return {
+        "version": program.version,
+        "size": program.size,
+        "header_size": program.header_size,
+        "worst_cost": profile.worst_cost,
+        "static_cost": profile.static_cost,
+        "budget": LOGICSIG_BUDGET if logicsig else APP_BUDGET,
+        "max_size": LOGICSIG_MAX_SIZE if logicsig else APP_PAGE_SIZE,
+        "loops": profile.loops,
+        "labels": profile.label_costs(),
+        "branches": [],
+    }
+
+
+def _project_programs(cash_asset_id, sub_asset_id):
+    # name -> (build expr or None, source, mode, always optimized, loop bounds)
+    from algovault.subscription import MAX_CALL_DISPENSES
+
+    def subscription(attr, *args):
+        def build():
+            from algovault import subscription_teal
+
+            return getattr(subscription_teal, attr)(*args)
+
+        return build
+
+    def naming(attr):
+        def build():
+            from algovault import naming_teal
+
+            return getattr(naming_teal, attr)()
+
+        return build
+
+    def qvote(name):
+        def source():
+            with open(os.path.join(QVOTE_CONTRACTS_DIR, name), "r") as f:
+                return f.read()
+
+        return source
+
+    return {
+        "subscription-approval": (
+            subscription("subtoken_approval_expr", cash_asset_id, sub_asset_id),
+            None,
+            "app",
+            False,
+            {"NoOp/DispenseMany": MAX_CALL_DISPENSES},
+        ),
+        "subscription-clear": (
+            None,
+            subscription("clear_state_program"),
+            "app",
+            False,
+            None,
+        ),
+        # Template versions from 2 on are generated through the optimizer.
+        "subscription-logicsig-v1": (
+            subscription("sub_logicsig_expr", 1),
+            None,
+            "logicsig",
+            False,
+            None,
+        ),
+        "subscription-logicsig-v2": (
+            subscription("sub_logicsig_expr", 2),
+            None,
+            "logicsig",
+            True,
+            None,
+        ),
+        "subscription-logicsig-v3": (
+            subscription("sub_logicsig_expr", 3),
+            None,
+            "logicsig",
+            True,
+            None,
+        ),
+        "naming-approval": (naming("approval_expr"), None, "app", False, None),
+        "naming-clear": (None, naming("clear_state_program"), "app", False, None),
+        "qvote-approval": (
+            None,
+            qvote("quadratic_voting_approval.teal"),
+            "app",
+            False,
+            None,
+        ),
+        "qvote-clear": (
+            None,
+            qvote("quadratic_voting_clear_state.teal"),
+            "app",
+            False,
+            None,
+        ),
+    }
+
+
+def _print_report(name, result, show_labels):
+    loop_note = " (loops counted once)" if result["loops"] else ""
+    print(
+        f"{name}: v{result['version']}, {result['size']} bytes "
+        f"(header {result['header_size']}, limit {result['max_size']}), "
+        f"worst case {result['worst_cost']}/{result['budget']}{loop_note}, "
+        f"static {result['static_cost']}"
+    )
+    if result["branches"]:
+        width = max(len(b["branch"]) for b in result["branches"])
+        print(f"  {'branch':<{width}} {'worst':>6} {'size':>6}")
+        for branch in result["branches"]:
+            iterations = branch.get("iterations")
+            print(
+                f"  {branch['branch']:<{width}} {branch['worst_cost']:>6} "
+                f"{branch['size']:>6}"
+                + (f"  (loops x{iterations})" if iterations else "")
+            )
+    if show_labels:
+        for label, cost in result["labels"].items():
+            print(f"  {label}: {cost}")
+
+
+@click.command("teal-profile")
+@click.argument("programs", nargs=-1)
+@click.option("--cash_asset_id", type=click.INT, default=None)
+@click.option("--sub_asset_id", type=click.INT, default=None)
+@click.option(
+    "--mode",
+    type=click.Choice(["app", "logicsig"]),
+    default="app",
+    help="Budget to check .teal files against.",
+)
+@click.option("--labels", "show_labels", is_flag=True, help="Cost from each label.")
+@click.option(
+    "--optimize", is_flag=True, help="Profile the output of teal_optimize instead."
+)
+@click.option("--json", "as_json", is_flag=True)
+def command(
+    programs, cash_asset_id, sub_asset_id, mode, show_labels, optimize, as_json
+):
+    """
+    Static cost and size report for the project's TEAL programs (all of them
+    by default) or any .teal file.
+    """
+    from algovault.subscription import DEFAULT_CASH_ID, DEFAULT_SUB_ID
+
+    known = _project_programs(
+        DEFAULT_CASH_ID if cash_asset_id is None else cash_asset_id,
+        DEFAULT_SUB_ID if sub_asset_id is None else sub_asset_id,
+    )
+    if not programs:
+        # The qvote contracts are a git submodule which may not be checked out.
+        programs = [
+            name
+            for name in known
+            if not name.startswith("qvote") or os.path.isdir(QVOTE_CONTRACTS_DIR)
+        ]
+    results = {}
+    for name in programs:
+        try:
+            if name in known:
+                build, source, program_mode, optimized, bounds = known[name]
+                if build is not None:
+                    results[name] = profile_expr(
+                        build,
+                        program_mode,
+                        optimize=optimize or optimized,
+                        loop_bounds=bounds,
+                    )
+                else:
+                    results[name] = profile_source(
+                        source(), program_mode, optimize=optimize or optimized
+                    )
+            else:
+                with open(name, "r") as f:
+                    results[name] = profile_source(f.read(), mode, optimize=optimize)
+        except (OSError, teal_asm.TealError) as e:
+            click.echo(f"{name}: {e}", err=True)
+            sys.exit(1)
+    if as_json:
+        print(json.dumps(results, indent=2))
+        return
+    for name, result in results.items():
+        _print_report(name, result, show_labels)
@@ -14,8 +14,16 @@
 #
 # You should have received a copy of the GNU Affero General Public License along
 # with algovault.  If not, see <https://www.gnu.org/licenses/>.
+import base64
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 from algosdk.future import transaction
-from algovault.client import get_wallet
+import click
+
+from algovault import fees, pipeline
+from algovault.client import get_block, get_wallet
 
 
 def create_max_token(
@@ -25,11 +33,13 @@ def create_max_token(
     manager="",
     reserve="",
     freeze="",
+    clawback=None,
     url="https://str.rs/",
 ):
     """
     Creates a token with maximum possible supply (uint64 max) and 6
-    fractional digits.
+    fractional digits, and returns its asset id. The clawback defaults to the
+    creator.
     """
     kcl, acl, wallet_handle, pw = get_wallet()
     suggested_params = acl.suggested_params()
@@ -39,7 +49,7 @@ def create_max_token(
         0xFFFFFFFFFFFFFFFF,
         6,
         False,
-        clawback=creator,
+        clawback=creator if clawback is None else clawback,
         freeze=freeze,
         manager=manager,
         reserve=reserve,
@@ -49,4 +59,241 @@ def create_max_token(
     )
     signed_txn = kcl.sign_transaction(wallet_handle, pw, txn)
     acl.send_transaction(signed_txn)
-    transaction.wait_for_confirmation(acl, signed_txn.get_txid())
+    info = transaction.wait_for_confirmation(acl, signed_txn.get_txid())
+    asset_id = info["asset-index"]
+    print("Created new asset-id:", asset_id)
+    return asset_id
+
+
+# Bulk distribution. Rows of "address,amount" are streamed from the input,
+# receivers' opt-ins are looked up LOOKUP_BATCH at a time in parallel, and the
+# transfers go out 16 to a group through pipeline.submit_groups. Rows whose
+# receiver hasn't opted in are skipped.
+#
+# Progress is checkpointed as how many input rows have been consumed plus the
+# groups in flight, written before each group is sent. After a crash the
+# in-flight groups are settled by waiting out their (short) validity window
+# and looking for their group id in those blocks; the ones that never landed
+# are sent again, then reading resumes where it stopped. Each row gets exactly
+# one result line in the output, give or take a repeated "skipped" line.
+LOOKUP_BATCH = 256
+LOOKUP_WORKERS = 16
+VALIDITY_ROUNDS = 20
+
+
+def _read_rows(path, start):
+    with open(path, "r") as f:
+        row = 0
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if row >= start:
+                address, amount = line.replace(",", " ").split()
+                yield row, address, int(amount)
+            row += 1
+
+
+def _opted_in(info, asset_id):
+    return any(asset["asset-id"] == asset_id for asset in info.get("assets", []))
+
+
+class Distribution:
+    def __init__(self, acl, private_key, sender, asset_id, checkpoint_file, out):
+        self.acl = acl
+        self.private_key = private_key
+        self.sender = sender
+        self.asset_id = asset_id
+        self.checkpoint_file = checkpoint_file
+        self.out = out
+        self.read = 0
+        # group id (b64) -> {"rows": [[row, address, amount]], "first", "last"}
+        self.in_flight = {}
+        self.requeued = []
+
+    def load(self, in_file):
+        try:
+            with open(self.checkpoint_file, "r") as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        if (state["in_file"], state["asset_id"]) != (
+            os.path.abspath(in_file),
+            self.asset_id,
+        ):
+            click.echo("Checkpoint is for a different distribution.", err=True)
+            raise SystemExit(1)
+        self.read = state["read"]
+        for group_id, entry in state["in_flight"].items():
+            confirmed_round = self._find_group(base64.b64decode(group_id), entry)
+            if confirmed_round is None:
+                self.requeued.extend(entry["rows"])
+            else:
+                self._results(entry["rows"], "sent", round=confirmed_round)
+
+    def save(self, in_file):
+        state = {
+            "in_file": os.path.abspath(in_file),
+            "asset_id": self.asset_id,
+            "read": self.read,
+            "in_flight": self.in_flight,
+        }
+        tmp_file = f"{self.checkpoint_file}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_file, self.checkpoint_file)
+
+    def _find_group(self, group_id, entry):
+        # Wait the group out, then see whether it made it into a block.
+        current_round = self.acl.status()["last-round"]
+        while current_round <= entry["last"]:
+            current_round = self.acl.status_after_block(current_round)["last-round"]
+        for round in range(entry["first"], entry["last"] + 1):
+            for stxn in get_block(self.acl, round)["block"].get("txns", []):
+                if stxn["txn"].get("grp") == group_id:
+                    return round
+        return None
+
+    def _results(self, rows, status, **fields):
+        for row, address, amount in rows:
+            record = {"row": row, "address": address, "amount": amount}
+            record.update(status=status, **fields)
+            self.out.write(json.dumps(record) + "\n")
+        self.out.flush()
+
+    def _batches(self, in_file):
+        if self.requeued:
+            yield [
+                (row, address, amount, True) for row, address, amount in self.requeued
+            ]
+        rows = _read_rows(in_file, self.read)
+        with ThreadPoolExecutor(LOOKUP_WORKERS) as executor:
+            while True:
+                batch = [row for _, row in zip(range(LOOKUP_BATCH), rows)]
+                if not batch:
+                    return
+                addresses = list(dict.fromkeys(address for _, address, _ in batch))
+                infos = dict(
+                    zip(addresses, executor.map(self.acl.account_info, addresses))
+                )
+                yield [
+                    (row, address, amount, _opted_in(infos[address], self.asset_id))
+                    for row, address, amount in batch
+                ]
+
+    def groups(self, in_file):
+        # Signed groups for pipeline.submit_groups, each recorded as in flight
+        # (and the checkpoint saved) just before it's handed over.
+        estimate = fees.current(self.acl)
+        pending = []
+        skipped = []
+        for batch in self._batches(in_file):
+            for row, address, amount, opted_in in batch:
+                if not opted_in:
+                    skipped.append((row, address, amount))
+                    continue
+                pending.append((row, address, amount))
+                if len(pending) == transaction.constants.tx_group_limit:
+                    yield self._dispatch(in_file, pending, skipped, estimate)
+                    pending, skipped = [], []
+        if pending:
+            yield self._dispatch(in_file, pending, skipped, estimate)
+        elif skipped:
+            self._settle_skipped(in_file, skipped, skipped[-1][0] + 1)
+
+    def _settle_skipped(self, in_file, skipped, read):
+        self._results(skipped, "skipped", error="receiver not opted in")
+        self.read = max(self.read, read)
+        self.save(in_file)
+
+    def _dispatch(self, in_file, rows, skipped, estimate):
+        sp = self.acl.suggested_params()
+        sp.last = sp.first + VALIDITY_ROUNDS
+        group = [
+            transaction.AssetTransferTxn(
+                self.sender, sp, address, amount, self.asset_id
+            )
+            for _, address, amount in rows
+        ]
+        fees.pool_fees(group, estimate)
+        transaction.assign_group_id(group)
+        group_id = base64.b64encode(group[0].group).decode("utf-8")
+        self.in_flight[group_id] = {
+            "rows": [list(row) for row in rows],
+            "first": sp.first,
+            "last": sp.last,
+        }
+        self._settle_skipped(
+            in_file, skipped, max(row for row, _, _ in rows + skipped) + 1
+        )
+        return [txn.sign(self.private_key) for txn in group]
+
+    def settle(self, in_file, group, txid, confirmed_round, err):
+        group_id = base64.b64encode(group[0].transaction.group).decode("utf-8")
+        rows = self.in_flight.pop(group_id)["rows"]
+        if err is None:
+            self._results(rows, "sent", txid=txid, round=confirmed_round)
+        else:
+            self._results(rows, "failed", txid=txid, error=err)
+        self.save(in_file)
+
+
+def distribute(
+    sender, asset_id, in_file, out_file, checkpoint_file, window=pipeline.DEFAULT_WINDOW
+):
+    kcl, acl, wallet_handle, pw = get_wallet()
+    private_key = kcl.export_key(wallet_handle, pw, sender)
+    with open(out_file, "a") as out:
+        dist = Distribution(acl, private_key, sender, asset_id, checkpoint_file, out)
+        dist.load(in_file)
+        sent = []
+
+        def groups():
+            for group in dist.groups(in_file):
+                sent.append(group)
+                yield group
+
+        for index, txid, confirmed_round, err in pipeline.submit_groups(
+            acl, groups(), window
+        ):
+            dist.settle(in_file, sent[index], txid, confirmed_round, err)
+            sent[index] = None
+            if err is not None:
+                click.echo(f"Group {txid} failed: {err}", err=True)
+    return dist
+
+
+@click.group("token")
+def command_group():
+    pass
+
+
+@command_group.command("distribute")
+@click.option("--sender", required=True)
+@click.option("--asset_id", type=click.INT, required=True)
+@click.option("--in_file", type=click.Path(exists=True), required=True)
+@click.option("--out_file", type=click.Path(), required=True)
+@click.option(
+    "--checkpoint",
+    "checkpoint_file",
+    type=click.Path(),
+    help="Progress file to resume from (default: in_file + .checkpoint).",
+)
+@click.option(
+    "--window",
+    type=click.INT,
+    default=pipeline.DEFAULT_WINDOW,
+    help="Groups to keep in flight at once.",
+)
+def distribute_cmd(sender, asset_id, in_file, out_file, checkpoint_file, window):
+    # in_file has one "address,amount" per line; out_file gets a JSON line per
+    # row saying whether it was sent, skipped or failed.
+    dist = distribute(
+        sender,
+        asset_id,
+        in_file,
+        out_file,
+        checkpoint_file or f"{in_file}.checkpoint",
+        window,
+    )
+    print(f"Distributed through row {dist.read}")
@@ -0,0 +1,127 @@
+# Copyright 2021 Mackenzie Straight
+#
+# This file is part of algovault.
+#
+# algovault is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# algovault is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with algovault.  If not, see <https://www.gnu.org/licenses/>.
+
+# Per-RPC tracing for the algod and kmd clients. Every request made through the
+# clients in algovault.client ends up in record() when tracing is enabled, which
+# is just a perf_counter delta, a list append and (optionally) one buffered
+# write, so it's fine to leave on for long running jobs.
+import json
+import re
+import threading
+import time
+
+import click
+
+# Path components which are per-call parameters (addresses, txids, app/asset
+# ids, rounds) get folded together so the summary groups by route.
+_ROUTE_PARAM = re.compile(r"/(?:[A-Z2-7]{58}|[A-Z2-7]{52}|\d+)(?=/|$)")
+
+tracer = None
+
+
+class Tracer:
+    def __init__(self, out_file=None):
+        self.command = None
+        self.durations = {}
+        self.sent = {}
+        self.received = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+        self.out = open(out_file, "a", buffering=1 << 16) if out_file else None
+
+    def record(self, service, method, url, duration, sent, received, outcome):
+        if self.command is None:
+            # By the time anything talks to the network we're inside the
+            # subcommand's context, so this is e.g. "subscription list".
+            ctx = click.get_current_context(silent=True)
+            if ctx is not None:
+                self.command = ctx.command_path.partition(" ")[2]
+        path = url.split("?", 1)[0]
+        key = (service, method, _ROUTE_PARAM.sub("/*", path))
+        with self.lock:
+            self._record(key, path, service, method, duration, sent, received, outcome)
+
+    def _record(self, key, path, service, method, duration, sent, received, outcome):
+        durations = self.durations.get(key)
+        if durations is None:
+            durations = self.durations[key] = []
+            self.sent[key] = 0
+            self.received[key] = 0
+            self.errors[key] = 0
+        durations.append(duration)
+        self.sent[key] += sent
+        self.received[key] += received
+        if outcome != "ok":
+            self.errors[key] += 1
+        if self.out is not None:
+            self.out.write(
+                json.dumps(
+                    {
+                        "ts": time.time(),
+                        "command": self.command,
+                        "service": service,
+                        "method": method,
+                        "endpoint": path,
+                        "duration_ms": round(duration * 1000, 3),
+                        "sent": sent,
+                        "received": received,
+                        "outcome": outcome,
+                    }
+                )
+                + "\n"
+            )
+
+    def summary(self):
+        lines = [f"trace: {self.command or '(no command)'}"]
+        lines.append(
+            f"  {'calls':>6} {'errors':>6} {'total ms':>10} {'p50 ms':>8} "
+            f"{'p99 ms':>8} {'sent':>9} {'recv':>9}  endpoint"
+        )
+        total_calls = 0
+        total_time = 0.0
+        for key in sorted(self.durations, key=lambda k: -sum(self.durations[k])):
+            durations = sorted(self.durations[key])
+            total = sum(durations)
+            total_calls += len(durations)
+            total_time += total
+            service, method, route = key
+            lines.append(
+                f"  {len(durations):>6} {self.errors[key]:>6} {total * 1000:>10.1f} "
+                f"{_percentile(durations, 50) * 1000:>8.1f} "
+                f"{_percentile(durations, 99) * 1000:>8.1f} "
+                f"{self.sent[key]:>9} {self.received[key]:>9}  "
+                f"{service} {method} {route}"
+            )
+        lines.append(f"  {total_calls:>6} {'':>6} {total_time * 1000:>10.1f}  total")
+        return "\n".join(lines)
+
+    def close(self):
+        if self.out is not None:
+            self.out.close()
+            self.out = None
+
+
+def _percentile(sorted_values, pct):
+    # Nearest-rank, which is what you want for a handful of samples.
+    rank = max(0, -(-len(sorted_values) * pct // 100) - 1)
+    return sorted_values[rank]
+
+
+def enable(out_file=None):
+    global tracer
+    tracer = Tracer(out_file)
+    return tracer
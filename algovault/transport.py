@@ -0,0 +1,154 @@
+# Copyright 2021 Mackenzie Straight
+#
+# This file is part of algovault.
+#
+# algovault is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# algovault is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with algovault.  If not, see <https://www.gnu.org/licenses/>.
+
+# HTTP transports for the algod and kmd clients. A transport is anything with
+# request(method, url, headers, data) -> (status, body); algovault.client sends
+# every request through whichever one is installed.
+import http.client
+import threading
+import time
+from urllib.error import HTTPError
+from urllib.parse import urlsplit
+from urllib.request import Request, urlopen
+
+
+class UrllibTransport:
+    # What the SDK does: a fresh connection for every request.
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+
+    def request(self, method, url, headers, data):
+        try:
+            with urlopen(
+                Request(url, headers=headers, method=method, data=data),
+                timeout=self.timeout,
+            ) as resp:
+                return resp.status, resp.read()
+        except HTTPError as e:
+            return e.code, e.read()
+
+    def stats(self):
+        return {}
+
+
+class _Pool:
+    def __init__(self, scheme, netloc, size):
+        self.scheme = scheme
+        self.netloc = netloc
+        self.idle = []
+        self.slots = threading.BoundedSemaphore(size)
+
+
+class PooledTransport:
+    """
+    Keeps up to pool_size keep-alive connections per endpoint. Safe to share
+    between threads; a thread which finds every connection to an endpoint busy
+    waits for one to be released.
+    """
+
+    def __init__(self, pool_size=4, idle_timeout=30.0, timeout=None):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.pools = {}
+        self.requests = 0
+        self.created = 0
+        self.reused = 0
+        self.expired = 0
+        self.retried = 0
+
+    def _pool(self, scheme, netloc):
+        key = (scheme, netloc)
+        with self.lock:
+            pool = self.pools.get(key)
+            if pool is None:
+                pool = self.pools[key] = _Pool(scheme, netloc, self.pool_size)
+            return pool
+
+    def _acquire(self, pool):
+        now = time.monotonic()
+        with self.lock:
+            while pool.idle:
+                conn, last_used = pool.idle.pop()
+                if now - last_used < self.idle_timeout:
+                    self.reused += 1
+                    return conn, True
+                self.expired += 1
+                conn.close()
+            self.created += 1
+        if pool.scheme == "https":
+            conn = http.client.HTTPSConnection(pool.netloc, timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(pool.netloc, timeout=self.timeout)
+        return conn, False
+
+    def _release(self, pool, conn):
+        with self.lock:
+            pool.idle.append((conn, time.monotonic()))
+
+    def request(self, method, url, headers, data):
+        parts = urlsplit(url)
+        target = parts.path + ("?" + parts.query if parts.query else "")
+        pool = self._pool(parts.scheme, parts.netloc)
+        with self.lock:
+            self.requests += 1
+        with pool.slots:
+            while True:
+                conn, reused = self._acquire(pool)
+                try:
+                    conn.request(method, target, body=data, headers=headers)
+                    resp = conn.getresponse()
+                    body = resp.read()
+                except (
+                    http.client.RemoteDisconnected,
+                    ConnectionResetError,
+                    BrokenPipeError,
+                ):
+                    conn.close()
+                    # The server timed out a connection we thought was idle.
+                    # Only worth retrying on a connection that was reused.
+                    if not reused:
+                        raise
+                    with self.lock:
+                        self.retried += 1
+                    continue
+                except BaseException:
+                    conn.close()
+                    raise
+                if resp.will_close:
+                    conn.close()
+                else:
+                    self._release(pool, conn)
+                return resp.status, body
+
+    def close(self):
+        with self.lock:
+            for pool in self.pools.values():
+                for conn, _ in pool.idle:
+                    conn.close()
+                pool.idle.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "connections": self.created,
+                "reused": self.reused,
+                "expired": self.expired,
+                "retried": self.retried,
+            }
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 Mackenzie Straight
+#
+# This file is part of algovault.
+#
+# algovault is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# algovault is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with algovault.  If not, see <https://www.gnu.org/licenses/>.
+
+# Cold start timings for a couple of read-only commands. Runs each command as a
+# fresh process against a stub algod/kmd on localhost, once as the CLI is now
+# and once with every command module, PyTeal and init_environ loaded up front
+# (which is what the CLI used to do).
+#
+# $ ./benchmarks/cold_start.py --runs 20
+import base64
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import click
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SENDER = "SMCQDRS5MDSD3DLO6K2IJJU3ZVGN734X2GATUB23BZBQ5M75OBF5GFZGOE"
+
+COMMANDS = {
+    "name get": ["name", "get", "example", "url"],
+    "subscription list": ["subscription", "list", "--sender", SENDER],
+}
+
+EAGER_PRELUDE = (
+    "import runpy, sys;"
+    "import algovault.client, algovault.naming, algovault.naming_teal,"
+    " algovault.qvote_counterexample, algovault.subscription,"
+    " algovault.subscription_teal;"
+    "algovault.client.init_environ();"
+    "sys.argv = sys.argv[1:];"
+    "runpy.run_path(sys.argv[0], run_name='__main__')"
+)
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, obj, code=200):
+        body = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path.startswith("/v2/accounts/"):
+            self._reply({"amount": 0, "round": 1, "apps-local-state": []})
+        elif path == "/v1/wallets":
+            self._reply({"wallets": [{"id": "bench"}]})
+        else:
+            self._reply({"message": "not found"}, 404)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path == "/v1/wallet/init":
+            self._reply({"wallet_handle_token": "bench"})
+        elif self.path == "/v1/key/export":
+            self._reply({"private_key": base64.b64encode(b"\x01" * 64).decode()})
+        else:
+            self._reply({"message": "not found"}, 404)
+
+
+def _make_data_dir(tmp, port):
+    os.mkdir(os.path.join(tmp, "kmd-v0.5"))
+    for name in ["algod.net", os.path.join("kmd-v0.5", "kmd.net")]:
+        with open(os.path.join(tmp, name), "w") as f:
+            f.write(f"127.0.0.1:{port}\n")
+    for name in ["algod.token", os.path.join("kmd-v0.5", "kmd.token")]:
+        with open(os.path.join(tmp, name), "w") as f:
+            f.write("0" * 64 + "\n")
+
+
+def _time_run(argv, env):
+    start = time.perf_counter()
+    subprocess.run(
+        argv,
+        env=env,
+        cwd=ROOT,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        check=False,
+    )
+    return time.perf_counter() - start
+
+
+@click.command()
+@click.option("--runs", type=click.INT, default=10)
+def main(runs):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    with tempfile.TemporaryDirectory() as tmp:
+        _make_data_dir(tmp, server.server_address[1])
+        env = dict(os.environ, ALGORAND_DATA=tmp, PYTHONPATH=ROOT)
+        script = os.path.join(ROOT, "algovault.py")
+        print(f"{'command':<20} {'eager ms':>10} {'lazy ms':>10} {'speedup':>8}")
+        for label, args in COMMANDS.items():
+            eager = [sys.executable, "-c", EAGER_PRELUDE, script, *args]
+            lazy = [sys.executable, script, *args]
+            # Warm the page cache and .pyc files so we only measure imports.
+            _time_run(eager, env)
+            _time_run(lazy, env)
+            eager_ms = statistics.median(_time_run(eager, env) for _ in range(runs))
+            lazy_ms = statistics.median(_time_run(lazy, env) for _ in range(runs))
+            print(
+                f"{label:<20} {eager_ms * 1000:>10.1f} {lazy_ms * 1000:>10.1f} "
+                f"{eager_ms / lazy_ms:>7.2f}x"
+            )
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
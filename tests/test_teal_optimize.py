@@ -0,0 +1,579 @@
+# Copyright 2021 Mackenzie Straight
+#
+# This file is part of algovault.
+#
+# algovault is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# algovault is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with algovault.  If not, see <https://www.gnu.org/licenses/>.
+
+# Differential tests for teal_optimize: every program is run before and after
+# optimizing, against the same randomly drawn transaction fields and state, by
+# a small TEAL interpreter covering the ops our programs use. Both runs must
+# fail together or succeed with the same result, stack, state changes, inner
+# transactions and values in every scratch slot the original program uses.
+import hashlib
+import random
+
+import pytest
+
+from algovault import teal_asm, teal_optimize
+
+_BYTES_FIELDS = {
+    "Sender",
+    "Note",
+    "Lease",
+    "Receiver",
+    "CloseRemainderTo",
+    "Type",
+    "AssetSender",
+    "AssetReceiver",
+    "AssetCloseTo",
+    "TxID",
+    "ApplicationArgs",
+    "Accounts",
+    "RekeyTo",
+    "ZeroAddress",
+    "CreatorAddress",
+    "CurrentApplicationAddress",
+    "GroupID",
+    "arg",
+}
+_ADDRESS_FIELDS = {
+    "Sender",
+    "Receiver",
+    "CloseRemainderTo",
+    "AssetSender",
+    "AssetReceiver",
+    "AssetCloseTo",
+    "Accounts",
+    "RekeyTo",
+    "CreatorAddress",
+    "CurrentApplicationAddress",
+}
+_ADDRESSES = [bytes(32), b"A" * 32, b"B" * 32, bytes(range(32))]
+_BYTES_POOL = _ADDRESSES + [
+    b"",
+    b"\x01",
+    b"Subscribe",
+    b"Dispense",
+    b"DispenseDue",
+    b"DispenseMany",
+    b"Cancel",
+    b"CashIn",
+    (1).to_bytes(8, "big"),
+    (2**63).to_bytes(8, "big"),
+    bytes(range(5)),
+    bytes(range(10)),
+    bytes(range(12)),
+    bytes(range(40)),
+    bytes(range(88)),
+]
+_INT_POOL = [0, 1, 2, 3, 4, 5, 6, 8, 9, 16, 1000, 2**32, 2**63, 2**64 - 1]
+_U64 = 2**64
+
+
+class Fail(Exception):
+    pass
+
+
+class Env:
+    """Transaction fields and opt-ins, drawn lazily but fixed once seen.
+
+    Values are mostly drawn from the program's own constants so that its
+    checks pass often enough to reach the code behind them.
+    """
+
+    def __init__(self, seed, program=None):
+        self.rng = random.Random(seed)
+        self.values = {}
+        constants = [
+            ins.args[0]
+            for ins in (program.instructions if program else [])
+            if ins.op in ("int", "pushint", "byte", "addr", "pushbytes")
+        ]
+        self.bytes = [c for c in constants if isinstance(c, bytes)] + _ADDRESSES[:2]
+        self.ints = [c for c in constants if isinstance(c, int)] + [0, 1]
+
+    def _pick(self, constants, pool):
+        return self.rng.choice(constants if self.rng.random() < 0.9 else pool)
+
+    def field(self, name, *key):
+        full = (name,) + key
+        if full not in self.values:
+            if name == "ZeroAddress":
+                value = bytes(32)
+            elif name in _ADDRESS_FIELDS:
+                value = self._pick([b for b in self.bytes if len(b) == 32], _BYTES_POOL)
+            elif name in _BYTES_FIELDS:
+                value = self._pick(self.bytes, _BYTES_POOL)
+            elif name.startswith("Num") or name in ("GroupSize", "GroupIndex"):
+                value = self._pick([i for i in self.ints if i < 16], range(16))
+            elif name == "opted_in":
+                value = self.rng.randrange(2)
+            else:
+                value = self._pick(self.ints, _INT_POOL)
+            self.values[full] = value
+        return self.values[full]
+
+
+def _check(value, kind):
+    if not isinstance(value, kind):
+        raise Fail(f"expected {kind.__name__}")
+    return value
+
+
+def _uint(value):
+    if not 0 <= value < _U64:
+        raise Fail("overflow")
+    return value
+
+
+_BINARY = {
+    "+": lambda a, b: _uint(a + b),
+    "-": lambda a, b: _uint(a - b),
+    "*": lambda a, b: _uint(a * b),
+    "/": lambda a, b: a // b if b else _uint(-1),
+    "%": lambda a, b: a % b if b else _uint(-1),
+    "<": lambda a, b: int(a < b),
+    ">": lambda a, b: int(a > b),
+    "<=": lambda a, b: int(a <= b),
+    ">=": lambda a, b: int(a >= b),
+    "&&": lambda a, b: int(bool(a and b)),
+    "||": lambda a, b: int(bool(a or b)),
+    "|": lambda a, b: a | b,
+    "&": lambda a, b: a & b,
+    "^": lambda a, b: a ^ b,
+    "shl": lambda a, b: (a << b) % _U64 if b < 64 else _uint(-1),
+    "shr": lambda a, b: a >> b if b < 64 else _uint(-1),
+}
+_HASHES = {
+    "sha256": lambda x: hashlib.sha256(x).digest(),
+    "keccak256": lambda x: hashlib.sha3_256(x).digest(),
+    # Stand-in; both runs only need to agree.
+    "sha512_256": lambda x: hashlib.sha512(x).digest()[:32],
+}
+
+
+def _slice(data, start, end):
+    if not start <= end <= len(data):
+        raise Fail("out of bounds")
+    return data[start:end]
+
+
+def run(program, env, limit=100000):
+    ins = program.instructions
+    labels = program.label_index()
+    stack, scratch, state, effects, frames = [], {}, {}, [], []
+
+    def pop(kind=None):
+        if not stack:
+            raise Fail("stack underflow")
+        value = stack.pop()
+        return value if kind is None else _check(value, kind)
+
+    def push(value):
+        if isinstance(value, bytes) and len(value) > 4096:
+            raise Fail("too long")
+        stack.append(value)
+
+    def field(name, *key):
+        value = env.field(name, *key)
+        return value
+
+    pc = 0
+    for _ in range(limit):
+        if pc >= len(ins):
+            break
+        op, args = ins[pc].op, ins[pc].args
+        pc += 1
+        if op in ("int", "pushint", "byte", "addr", "pushbytes"):
+            push(args[0])
+        elif op == "load":
+            push(scratch.get(args[0], 0))
+        elif op == "store":
+            scratch[args[0]] = pop()
+        elif op == "dup":
+            value = pop()
+            push(value)
+            push(value)
+        elif op == "dup2":
+            b, a = pop(), pop()
+            stack.extend([a, b, a, b])
+        elif op == "swap":
+            b, a = pop(), pop()
+            stack.extend([b, a])
+        elif op == "pop":
+            pop()
+        elif op == "select":
+            c, b, a = pop(int), pop(), pop()
+            push(b if c else a)
+        elif op in _BINARY:
+            b, a = pop(int), pop(int)
+            push(_BINARY[op](a, b))
+        elif op in ("==", "!="):
+            b, a = pop(), pop()
+            if type(a) is not type(b):
+                raise Fail("type mismatch")
+            push(int((a == b) == (op == "==")))
+        elif op == "!":
+            push(int(not pop(int)))
+        elif op == "~":
+            push(pop(int) ^ (_U64 - 1))
+        elif op == "len":
+            push(len(pop(bytes)))
+        elif op == "itob":
+            push(pop(int).to_bytes(8, "big"))
+        elif op == "btoi":
+            value = pop(bytes)
+            if len(value) > 8:
+                raise Fail("btoi too long")
+            push(int.from_bytes(value, "big"))
+        elif op == "concat":
+            b, a = pop(bytes), pop(bytes)
+            push(a + b)
+        elif op == "substring":
+            push(_slice(pop(bytes), args[0], args[1]))
+        elif op == "substring3":
+            end, start, data = pop(int), pop(int), pop(bytes)
+            push(_slice(data, start, end))
+        elif op == "extract":
+            data = pop(bytes)
+            start, length = args
+            push(_slice(data, start, len(data) if length == 0 else start + length))
+        elif op == "extract3":
+            length, start, data = pop(int), pop(int), pop(bytes)
+            push(_slice(data, start, start + length))
+        elif op in ("extract_uint16", "extract_uint32", "extract_uint64"):
+            size = int(op[len("extract_uint") :]) // 8
+            start, data = pop(int), pop(bytes)
+            push(int.from_bytes(_slice(data, start, start + size), "big"))
+        elif op == "getbyte":
+            index, data = pop(int), pop(bytes)
+            push(_slice(data, index, index + 1)[0])
+        elif op in _HASHES:
+            push(_HASHES[op](pop(bytes)))
+        elif op == "ed25519verify":
+            key, sig, data = pop(bytes), pop(bytes), pop(bytes)
+            push(hashlib.sha256(data + sig + key).digest()[0] & 1)
+        elif op == "txn":
+            push(field(args[0]))
+        elif op == "txna":
+            push(field(args[0], args[1]))
+        elif op == "txnas":
+            push(field(args[0], pop(int)))
+        elif op == "gtxn":
+            push(field(args[1], "group", args[0]))
+        elif op == "gtxna":
+            push(field(args[1], "group", args[0], args[2]))
+        elif op == "gtxns":
+            push(field(args[0], "group", pop(int)))
+        elif op == "gtxnsa":
+            push(field(args[0], "group", pop(int), args[1]))
+        elif op == "global":
+            push(field(args[0]))
+        elif op == "arg":
+            push(field("arg", args[0]))
+        elif op.startswith("arg_"):
+            push(field("arg", int(op[4:])))
+        elif op == "app_opted_in":
+            pop(int)
+            push(field("opted_in", pop()))
+        elif op == "app_local_get":
+            key, account = pop(bytes), pop()
+            push(state.get((account, key), 0))
+        elif op == "app_local_get_ex":
+            key, _, account = pop(bytes), pop(int), pop()
+            present = (account, key) in state
+            push(state.get((account, key), 0))
+            push(int(present))
+        elif op == "app_local_put":
+            value, key, account = pop(), pop(bytes), pop()
+            state[account, key] = value
+            effects.append(("put", account, key, value))
+        elif op == "app_local_del":
+            key, account = pop(bytes), pop()
+            state.pop((account, key), None)
+            effects.append(("del", account, key))
+        elif op == "app_global_put":
+            value, key = pop(), pop(bytes)
+            state["global", key] = value
+            effects.append(("global", key, value))
+        elif op == "itxn_begin" or op == "itxn_submit":
+            effects.append((op,))
+        elif op == "itxn_field":
+            effects.append((op, args[0], pop()))
+        elif op == "log":
+            effects.append((op, pop(bytes)))
+        elif op in ("b", "bz", "bnz"):
+            taken = op == "b" or bool(pop(int)) == (op == "bnz")
+            if taken:
+                pc = labels[args[0]]
+        elif op == "callsub":
+            frames.append(pc)
+            pc = labels[args[0]]
+        elif op == "retsub":
+            if not frames:
+                raise Fail("retsub without callsub")
+            pc = frames.pop()
+        elif op == "assert":
+            if not pop(int):
+                raise Fail("assert")
+        elif op == "err":
+            raise Fail("err")
+        elif op == "return":
+            return pop(int), stack, scratch, effects
+        else:
+            raise NotImplementedError(op)
+    else:
+        raise Fail("step limit")
+    if len(stack) != 1:
+        raise Fail("stack must end with one value")
+    return _check(stack[0], int), [], scratch, effects
+
+
+def outcome(program, env, slots):
+    try:
+        result, stack, scratch, effects = run(program, env)
+    except Fail:
+        return "fail"
+    return result, stack, {slot: scratch.get(slot, 0) for slot in slots}, effects
+
+
+def used_slots(program):
+    return {ins.args[0] for ins in program.instructions if ins.op in ("load", "store")}
+
+
+def assert_equivalent(source, seeds=range(200)):
+    """Returns the optimized program after checking it against source."""
+    original = teal_asm.parse(source)
+    optimized = teal_asm.parse(teal_optimize.optimize(source))
+    slots = used_slots(original)
+    outcomes = set()
+    for seed in seeds:
+        env = Env(seed, original)
+        expected = outcome(original, env, slots)
+        assert outcome(optimized, env, slots) == expected, (seed, env.values)
+        outcomes.add(expected == "fail")
+    return optimized, outcomes
+
+
+def _text(program):
+    return [ins.text() for ins in program.instructions]
+
+
+def test_concat_constants():
+    optimized, _ = assert_equivalent(
+        '#pragma version 5\nbyte "ab"\nbyte 0x0102\nconcat\nlen\nreturn'
+    )
+    assert _text(optimized)[0] == "byte 0x61620102"
+
+
+def test_substring3_to_extract():
+    optimized, outcomes = assert_equivalent(
+        "#pragma version 5\ntxn Note\nint 2\nint 10\nsubstring3\nstore 0\nint 1"
+    )
+    assert "extract 2 8" in _text(optimized)
+    # Some Notes are too short, so both runs fail for those.
+    assert outcomes == {True, False}
+
+
+def test_substring3_empty_stays_substring():
+    # extract's length 0 means "to the end", so this can't become an extract.
+    optimized, _ = assert_equivalent(
+        "#pragma version 5\ntxn Note\nint 5\nint 5\nsubstring3\nlen\n!"
+    )
+    assert "substring 5 5" in _text(optimized)
+
+
+@pytest.mark.parametrize("start,end", [(7, 3), (300, 400), (250, 260)])
+def test_substring3_bounds(start, end):
+    # Backwards or beyond what an immediate can hold: fails in both, or isn't
+    # rewritten at all.
+    optimized, _ = assert_equivalent(
+        f"#pragma version 5\ntxn Note\nint {start}\nint {end}\nsubstring3\nlen\n!"
+    )
+    if end >= 256:
+        assert "substring3" in _text(optimized)
+
+
+def test_extract_uint64():
+    for tail in ("int 24\nint 32\nsubstring3\nbtoi", "extract 24 8\nbtoi"):
+        optimized, outcomes = assert_equivalent(
+            f"#pragma version 5\ntxna ApplicationArgs 0\n{tail}\nint 1\n>="
+        )
+        assert _text(optimized)[-4:-2] == ["int 24", "extract_uint64"]
+        assert outcomes == {True, False}
+
+
+def test_load_store_pairs():
+    optimized, _ = assert_equivalent(
+        "#pragma version 5\ntxn Fee\nstore 1\nload 1\nload 1\nstore 1\nint 3\n+\n"
+        "store 2\nload 2"
+    )
+    assert _text(optimized)[:3] == ["txn Fee", "dup", "store 1"]
+    assert "load 1" not in _text(optimized)[3:]
+
+
+def test_label_inside_rewrite_site():
+    # mid is a branch target in the middle of each pattern, so neither may be
+    # folded: the branch arrives with a different stack.
+    source = """#pragma version 5
+byte "abcdef"
+int 0
+txn Fee
+bnz mid
+pop
+int 2
+mid:
+int 4
+substring3
+txn Fee
+bnz next
+byte "a"
+next:
+byte "bc"
+concat
+len
+"""
+    assert_equivalent(source)
+    text = teal_optimize.optimize(source)
+    assert "mid:\nint 4\nsubstring3" in text
+    assert 'next:\nbyte "bc"\nconcat' in text or "next:\nbyte 0x6263\nconcat" in text
+
+
+def test_label_between_rewrite_sites():
+    # Both sites fold; the label in between stays where it was.
+    source = """#pragma version 5
+txn Fee
+bnz mid
+byte "a"
+byte "b"
+concat
+store 0
+mid:
+txn Note
+int 1
+int 3
+substring3
+len
+load 0
+len
++
+"""
+    optimized, _ = assert_equivalent(source)
+    text = teal_optimize.optimize(source)
+    assert 'byte "ab"' in text or "byte 0x6162" in text
+    assert "store 0\nmid:\ntxn Note\nextract 1 2" in text
+
+
+def test_cse_skips_used_slots():
+    expr = "txna ApplicationArgs 0\nint 32\nint 64\nsubstring3\nlen\nitob\nsha256"
+    source = (
+        "#pragma version 5\nint 7\nstore 255\nint 8\nstore 254\n"
+        f"{expr}\n{expr}\n==\n{expr}\nlen\n==\nload 255\nload 254\n<\n&&"
+    )
+    optimized, _ = assert_equivalent(source)
+    new_slots = used_slots(optimized) - used_slots(teal_asm.parse(source))
+    assert new_slots == {253}
+
+
+def test_cse_needs_a_free_slot():
+    fill = "".join(f"int {i}\nstore {i}\n" for i in range(256))
+    expr = "txn Note\nsha256\nsha256\nsha256"
+    source = f"#pragma version 5\n{fill}{expr}\n{expr}\n=="
+    optimized, _ = assert_equivalent(source, seeds=range(20))
+    assert _text(optimized).count("sha256") == 6
+
+
+def test_cse_not_across_stores():
+    # The second `load 0` sees a different value and mustn't be merged.
+    source = (
+        "#pragma version 5\ntxn Fee\nstore 0\nload 0\nint 5\n+\nitob\nsha256\n"
+        "int 9\nstore 0\nload 0\nint 5\n+\nitob\nsha256\n=="
+    )
+    assert_equivalent(source)
+
+
+def _random_expr(rng, kind, depth):
+    if depth == 0 or rng.random() < 0.2:
+        if kind == "int":
+            return rng.choice(
+                [f"int {rng.choice(_INT_POOL[:10])}", "txn Fee", "txn NumAppArgs"]
+                + [f"load {rng.randrange(3)}"]
+            )
+        return rng.choice(
+            ['byte "xy"', "byte 0x0011223344556677", "txn Note", "txn Sender"]
+            + [f"txna ApplicationArgs {rng.randrange(2)}"]
+        )
+    sub = lambda k: _random_expr(rng, k, depth - 1)
+    if kind == "int":
+        choice = rng.randrange(6)
+        if choice == 0:
+            return f"{sub('int')}\n{sub('int')}\n{rng.choice(list(_BINARY))}"
+        if choice == 1:
+            return f"{sub('bytes')}\nlen"
+        if choice == 2:
+            start = rng.randrange(0, 12)
+            return f"{sub('bytes')}\nint {start}\nint {start + 8}\nsubstring3\nbtoi"
+        if choice == 3:
+            return f"{sub('bytes')}\nextract {rng.randrange(4)} 8\nbtoi"
+        if choice == 4:
+            return f"{sub('bytes')}\n{sub('bytes')}\n=="
+        return f"{sub('int')}\nstore {rng.randrange(3)}\nload {rng.randrange(3)}"
+    choice = rng.randrange(4)
+    if choice == 0:
+        return f"{sub('bytes')}\n{sub('bytes')}\nconcat"
+    if choice == 1:
+        start = rng.randrange(0, 10)
+        end = start + rng.randrange(-1, 10)
+        return f"{sub('bytes')}\nint {start}\nint {end}\nsubstring3"
+    if choice == 2:
+        return f"{sub('int')}\nitob"
+    return f"{sub('bytes')}\nsha256"
+
+
+def test_random_programs():
+    rng = random.Random(5)
+    for _ in range(300):
+        exprs = [_random_expr(rng, "int", 3) for _ in range(3)]
+        # Repeat some expressions so CSE has something to do.
+        body = "\n".join(
+            f"{rng.choice(exprs)}\nstore {rng.randrange(4)}" for _ in range(5)
+        )
+        assert_equivalent(f"#pragma version 5\n{body}\nint 1", seeds=range(40))
+
+
+def test_subscription_logicsig():
+    # Earlier versions come out of the optimizer unchanged.
+    from pyteal import Mode, compileTeal
+    from algovault import subscription_teal
+
+    source = compileTeal(
+        subscription_teal.sub_logicsig_expr(3), Mode.Signature, version=5
+    )
+    _, outcomes = assert_equivalent(source, seeds=range(5000))
+    assert outcomes == {True, False}
+
+
+@pytest.mark.parametrize("version", [2, 3])
+def test_subscription_approval(version):
+    from algovault import subscription_teal
+
+    source = subscription_teal.subtoken_approval(1, 2, version)
+    _, outcomes = assert_equivalent(source, seeds=range(2000))
+    assert outcomes == {True, False}
+
+
+def test_naming_approval():
+    from algovault import naming_teal
+
+    assert_equivalent(naming_teal.approval_program(), seeds=range(500))
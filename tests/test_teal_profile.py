@@ -0,0 +1,83 @@
+# Copyright 2021 Mackenzie Straight
+#
+# This file is part of algovault.
+#
+# algovault is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# algovault is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with algovault.  If not, see <https://www.gnu.org/licenses/>.
+
+# Budget checks for the approval program's loops, using the bounds the client
+# sticks to when building calls.
+import pytest
+
+from algovault import teal_asm, teal_profile
+from algovault.subscription import (
+    DEFAULT_CASH_ID,
+    DEFAULT_SUB_ID,
+    MAX_CALL_ACCOUNTS,
+    MAX_CALL_DISPENSES,
+)
+from algovault.subscription_teal import (
+    PACKED_TEMPLATE_VERSION,
+    subtoken_approval_expr,
+)
+
+
+def _dispense_many(template_version, count, optimize):
+    def build():
+        return subtoken_approval_expr(DEFAULT_CASH_ID, DEFAULT_SUB_ID, template_version)
+
+    result = teal_profile.profile_expr(
+        build,
+        "app",
+        optimize=optimize,
+        loop_bounds={"NoOp/DispenseMany": count},
+    )
+    assert not result["loops"]
+    (branch,) = [b for b in result["branches"] if b["branch"] == "NoOp/DispenseMany"]
+    return result, branch
+
+
+# Deploys can skip the optimizer, so both outputs have to fit.
+@pytest.mark.parametrize("optimize", [False, True])
+def test_dispense_many_fits(optimize):
+    result, branch = _dispense_many(
+        PACKED_TEMPLATE_VERSION, MAX_CALL_DISPENSES, optimize
+    )
+    assert branch["worst_cost"] <= result["budget"]
+
+
+# The legacy loop walks every account in the call. Unoptimized it would be a
+# few ops over with all four, so it only fits as deployed by default.
+def test_legacy_dispense_many_fits():
+    result, branch = _dispense_many(
+        PACKED_TEMPLATE_VERSION - 1, MAX_CALL_ACCOUNTS, True
+    )
+    assert branch["worst_cost"] <= result["budget"]
+
+
+def test_loop_bound_scales_cost():
+    _, once = _dispense_many(PACKED_TEMPLATE_VERSION, 1, False)
+    _, twice = _dispense_many(PACKED_TEMPLATE_VERSION, 2, False)
+    _, thrice = _dispense_many(PACKED_TEMPLATE_VERSION, 3, False)
+    assert thrice["worst_cost"] - twice["worst_cost"] == (
+        twice["worst_cost"] - once["worst_cost"]
+    )
+    assert twice["worst_cost"] > once["worst_cost"]
+
+
+def test_unbounded_loop_is_flagged():
+    program = teal_asm.parse(
+        "#pragma version 5\nint 3\nloop:\nint 1\n-\ndup\nbnz loop\nreturn\n"
+    )
+    assert teal_profile.Profile(program).loops
+    assert not teal_profile.Profile(program, loop_bounds={1: 3}).loops